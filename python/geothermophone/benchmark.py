@@ -0,0 +1,248 @@
+'''
+Benchmarks on synthetic NCEP-shaped files, so performance can be measured
+(and compared across versions) without the real data.
+
+write_fixture makes a NetCDF file shaped like the reanalysis files: a 73x144
+regular grid (air, rhum, wspd) or prate's 94x192 Gaussian one, with lat/lon
+coordinates, packed int16 values with scale_factor/add_offset and a sprinkling
+of missing values, and a monthly or 4x daily time axis as many years long as
+asked for.
+
+Each case runs the pipeline.py stages over its fixture, timing each stage
+on its own (the time spent in it, less what it spent waiting for the stage
+before), and reports seconds and throughput in cells a second: grid cells
+for read and reduce, region values for smooth, normalize and export. It also
+times parser.get_data end to end. Every measurement runs in a fresh process,
+so each peak RSS is its own.
+
+python benchmark.py results.json [baseline.json] runs default_cases, saves
+the results as JSON, and compares them against an earlier run's.
+'''
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+from scipy.io import netcdf
+import numpy
+from dataset import peak_memory_kb
+import packing
+import parser
+import pipeline
+import regrid
+import timeaxis
+
+grids = {'regular': (73, 144), 'gaussian': (94, 192)}
+# Time units as the files have them.
+time_units = {'monthly': 'hours since 1-1-1 00:00:0.0', '4xdaily': 'hours since 1800-1-1 00:00:0.0'}
+default_cases = [
+	{'name': 'air monthly 73x144', 'var': 'air', 'grid': 'regular', 'step': 'monthly', 'years': 62},
+	{'name': 'prate monthly 94x192', 'var': 'prate', 'grid': 'gaussian', 'step': 'monthly', 'years': 62},
+	{'name': 'air 4x daily 73x144', 'var': 'air', 'grid': 'regular', 'step': '4xdaily', 'years': 4},
+]
+stages = ('read', 'reduce', 'smooth', 'normalize', 'export')
+# Slower than this, relative to the baseline, is reported as a regression.
+regression_ratio = 1.2
+
+def coordinates(grid):
+	''' (lats, lons) of a grid, north to south. '''
+	num_lats, num_lons = grids[grid]
+	if grid == 'gaussian':
+		return (regrid.gaussian_lats(num_lats), regrid.regular_lons(num_lons))
+	return (regrid.regular_lats(num_lats), regrid.regular_lons(num_lons))
+
+def dates(step, years, start='1960-01'):
+	''' datetime64s of a monthly or 4x daily time axis, years long. '''
+	if step == 'monthly':
+		return numpy.datetime64(start, 'M') + numpy.arange(int(round(years * 12)))
+	assert step == '4xdaily', 'Unknown time step %r' % step
+	return numpy.datetime64(start, 'h') + 6 * numpy.arange(int(round(years * 365.25 * 4)))
+
+def write_fixture(filename, var, grid, step, years, block_size=480, seed=0):
+	''' Write a synthetic packed NetCDF file (see the module docstring):
+	a temperature-like field with a seasonal cycle, a trend and noise. '''
+	random = numpy.random.RandomState(seed)
+	lats, lons = coordinates(grid)
+	times = dates(step, years)
+	lat_grid = numpy.radians(lats)[:, numpy.newaxis]
+	lon_grid = numpy.radians(lons)[numpy.newaxis, :]
+	# Like wspd: scale 0.01 and offset 225.45, missing value 32766.
+	scale_factor, add_offset, missing_value = 0.01, 225.45, 32766
+
+	f = netcdf.netcdf_file(filename, 'w')
+	f.createDimension('time', len(times))
+	f.createDimension('lat', len(lats))
+	f.createDimension('lon', len(lons))
+	f.createVariable('lat', 'f', ('lat',))[:] = lats
+	f.createVariable('lon', 'f', ('lon',))[:] = lons
+	time_var = f.createVariable('time', 'd', ('time',))
+	time_var[:] = timeaxis.encode(times, time_units[step])
+	time_var.units = time_units[step]
+	data = f.createVariable(var, 'h', ('time', 'lat', 'lon'))
+	years_in = (times - times[0]).astype('timedelta64[h]').astype(float) / (365.25 * 24)
+	for start in range(0, len(times), block_size):
+		t = years_in[start:start + block_size, numpy.newaxis, numpy.newaxis]
+		values = (15 + 25 * numpy.cos(lat_grid) + 3 * numpy.sin(lon_grid) + 0.02 * t
+				  + 10 * numpy.sin(lat_grid) * numpy.cos(2 * numpy.pi * t)
+				  + random.normal(0, 1, (len(t), len(lats), len(lons))))
+		values[random.random_sample(values.shape) < 0.001] = numpy.nan
+		data[start:start + len(t)] = packing.pack(values, scale_factor, add_offset, missing_value)
+	data.scale_factor = numpy.float32(scale_factor)
+	data.add_offset = numpy.float32(add_offset)
+	data.missing_value = numpy.int16(missing_value)
+	data = None
+	f.close()
+
+def _timed(chunks, seconds, stage):
+	''' Pass chunks through, adding the time spent getting each to seconds[stage]. '''
+	started = time.time()
+	for chunk in chunks:
+		seconds[stage] += time.time() - started
+		yield chunk
+		started = time.time()
+	seconds[stage] += time.time() - started
+
+def measure_stages(var, filename, output, window=12, block_size=pipeline.defaults['block_size']):
+	''' Run the stages over a fixture, returning per-stage results. '''
+	started = time.time()
+	read = pipeline.Read(var, filename, datetime.min, None, 0, block_size)
+	region_reducer = parser.make_octant_reducer(read.dataset.grid_shape, read.dataset.lats, read.dataset.lons)
+	num_outputs = max(len(read) - window, 0)
+	emit = pipeline.Emit(output, [var], region_reducer.keys, num_outputs, {var: (0, 255)})
+	seconds = dict((stage, 0.0) for stage in stages)
+	# Copy each block, so that reading isn't put off until it's reduced.
+	chunks = _timed(((start, numpy.array(block), packing) for (start, block, packing) in read.stream()), seconds, 'read')
+	chunks = _timed(pipeline.Reduce(var, region_reducer).stream(chunks), seconds, 'reduce')
+	chunks = _timed(pipeline.Smooth(window, block_size=block_size).stream(chunks), seconds, 'smooth')
+	chunks = _timed(pipeline.Normalize('relative').stream(chunks), seconds, 'normalize')
+	chunks = _timed(emit.stream(chunks, window), seconds, 'export')
+	for chunk in chunks:
+		pass
+	emit.close()
+
+	grid_cells = len(read) * int(numpy.prod(read.dataset.grid_shape))
+	region_values = num_outputs * region_reducer.num_regions
+	results = {}
+	previous = 0.0
+	for stage in stages:
+		# Each stage's time includes waiting for the ones before it.
+		own = max(seconds[stage] - previous, 0.0)
+		previous = seconds[stage]
+		cells = grid_cells if stage in ('read', 'reduce') else region_values
+		results[stage] = {'seconds': own, 'cells': cells, 'cells_per_second': cells / own if own else None}
+	return {'records': len(read), 'stages': results, 'wall_seconds': time.time() - started,
+			'peak_rss_kb': peak_memory_kb()}
+
+def measure_get_data(var, filename):
+	''' Time parser.get_data end to end. '''
+	started = time.time()
+	parser.get_data(var, filename)
+	return {'seconds': time.time() - started, 'peak_rss_kb': peak_memory_kb()}
+
+def _task(task):
+	function, args = task
+	return globals()[function](*args)
+
+def _in_fresh_process(function, *args):
+	pool = multiprocessing.Pool(1)
+	try:
+		return pool.apply(_task, ((function, args),))
+	finally:
+		pool.close()
+		pool.join()
+
+def run_case(case, directory):
+	''' Write a case's fixture into directory and measure it. '''
+	filename = os.path.join(directory, '%s.%s.%s.nc' % (case['var'], case['grid'], case['step']))
+	started = time.time()
+	_in_fresh_process('write_fixture', filename, case['var'], case['grid'], case['step'], case['years'])
+	result = dict(case)
+	result['fixture_seconds'] = time.time() - started
+	result['fixture_bytes'] = os.path.getsize(filename)
+	result.update(_in_fresh_process('measure_stages', case['var'], filename, os.path.join(directory, 'out.gtp')))
+	result['get_data'] = _in_fresh_process('measure_get_data', case['var'], filename)
+	os.remove(filename)
+	return result
+
+def _revision():
+	try:
+		return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+									   cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+def run(cases=default_cases, directory=None):
+	''' Run the cases (in a temporary directory unless given one), returning
+	results ready to be saved as JSON. '''
+	tmpdir = directory or tempfile.mkdtemp()
+	try:
+		results = [run_case(case, tmpdir) for case in cases]
+	finally:
+		if directory is None:
+			shutil.rmtree(tmpdir)
+	return {'date': datetime.now().isoformat(), 'revision': _revision(), 'python': platform.python_version(),
+			'numpy': numpy.__version__, 'machine': platform.machine(), 'cases': results}
+
+def compare(baseline, results):
+	''' Lines comparing each stage's time with a baseline run's, flagging
+	regressions. '''
+	baseline_cases = dict((case['name'], case) for case in baseline['cases'])
+	lines = []
+	for case in results['cases']:
+		old = baseline_cases.get(case['name'])
+		if old is None:
+			continue
+		timings = [(stage, old['stages'][stage]['seconds'], case['stages'][stage]['seconds']) for stage in stages]
+		timings.append(('get_data', old['get_data']['seconds'], case['get_data']['seconds']))
+		for stage, old_seconds, seconds in timings:
+			ratio = seconds / old_seconds if old_seconds else float('inf')
+			lines.append('%-24s %-10s %8.3fs -> %8.3fs  x%.2f%s' % (case['name'], stage, old_seconds, seconds, ratio,
+																	'  REGRESSION' if ratio > regression_ratio else ''))
+		lines.append('%-24s %-10s %8d KB -> %8d KB' % (case['name'], 'peak rss', old['peak_rss_kb'], case['peak_rss_kb']))
+	return lines
+
+def summary(results):
+	lines = []
+	for case in results['cases']:
+		lines.append('%s: %d records, %.2fs, peak RSS %.1f MB' % (case['name'], case['records'], case['wall_seconds'],
+																case['peak_rss_kb'] / 1024.0))
+		for stage in stages:
+			stats = case['stages'][stage]
+			lines.append('  %-10s %8.3fs %14s cells/s' % (stage, stats['seconds'],
+														  '%.0f' % stats['cells_per_second'] if stats['cells_per_second'] else '-'))
+		lines.append('  %-10s %8.3fs' % ('get_data', case['get_data']['seconds']))
+	return lines
+
+def test_benchmark():
+	tmpdir = tempfile.mkdtemp()
+	try:
+		filename = os.path.join(tmpdir, 'prate.nc')
+		write_fixture(filename, 'prate', 'gaussian', '4xdaily', 0.05, block_size=7)
+		f = netcdf.netcdf_file(filename, 'r', mmap=False)
+		data = f.variables['prate']
+		assert data.shape == (73, 94, 192) and data.data.dtype.str.endswith('i2')
+		assert packing.Packing.of(data).is_packed() and (data.data == 32766).any()
+		assert timeaxis.TimeAxis.from_variable(f.variables['time']).dates[1] == numpy.datetime64('1960-01-01T06:00')
+		f.close()
+		results = run([{'name': 'tiny', 'var': 'air', 'grid': 'regular', 'step': 'monthly', 'years': 2}], tmpdir)
+	finally:
+		shutil.rmtree(tmpdir)
+	case = json.loads(json.dumps(results))['cases'][0]
+	assert case['records'] == 24 and case['peak_rss_kb'] > 0
+	assert case['stages']['reduce']['cells'] == 24 * 73 * 144 and case['stages']['export']['cells'] == 12 * 8
+	assert len(compare(results, results)) == len(stages) + 2 and not any('REGRESSION' in line for line in compare(results, results))
+
+if __name__ == '__main__':
+	# python benchmark.py results.json [baseline.json]
+	import sys
+	results = run()
+	with open(sys.argv[1], 'w') as f:
+		json.dump(results, f, indent=1, sort_keys=True)
+	print '\n'.join(summary(results))
+	if len(sys.argv) > 2:
+		with open(sys.argv[2]) as f:
+			print '\n'.join(compare(json.load(f), results))
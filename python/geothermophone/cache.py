@@ -0,0 +1,161 @@
+'''
+On-disk cache of reduced region series, so re-running with a different
+normalization doesn't mean re-reducing every NetCDF file.
+
+An entry is keyed by the source file (path plus size/mtime, or a hash of its
+contents), the variable, the region layout, the time window and whether the
+running average was applied, plus cache_version, so that entries reduced the
+old way stop matching when the reduction itself changes. Entries are .npz
+files named after a hash of that key. The cache is bounded in size; the least recently used entries are evicted
+first (use is tracked via the entry's mtime).
+'''
+import hashlib
+import json
+import os
+import tempfile
+import numpy
+
+default_cache_dir = os.path.expanduser(os.path.join('~', '.geothermophone', 'cache'))
+default_max_bytes = 256 * 1024 * 1024
+# Bump whenever the same file and parameters would reduce to different series.
+# 2: packed values are decoded per region after summing, not per cell before.
+cache_version = 2
+
+def file_signature(filename, hash_contents=False):
+	''' Identify the current version of a file: size and mtime, or a sha1 of
+	its contents if hash_contents is set (slower, but survives touch/copy). '''
+	stat = os.stat(filename)
+	if not hash_contents:
+		return {'size': stat.st_size, 'mtime': stat.st_mtime}
+	sha1 = hashlib.sha1()
+	with open(filename, 'rb') as f:
+		for chunk in iter(lambda: f.read(1 << 20), b''):
+			sha1.update(chunk)
+	return {'size': stat.st_size, 'sha1': sha1.hexdigest()}
+
+class RegionCache(object):
+	''' Size-bounded store of {region key: series} dicts. '''
+	def __init__(self, directory=default_cache_dir, max_bytes=default_max_bytes, hash_contents=False):
+		self.directory = directory
+		self.max_bytes = max_bytes
+		self.hash_contents = hash_contents
+		self.hits = 0
+		self.misses = 0
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+
+	def make_key(self, filename, **params):
+		''' Build the key for a source file plus whatever parameters produced the
+		series (variable, layout, window...). Values must be JSON-able. '''
+		key = dict(params)
+		key['version'] = cache_version
+		key['source'] = os.path.abspath(filename)
+		key.update(file_signature(filename, self.hash_contents))
+		return key
+
+	def _path(self, key):
+		digest = hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+		return os.path.join(self.directory, digest + '.npz')
+
+	def get(self, key):
+		''' Return the cached series for key, or None. '''
+		path = self._path(key)
+		try:
+			with numpy.load(path) as entry:
+				region_keys = json.loads(str(entry['keys']))
+				values = entry['values']
+		except (IOError, OSError, KeyError, ValueError):
+			self.misses += 1
+			return None
+		os.utime(path, None) # mark as recently used
+		self.hits += 1
+		return dict((tuple(region_key) if isinstance(region_key, list) else region_key, values[i].tolist())
+					for i, region_key in enumerate(region_keys))
+
+	def put(self, key, series):
+		''' Store series (a dict from region key to a list of values, all the
+		same length), then evict down to max_bytes. '''
+		region_keys = sorted(series.keys())
+		values = numpy.array([series[region_key] for region_key in region_keys], dtype=float)
+		fd, tmp_path = tempfile.mkstemp(suffix='.npz', dir=self.directory)
+		try:
+			with os.fdopen(fd, 'wb') as f:
+				numpy.savez(f, keys=numpy.array(json.dumps(region_keys)),
+							source=numpy.array(key['source']), values=values)
+			os.rename(tmp_path, self._path(key))
+		except:
+			os.remove(tmp_path)
+			raise
+		self.evict()
+
+	def _entries(self):
+		''' (mtime, size, path) of each entry, oldest first. '''
+		entries = []
+		for name in os.listdir(self.directory):
+			if name.endswith('.npz'):
+				path = os.path.join(self.directory, name)
+				stat = os.stat(path)
+				entries.append((stat.st_mtime, stat.st_size, path))
+		return sorted(entries)
+
+	def evict(self):
+		''' Remove least recently used entries until we're within max_bytes. '''
+		entries = self._entries()
+		total = sum(size for (mtime, size, path) in entries)
+		for (mtime, size, path) in entries:
+			if total <= self.max_bytes:
+				break
+			os.remove(path)
+			total -= size
+
+	def invalidate(self, filename=None):
+		''' Drop every entry derived from filename, or everything if None. '''
+		source = filename and os.path.abspath(filename)
+		for (mtime, size, path) in self._entries():
+			if source is not None:
+				with numpy.load(path) as entry:
+					if str(entry['source']) != source:
+						continue
+			os.remove(path)
+
+def test_region_cache():
+	import shutil
+	tmpdir = tempfile.mkdtemp()
+	try:
+		source = os.path.join(tmpdir, 'air.nc')
+		with open(source, 'w') as f:
+			f.write('not really netcdf')
+		cache = RegionCache(os.path.join(tmpdir, 'cache'), max_bytes=10 ** 6)
+		series = {(0, 0): [1.0, 2.0], (0, 1): [3.0, float('nan')]}
+		key = cache.make_key(source, var='air', runningAve=True)
+		assert cache.get(key) is None
+		cache.put(key, series)
+		cached = cache.get(key)
+		assert cached[(0, 0)] == [1.0, 2.0] and numpy.isnan(cached[(0, 1)][1])
+		assert (cache.hits, cache.misses) == (1, 1)
+		assert cache.get(cache.make_key(source, var='air', runningAve=False)) is None
+		# Entries from before a change to the reduction don't match.
+		global cache_version
+		cache_version += 1
+		try:
+			assert cache.get(cache.make_key(source, var='air', runningAve=True)) is None
+		finally:
+			cache_version -= 1
+
+		# Changing the source file changes its signature, so the entry goes stale.
+		with open(source, 'a') as f:
+			f.write('!')
+		assert cache.get(cache.make_key(source, var='air', runningAve=True)) is None
+		cache.invalidate(source)
+		assert cache._entries() == []
+
+		# Bounded to one entry's worth, the least recently used one goes.
+		cache.put(cache.make_key(source, var='air'), series)
+		(mtime, size, oldest) = cache._entries()[0]
+		os.utime(oldest, (mtime - 10, mtime - 10))
+		cache.max_bytes = size
+		cache.put(cache.make_key(source, var='rhum'), series)
+		assert [path for (mtime, size, path) in cache._entries()] == \
+			[cache._path(cache.make_key(source, var='rhum'))]
+	finally:
+		shutil.rmtree(tmpdir)
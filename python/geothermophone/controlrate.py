@@ -0,0 +1,206 @@
+'''
+Rendering get_all_data's monthly series at a control rate, for stretching the
+~600 samples over a piece a few minutes long without zipper steps.
+
+A Renderer maps a series onto duration seconds at rate samples per second,
+with the first and last samples landing on the first and last output values,
+and interpolates in between:
+	linear       straight lines between samples
+	cubic        Catmull-Rom splines: smooth, through every sample
+	bandlimited  Lanczos-windowed sinc; when there are fewer outputs than
+	             samples the kernel is widened, so it low-passes instead of
+	             aliasing
+Cubic and band-limited output is clipped to each channel's own range, so the
+overshoot near steps never leaves the range the data was normalized onto.
+
+Nothing is rendered until asked for: render(start, stop) works out only that
+span, and blocks() walks the whole piece a block at a time, so a 100 Hz x 10
+minute x 32 channel render never has to be in memory at once. write() streams
+the blocks into an export.py file (or renders a MIDI file), and
+playback.Player plays a Renderer directly, rendering as it goes.
+'''
+import numpy
+import export
+import midi
+
+kinds = ('linear', 'cubic', 'bandlimited')
+default_rate = 100.0
+default_block_size = 4096
+lanczos_lobes = 3
+
+def _linear(values, positions):
+	last = values.shape[1] - 1
+	i = numpy.clip(numpy.floor(positions).astype(int), 0, max(last - 1, 0))
+	f = positions - i
+	return values[:, i] * (1 - f) + values[:, numpy.minimum(i + 1, last)] * f
+
+def _cubic(values, positions):
+	last = values.shape[1] - 1
+	i = numpy.clip(numpy.floor(positions).astype(int), 0, max(last - 1, 0))
+	f = positions - i
+	p0 = values[:, numpy.maximum(i - 1, 0)]
+	p1 = values[:, i]
+	p2 = values[:, numpy.minimum(i + 1, last)]
+	p3 = values[:, numpy.minimum(i + 2, last)]
+	return 0.5 * (2 * p1 + (p2 - p0) * f + (2 * p0 - 5 * p1 + 4 * p2 - p3) * f * f
+				  + (3 * p1 - p0 - 3 * p2 + p3) * f * f * f)
+
+def _bandlimited(values, positions, step):
+	# Widen the kernel by the step when downsampling, to cut off at the new
+	# Nyquist rate.
+	width = max(step, 1.0)
+	half = int(numpy.ceil(lanczos_lobes * width))
+	taps = numpy.floor(positions).astype(int)[:, numpy.newaxis] + numpy.arange(1 - half, half + 1)
+	distance = (positions[:, numpy.newaxis] - taps) / width
+	weights = numpy.sinc(distance) * numpy.sinc(distance / lanczos_lobes)
+	weights[numpy.abs(distance) >= lanczos_lobes] = 0.0
+	weights /= weights.sum(axis=1)[:, numpy.newaxis]
+	# Beyond the ends, repeat the end samples.
+	taps = numpy.clip(taps, 0, values.shape[1] - 1)
+	return numpy.einsum('cnt,nt->cn', values[:, taps], weights)
+
+class Renderer(object):
+	''' Renders data (a list, per region, of dicts from variable to values) at
+	rate values per second over duration seconds. '''
+	def __init__(self, data, duration, rate=default_rate, kind='cubic', ranges=None, times=None):
+		''' ranges, if given, maps variables to the (min, max) they were
+		normalized onto, which quantized output is clipped to. times, if given,
+		is the input's time axis, for render_times. '''
+		assert kind in kinds, 'Unknown interpolation %r (expected one of %s)' % (kind, kinds)
+		self.variables = sorted(data[0].keys()) if data else []
+		self.num_regions = len(data)
+		self.rate = float(rate)
+		self.duration = float(duration)
+		self.kind = kind
+		self.ranges = dict(ranges or {})
+		num_inputs = min(len(region[var]) for region in data for var in self.variables) if data else 0
+		assert num_inputs > 0, 'Nothing to render'
+		# One row per (variable, region) channel.
+		self.values = numpy.array([[region[var][:num_inputs] for region in data] for var in self.variables],
+								  dtype=float).reshape(-1, num_inputs)
+		self.lows = numpy.nanmin(self.values, axis=1)[:, numpy.newaxis]
+		self.highs = numpy.nanmax(self.values, axis=1)[:, numpy.newaxis]
+		self.times = None if times is None else numpy.asarray(times, dtype=float)[:num_inputs]
+		self.num_samples = max(int(round(self.duration * self.rate)), 1)
+		# Input samples per output value.
+		self.step = (num_inputs - 1) / float(self.num_samples - 1) if self.num_samples > 1 else 0.0
+
+	def __len__(self):
+		return self.num_samples
+
+	def positions(self, start, stop):
+		''' Where output values start..stop-1 fall, in input samples. '''
+		return numpy.arange(start, stop) * self.step
+
+	def _render(self, start, stop):
+		positions = self.positions(start, stop)
+		if self.kind == 'linear':
+			return _linear(self.values, positions)
+		if self.kind == 'cubic':
+			rendered = _cubic(self.values, positions)
+		else:
+			rendered = _bandlimited(self.values, positions, self.step)
+		return numpy.clip(rendered, self.lows, self.highs)
+
+	def render(self, start=0, stop=None, quantize=False):
+		''' Output values start..stop-1 as a dict from variable to a (region,
+		value) array. quantize rounds variables that have a range to ints
+		within it, as they were before rendering. '''
+		stop = self.num_samples if stop is None else min(stop, self.num_samples)
+		rendered = self._render(start, stop).reshape(len(self.variables), self.num_regions, stop - start)
+		result = {}
+		for i, var in enumerate(self.variables):
+			values = rendered[i]
+			if quantize and var in self.ranges:
+				values = numpy.clip(numpy.round(values), *self.ranges[var]).astype(numpy.int64)
+			result[var] = values
+		return result
+
+	def render_times(self, start=0, stop=None):
+		''' The input's time axis interpolated onto output values start..stop-1. '''
+		stop = self.num_samples if stop is None else min(stop, self.num_samples)
+		return numpy.interp(self.positions(start, stop), numpy.arange(len(self.times)), self.times)
+
+	def blocks(self, block_size=default_block_size, quantize=False):
+		''' Yield (start, render(start, start + block_size)) over the piece. '''
+		for start in range(0, self.num_samples, block_size):
+			yield (start, self.render(start, start + block_size, quantize))
+
+	def to_list(self, quantize=True):
+		''' The whole render in get_all_data's structure (this materializes it). '''
+		rendered = self.render(quantize=quantize)
+		return [dict((var, rendered[var][i].tolist()) for var in self.variables) for i in range(self.num_regions)]
+
+def write(filename, renderer, region_keys=None, block_size=default_block_size):
+	''' Write a render out: as MIDI CCs at the control rate for a .mid
+	filename (see midi.py; that encodes whole tracks, so it's rendered in one
+	go), otherwise in export.py's format, streamed a block at a time. '''
+	if filename.lower().endswith('.mid'):
+		midi.write(filename, renderer.to_list(), seconds_per_sample=1.0 / renderer.rate, ranges=renderer.ranges,
+				   region_names=None if region_keys is None else [str(key) for key in region_keys])
+		return
+	if region_keys is None:
+		region_keys = list(range(renderer.num_regions))
+	dtypes = dict((var, numpy.float64) for var in renderer.variables if var not in renderer.ranges)
+	written = export.create(filename, renderer.variables, region_keys, len(renderer), dtypes,
+							times=renderer.times is not None, ranges=renderer.ranges)
+	try:
+		for start, block in renderer.blocks(block_size, quantize=True):
+			for var in renderer.variables:
+				written.series(var)[:, start:start + block[var].shape[1]] = block[var]
+			if renderer.times is not None:
+				written.times[start:start + block_size] = renderer.render_times(start, start + block_size)
+	finally:
+		written.close()
+
+def test_interpolation():
+	data = [{'air': [0, 100, 0, 100, 0], 'wspd': [10, 10, 10, 10, 10]}]
+	for kind in kinds:
+		renderer = Renderer(data, duration=0.9, rate=10, kind=kind, ranges={'air': (0, 255)})
+		assert len(renderer) == 9 and renderer.step == 0.5
+		rendered = renderer.render()
+		# Every other output lands on an input sample.
+		assert numpy.allclose(rendered['air'][0, ::2], [0, 100, 0, 100, 0]), kind
+		assert numpy.allclose(rendered['wspd'], 10), kind
+		assert rendered['air'].min() >= 0 and rendered['air'].max() <= 100, 'Overshoot should be clipped'
+		# Rendering in blocks gives the same as in one go.
+		blocks = numpy.concatenate([block['air'] for start, block in renderer.blocks(block_size=4)], axis=1)
+		assert numpy.array_equal(blocks, rendered['air']), kind
+	assert Renderer(data, 0.9, 10, 'linear').render()['air'][0, 1] == 50
+	# Downsampling band-limited: a tone at the input's Nyquist rate averages out.
+	fast = [{'air': [0, 100] * 50}]
+	assert numpy.allclose(Renderer(fast, 1.0, 10, 'bandlimited').render()['air'][0, 2:-2], 50, atol=5)
+
+def test_write_streamed():
+	import os, shutil, tempfile
+	data = [{'air': list(range(0, 250, 10)), 'rhum': [0.5] * 25}, {'air': [255] * 25, 'rhum': [1.0] * 25}]
+	renderer = Renderer(data, duration=3.0, rate=100, kind='cubic', ranges={'air': (0, 255)},
+						times=numpy.arange(25) * 730.0)
+	tmpdir = tempfile.mkdtemp()
+	try:
+		filename = os.path.join(tmpdir, 'render.gtp')
+		write(filename, renderer, region_keys=[(0, 0), (0, 1)], block_size=64)
+		loaded = export.load(filename)
+		assert loaded.regions == [(0, 0), (0, 1)] and loaded.series('air').dtype == numpy.uint8
+		assert numpy.array_equal(loaded.series('air'), renderer.render(quantize=True)['air'])
+		assert loaded.series('air')[0, 0] == 0 and loaded.series('air')[0, -1] == 240
+		assert numpy.allclose(loaded.times[[0, -1]], [0, 24 * 730.0])
+		assert numpy.allclose(loaded.series('rhum'), [[0.5], [1.0]])
+		write(os.path.join(tmpdir, 'render.mid'), renderer)
+		tracks = midi.read_control_changes(os.path.join(tmpdir, 'render.mid'))
+		# 100 Hz at 960 ticks a second; the ramp is still changing near the end.
+		assert len(tracks) == 3 and 2800 < tracks[1][-1][0] <= int(round(299 / 100.0 * 960))
+	finally:
+		loaded = None
+		shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+	# python controlrate.py data.gtp out.gtp|out.mid seconds [rate [kind]]:
+	# render a file written by parser.py onto a piece seconds long.
+	import sys
+	exported = export.load(sys.argv[1])
+	renderer = Renderer(exported.to_list(), float(sys.argv[3]),
+						rate=float(sys.argv[4]) if len(sys.argv) > 4 else default_rate,
+						kind=sys.argv[5] if len(sys.argv) > 5 else 'cubic', ranges=exported.ranges,
+						times=exported.times)
+	write(sys.argv[2], renderer, region_keys=exported.regions)
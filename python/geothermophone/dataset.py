@@ -0,0 +1,204 @@
+'''
+Reading a variable that's split across many files, like the 4x daily 2-metre
+temperature, which comes as one file per year.
+
+A Dataset takes a directory or a glob of those files, orders them by their
+time axes (not their names) and treats them as one long record. Records are
+streamed to the region reducer in blocks of at most block_size records, each
+file memory-mapped only while it's being read, so fifty-odd years at 1460
+steps a year never need to be in memory at once.
+
+get_series and get_data run pipeline.py over a Dataset, like their parser.py
+namesakes, and return the same {octant key: list} dicts.
+'''
+import glob
+import os
+import resource
+import time
+from datetime import datetime
+from scipy.io import netcdf
+import numpy
+from packing import Packing
+import parser
+import timeaxis
+from reducer import RegionReducer
+
+default_block_size = 480
+
+def peak_memory_kb():
+	''' Peak resident set size of this process so far, in KB. '''
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	# Linux reports KB, OS X bytes.
+	return peak // 1024 if os.uname()[0] == 'Darwin' else peak
+
+class Dataset(object):
+	''' One variable spread over several files, in time order. '''
+	def __init__(self, var, path):
+		''' path is a directory (every .nc file in it) or a glob pattern. '''
+		self.var = var
+		if os.path.isdir(path):
+			filenames = glob.glob(os.path.join(path, '*.nc'))
+		else:
+			filenames = glob.glob(path)
+		assert filenames, 'No files found for %s' % path
+
+		files = []
+		for filename in filenames:
+			f = netcdf.netcdf_file(filename, 'r', mmap=True)
+			try:
+				# In the hours since 1-1-1 the rest of the code uses, whatever
+				# the file's own units.
+				hours = timeaxis.TimeAxis.from_variable(f.variables['time']).hours
+				shape = f.variables[var].shape
+				files.append((hours[0] if len(hours) else float('inf'), filename, hours, shape))
+				if not files[1:]:
+					self.lats, self.lons = parser._coordinates(f, f.variables[var])
+			finally:
+				f.close()
+		files.sort()
+
+		self.filenames = [filename for (first, filename, hours, shape) in files]
+		self.grid_shape = files[0][3][1:]
+		for (first, filename, hours, shape) in files:
+			assert shape[1:] == self.grid_shape, \
+				'%s has a %s grid but %s has %s' % (filename, shape[1:], self.filenames[0], self.grid_shape)
+		self.file_lengths = [len(hours) for (first, filename, hours, shape) in files]
+		# The whole time axis is small (8 bytes a record), so keep it.
+		self.hours = numpy.concatenate([hours for (first, filename, hours, shape) in files])
+		assert numpy.all(numpy.diff(self.hours) > 0), 'Time axes of the files overlap'
+
+	def __len__(self):
+		return len(self.hours)
+
+	def records_per_year(self):
+		''' Estimated from the typical spacing of the time axis. '''
+		return int(round(365.25 * 24 / numpy.median(numpy.diff(self.hours))))
+
+	def blocks(self, first=0, last=None, block_size=default_block_size):
+		''' Yield (record index, block, packing) for records first..last-1,
+		where each block is a raw (time, lon, lat) array of at most block_size
+		records from a single file, and packing its file's packing.Packing. '''
+		if last is None:
+			last = len(self)
+		file_start = 0
+		for filename, length in zip(self.filenames, self.file_lengths):
+			file_end = file_start + length
+			start = max(first, file_start)
+			stop = min(last, file_end)
+			if start < stop:
+				f = netcdf.netcdf_file(filename, 'r', mmap=True)
+				try:
+					data = f.variables[self.var]
+					packing = Packing.of(data)
+					for block_start in range(start, stop, block_size):
+						block_stop = min(block_start + block_size, stop)
+						yield (block_start, data.data[block_start - file_start:block_stop - file_start], packing)
+				finally:
+					data = None
+					f.close()
+			file_start = file_end
+
+def print_progress(done, total, stats):
+	print '%d/%d records, %.1fs, peak memory %.1f MB' % (done, total, stats['seconds'], stats['peak_memory_kb'] / 1024.0)
+
+def _progress_instruments(progress, total):
+	''' An instrument.Instruments calling progress(records done, total, stats)
+	after every block read. '''
+	import instrument
+	started = time.time()
+	done = [0]
+	def sink(event):
+		if event['stage'] == 'read' and event['event'] == 'chunk':
+			done[0] += event['records']
+			progress(done[0], total, {'records': done[0], 'total': total, 'seconds': time.time() - started,
+									  'peak_memory_kb': event['peak_rss_kb']})
+	return instrument.Instruments(sink)
+
+def _pipeline(var, path, runningAve, window, block_size, progress, normalization=None):
+	import pipeline
+	if window is None:
+		window = Dataset(var, path).records_per_year()
+	spec = {'variables': [{'name': var, 'path': path}], 'start': parser.starttime, 'end': parser.endtime,
+			'smoothing': 'boxcar' if runningAve else None, 'window': window, 'normalization': normalization,
+			'block_size': block_size}
+	series_pipeline = pipeline.Pipeline(spec)
+	if progress is not None:
+		read = series_pipeline.read(series_pipeline.variables[0])
+		series_pipeline.instruments = _progress_instruments(progress, read.last - read.first)
+	return series_pipeline
+
+def get_series(var, path, runningAve=True, window=None, block_size=default_block_size, progress=None):
+	''' Like parser.get_region_series, for a Dataset: a dict from octant key to
+	a list of mean values between parser.starttime and parser.endtime.
+	window defaults to a year's worth of records. progress, if given, is
+	called as progress(records done, total, stats) after every block read. '''
+	return _pipeline(var, path, runningAve, window, block_size, progress).series()[var]
+
+def get_data(var, path, runningAve=True, relative_normalization=True, window=None, progress=None):
+	''' Like parser.get_data, for a Dataset. '''
+	normalization = 'relative' if relative_normalization else 'absolute'
+	return _pipeline(var, path, runningAve, window, default_block_size, progress, normalization).series()[var]
+
+def test_dataset_streams_across_files():
+	import shutil, tempfile
+	values = parser._fixture_grid(24, num_lons=9, num_lats=16)
+	# 6-hourly records from 1959-12-30, split over three "yearly" files
+	# whose names sort in the wrong order.
+	start = parser.from_datetime(datetime(1959, 12, 30)) - parser.from_datetime(datetime(1800, 1, 1))
+	hours = start + 6 * numpy.arange(len(values))
+	tmpdir = tempfile.mkdtemp()
+	try:
+		for name, (a, b) in zip(('c', 'a', 'b'), ((0, 5), (5, 13), (13, 24))):
+			filename = os.path.join(tmpdir, 'air.%s.nc' % name)
+			parser._write_test_file(filename, 'air', values[a:b], hours[a:b])
+			f = netcdf.netcdf_file(filename, 'a')
+			f.variables['time'].units = 'hours since 1800-1-1 00:00:0.0'
+			f.close()
+		dataset = Dataset('air', tmpdir)
+		assert dataset.file_lengths == [5, 8, 11]
+		assert len(dataset) == 24 and dataset.records_per_year() == 1461
+		blocks = [(start, len(block)) for (start, block, packing) in dataset.blocks(2, 20, block_size=4)]
+		assert blocks == [(2, 3), (5, 4), (9, 4), (13, 4), (17, 3)], blocks
+		calls = []
+		series = get_series('air', os.path.join(tmpdir, '*.nc'), runningAve=False, block_size=4,
+							progress=lambda done, total, stats: calls.append((done, total)))
+	finally:
+		shutil.rmtree(tmpdir)
+	# 1960 starts at the 9th record; blocks don't cross files.
+	assert calls == [(4, 16), (5, 16), (9, 16), (13, 16), (16, 16)], calls
+	reducer = RegionReducer(*parser.LonLatSplitter(9, 16).label_grid())
+	expected_means = reducer.to_series(reducer.means(*reducer.reduce_block(values[8:])))
+	assert series == expected_means
+
+def _constant_field_series(weighting):
+	''' dataset.get_series and parser.get_region_series of a constant field
+	(with some cells missing) on a 73x144 grid with lat/lon coordinates. '''
+	import shutil, tempfile
+	import regrid
+	values = numpy.full((14, 73, 144), 5.0, dtype=numpy.float32)
+	values.reshape(14, -1)[:, ::7] = -9999.0
+	hours = parser._month_hours(datetime(1959, 12, 1), len(values))
+	tmpdir = tempfile.mkdtemp()
+	saved = parser.region_weighting
+	parser.region_weighting = weighting
+	try:
+		filename = os.path.join(tmpdir, 'air.nc')
+		parser._write_test_file(filename, 'air', values, hours, missing_value=-9999.0,
+								lats=regrid.regular_lats(73), lons=regrid.regular_lons(144))
+		return (get_series('air', filename, runningAve=False), parser.get_region_series('air', filename, runningAve=False))
+	finally:
+		parser.region_weighting = saved
+		shutil.rmtree(tmpdir)
+
+def test_get_series_with_coordinates():
+	# Weights of cells straddling the octant boundaries are fractional.
+	series, expected = _constant_field_series('degrees')
+	assert sorted(series) == sorted(expected)
+	for key in expected:
+		assert numpy.allclose(series[key], expected[key]) and numpy.allclose(series[key], 5.0), key
+
+def test_get_series_area_weighted():
+	# cos(lat) weights are fractional everywhere.
+	series, expected = _constant_field_series('area')
+	for key in expected:
+		assert numpy.allclose(series[key], expected[key]) and numpy.allclose(series[key], 5.0), key
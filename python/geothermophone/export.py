@@ -0,0 +1,198 @@
+'''
+Compact binary file format for sonification data, replacing the printed
+Python repr of get_all_data's output.
+
+Layout:
+	8 bytes   magic, 'GTPHONE' plus a format version byte
+	4 bytes   little-endian uint32, length of the JSON header
+	header    JSON: variables, region keys, normalization ranges, and where
+	          each data block lives (offset, dtype, shape)
+	blocks    raw little-endian arrays, each aligned to block_alignment:
+	          one (region, time) array per variable, in the smallest type that
+	          holds its values, plus an optional float64 time axis
+
+load() memory-maps the blocks, so opening even a large file costs next to
+nothing and only the parts actually used get read. Empty blocks (an output
+with no records) can't be mapped, so they're plain empty arrays. The time
+axis's block is called time, so no variable can be.
+'''
+import json
+import struct
+import numpy
+import normalize
+
+magic = b'GTPHONE\x01'
+block_alignment = 64
+# Block names that aren't variables.
+reserved_names = ('time',)
+
+def _block_dtype(values, value_range):
+	if value_range is not None:
+		return numpy.dtype(normalize.output_dtype(*value_range)).newbyteorder('<')
+	if values.dtype.kind in 'iub' and values.size and values.min() >= 0:
+		return numpy.dtype(normalize.output_dtype(0, int(values.max()))).newbyteorder('<')
+	return numpy.dtype('<f8')
+
+def _align(offset):
+	return (offset + block_alignment - 1) // block_alignment * block_alignment
+
+def _header(variables, region_keys, ranges, specs):
+	''' Encode the header for blocks given as (name, dtype, shape), returning
+	(encoded header, {name: block info}). '''
+	# Work out offsets for a header of the final size (the offsets themselves
+	# go in the header, so iterate until its length settles).
+	header_length = -1
+	while True:
+		offset = _align(len(magic) + 4 + header_length)
+		blocks = {}
+		for name, dtype, shape in specs:
+			blocks[name] = {'offset': offset, 'dtype': dtype.str, 'shape': list(shape)}
+			offset = _align(offset + dtype.itemsize * int(numpy.prod(shape)))
+		header = {'variables': variables,
+				  'regions': [list(key) if isinstance(key, tuple) else key for key in region_keys],
+				  'ranges': dict((var, list(r)) for var, r in ranges.items()),
+				  'blocks': blocks}
+		encoded = json.dumps(header, sort_keys=True).encode('utf-8')
+		if len(encoded) == header_length:
+			return (encoded, blocks, offset)
+		header_length = len(encoded)
+
+def create(filename, variables, region_keys, num_samples, dtypes=None, times=False, ranges=None):
+	''' Lay out a file for len(region_keys) x num_samples values of each
+	variable and return it opened for writing, as a SonificationData whose
+	series (and times, if times is set) are filled in place. That way a long
+	render can be written a block at a time rather than built up in memory.
+	dtypes maps variables to their block dtypes; by default a variable with a
+	range gets the smallest type that holds it, the rest float64. '''
+	reserved = [var for var in variables if var in reserved_names]
+	assert not reserved, 'Variables can\'t be called %s' % ', '.join(reserved)
+	ranges = dict(ranges or {})
+	dtypes = dict(dtypes or {})
+	specs = []
+	for var in variables:
+		if var in dtypes:
+			dtype = numpy.dtype(dtypes[var]).newbyteorder('<')
+		else:
+			dtype = _block_dtype(numpy.zeros(0), ranges.get(var))
+		specs.append((var, dtype, (len(region_keys), num_samples)))
+	if times:
+		specs.append(('time', numpy.dtype('<f8'), (num_samples,)))
+	encoded, blocks, end = _header(list(variables), region_keys, ranges, specs)
+	with open(filename, 'wb') as f:
+		f.write(magic)
+		f.write(struct.pack('<I', len(encoded)))
+		f.write(encoded)
+		f.truncate(end)
+	return SonificationData(filename, mode='r+')
+
+def write(filename, data, region_keys=None, times=None, ranges=None):
+	''' Write the structure get_all_data returns (a list, per region, of dicts
+	from variable to a list of values) to filename.
+	region_keys -- one JSON-able key per region, e.g. the octant tuples;
+	               defaults to the region indices
+	times       -- optional time axis, in the files' hours since 1-1-1
+	ranges      -- optional dict from variable to the (min, max) it was
+	               normalized onto, e.g. {'air': (0, 255)} '''
+	variables = sorted(data[0].keys()) if data else []
+	if region_keys is None:
+		region_keys = list(range(len(data)))
+	assert len(region_keys) == len(data), 'Need one key per region'
+	ranges = dict(ranges or {})
+
+	arrays = dict((var, numpy.array([region[var] for region in data])) for var in variables)
+	dtypes = dict((var, _block_dtype(values, ranges.get(var))) for var, values in arrays.items())
+	num_samples = arrays[variables[0]].shape[1] if variables else (len(times) if times is not None else 0)
+	written = create(filename, variables, region_keys, num_samples, dtypes, times is not None, ranges)
+	for var in variables:
+		written.series(var)[:] = arrays[var]
+	if times is not None:
+		written.times[:] = times
+	written.close()
+
+class SonificationData(object):
+	''' A file written by write(), with each block memory-mapped. '''
+	def __init__(self, filename, mode='r'):
+		with open(filename, 'rb') as f:
+			assert f.read(len(magic)) == magic, '%s is not a geothermophone data file' % filename
+			(header_length,) = struct.unpack('<I', f.read(4))
+			header = json.loads(f.read(header_length).decode('utf-8'))
+		self.filename = filename
+		self.variables = header['variables']
+		self.regions = [tuple(key) if isinstance(key, list) else key for key in header['regions']]
+		self.ranges = dict((var, tuple(r)) for var, r in header['ranges'].items())
+		self.blocks = {}
+		for name, block in header['blocks'].items():
+			dtype, shape = numpy.dtype(str(block['dtype'])), tuple(block['shape'])
+			if numpy.prod(shape) == 0:
+				self.blocks[name] = numpy.zeros(shape, dtype)
+			else:
+				self.blocks[name] = numpy.memmap(filename, dtype=dtype, mode=mode, offset=block['offset'], shape=shape)
+
+	def close(self):
+		''' Flush anything written and let go of the maps. '''
+		for block in self.blocks.values():
+			if isinstance(block, numpy.memmap) and block.mode != 'r':
+				block.flush()
+		self.blocks = {}
+
+	@property
+	def times(self):
+		''' The time axis (hours since 1-1-1), or None if none was written. '''
+		return self.blocks.get('time')
+
+	def series(self, var):
+		''' (region, time) array of var's values. No copy is made. '''
+		return self.blocks[var]
+
+	def to_list(self):
+		''' Back to get_all_data's structure (this one does copy). '''
+		return [dict((var, self.blocks[var][i].tolist()) for var in self.variables)
+				for i in range(len(self.regions))]
+
+def load(filename):
+	return SonificationData(filename)
+
+def test_write_load_round_trip():
+	import os, shutil, tempfile
+	data = [{'air': [0, 255, 12], 'wspd': [65535, 0, 1], 'rhum': [0.5, 1.5, 2.5]},
+			{'air': [1, 2, 3], 'wspd': [4, 5, 6], 'rhum': [-1.0, 0.0, 1.0]}]
+	tmpdir = tempfile.mkdtemp()
+	try:
+		filename = os.path.join(tmpdir, 'out.gtp')
+		write(filename, data, region_keys=[(0, 0), (0, 1)], times=[10.0, 20.0, 30.0],
+			  ranges={'air': (0, 255), 'wspd': (0, 65535)})
+		loaded = load(filename)
+		assert loaded.variables == ['air', 'rhum', 'wspd']
+		assert loaded.regions == [(0, 0), (0, 1)]
+		assert loaded.ranges == {'air': (0, 255), 'wspd': (0, 65535)}
+		assert loaded.series('air').dtype == numpy.uint8 and loaded.series('wspd').dtype == numpy.uint16
+		assert isinstance(loaded.series('air'), numpy.memmap)
+		assert loaded.times.tolist() == [10.0, 20.0, 30.0]
+		assert loaded.to_list() == data
+		assert all(block.offset % block_alignment == 0 for block in loaded.blocks.values())
+	finally:
+		shutil.rmtree(tmpdir)
+
+def test_write_load_empty():
+	import os, shutil, tempfile
+	tmpdir = tempfile.mkdtemp()
+	try:
+		filename = os.path.join(tmpdir, 'out.gtp')
+		write(filename, [{'air': []}, {'air': []}], times=[], ranges={'air': (0, 255)})
+		loaded = load(filename)
+		assert loaded.series('air').shape == (2, 0) and loaded.series('air').dtype == numpy.uint8
+		assert loaded.times.shape == (0,) and loaded.to_list() == [{'air': []}, {'air': []}]
+		loaded.close()
+	finally:
+		shutil.rmtree(tmpdir)
+
+def test_reserved_names():
+	import os, shutil, tempfile
+	tmpdir = tempfile.mkdtemp()
+	try:
+		write(os.path.join(tmpdir, 'out.gtp'), [{'time': [1, 2]}])
+		assert False, 'Expected time to be refused as a variable'
+	except AssertionError as error:
+		assert 'time' in str(error) and 'Expected' not in str(error)
+	finally:
+		shutil.rmtree(tmpdir)
@@ -0,0 +1,272 @@
+'''
+Incremental updates: extending a pipeline.py spec's output as NCEP publishes
+new records, without reprocessing the history.
+
+An Updater keeps, in a state directory, for each variable of the spec:
+	- the time of the last record it has read
+	- what Smooth carries between chunks (the last window records' region
+	  values, or the exponential filter's state)
+	- the smoothed series so far, its times and its normalized values (all
+	  records x regions, so small next to the grids)
+	- each channel's running min and max (or, for the percentile and
+	  equalized normalizations, its quantile sketches, which merge)
+update() reads only the records after the last one read, reduces and smooths
+them, and appends them. The history is only normalized again when the new
+records change what a channel is scaled by (its min..max, or percentiles);
+otherwise just the new records are normalized, against the stored range. Then the spec's outputs are rewritten
+from the stored values. So a refresh costs what the new records do (plus
+writing out the reduced data), not another pass over sixty years of grids.
+
+The output runs from the spec's start up to the last record of each file; the
+spec's end is ignored. State from a different spec (variables, files,
+regions, smoothing, normalization...) is thrown away, starting over; so is a
+variable's if its files no longer hold the last record read (they were cut
+short or replaced).
+'''
+import hashlib
+import json
+import os
+import tempfile
+import numpy
+import export
+import midi
+import pipeline
+
+state_version = 1
+
+def _fingerprint(updater_pipeline):
+	''' Identifies everything that goes into the stored state. '''
+	description = [state_version, pipeline._isoformat(updater_pipeline.start), updater_pipeline.layout(),
+				   updater_pipeline.spec['block_size']]
+	for variable in updater_pipeline.variables:
+		description.append([variable[name] for name in ('name', 'statistics', 'smoothing', 'window', 'normalization')]
+						   + [list(variable['range'] or ()), list(variable['percentiles']),
+							  os.path.abspath(variable['path'])])
+	return hashlib.sha1(json.dumps(description, sort_keys=True).encode('utf-8')).hexdigest()
+
+class Updater(object):
+	''' Incremental runs of a pipeline.Pipeline, with state in directory. '''
+	def __init__(self, updater_pipeline, directory):
+		self.pipeline = updater_pipeline
+		self.directory = directory
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+		self.fingerprint = _fingerprint(updater_pipeline)
+		self.state = {'fingerprint': self.fingerprint, 'variables': {}}
+		try:
+			with open(self._path('state.json')) as f:
+				state = json.load(f)
+		except (IOError, OSError, ValueError):
+			state = None
+		if state is not None and state.get('fingerprint') == self.fingerprint:
+			self.state = state
+
+	def _path(self, name):
+		return os.path.join(self.directory, name)
+
+	def _save_arrays(self, name, arrays):
+		fd, tmp_path = tempfile.mkstemp(suffix='.npz', dir=self.directory)
+		try:
+			with os.fdopen(fd, 'wb') as f:
+				numpy.savez(f, **arrays)
+			os.rename(tmp_path, self._path(name + '.npz'))
+		except:
+			os.remove(tmp_path)
+			raise
+
+	def _load_arrays(self, name):
+		with numpy.load(self._path(name + '.npz')) as arrays:
+			return dict((key, arrays[key]) for key in arrays.files)
+
+	def _read(self, variable, variable_state):
+		''' The Read stage for the records not read yet, or None if the last
+		record read isn't there any more. '''
+		lead_in = variable['window'] if variable['smoothing'] else 0
+		read = pipeline.Read(variable['name'], variable['path'], self.pipeline.start, None, lead_in,
+							 self.pipeline.spec['block_size'])
+		if variable_state is not None:
+			hours = read.dataset.hours
+			done = int(numpy.searchsorted(hours, variable_state['last'], side='right'))
+			if done == 0 or done > read.last or hours[done - 1] != variable_state['last']:
+				return None
+			read.first = max(read.first, done)
+		return read
+
+	def _update_variable(self, variable):
+		''' Read, reduce and smooth the new records of one variable, append
+		them, and normalize. Returns (new records, renormalized channels). '''
+		name = variable['name']
+		channels = self.pipeline.channels(variable)
+		num_regions = len(self.pipeline.keys())
+		variable_state = self.state['variables'].get(name)
+		arrays = self._load_arrays(name) if variable_state is not None else {}
+		read = self._read(variable, variable_state)
+		if read is None:
+			# The files were cut short or replaced: start over.
+			variable_state, arrays = None, {}
+			read = self._read(variable, None)
+		if not len(read):
+			return (0, [])
+
+		chunks = pipeline.Reduce(name, self.pipeline._reducer(read), variable['statistics']).stream(read.stream())
+		smooth = None
+		if variable['smoothing']:
+			tails = {}
+			for channel in channels:
+				if 'tail:' + channel in arrays:
+					tails[channel] = arrays['tail:' + channel]
+				elif 'state:' + channel in arrays:
+					tails[channel] = (arrays['state:' + channel], arrays['last:' + channel])
+			smooth = pipeline.Smooth(variable['window'], variable['smoothing'], self.pipeline.spec['block_size'],
+									 tails, variable_state['seen'] if variable_state else 0)
+			chunks = smooth.stream(chunks)
+		new = dict((channel, []) for channel in channels)
+		new_records = []
+		for start, chunk in chunks:
+			for channel in channels:
+				new[channel].append(chunk[channel])
+			new_records.append(numpy.arange(start, start + len(chunk[channels[0]])))
+		new_times = read.dataset.hours[numpy.concatenate(new_records).astype(int)] if new_records else numpy.zeros(0)
+
+		normalization = None
+		if variable['normalization']:
+			new_min, new_max = variable['range'] or (None, None)
+			normalization = pipeline.Normalize(variable['normalization'], new_min, new_max, variable['percentiles'])
+		renormalized = []
+		for channel in channels:
+			values = numpy.concatenate(new[channel]) if new[channel] else numpy.zeros((0, num_regions))
+			series = numpy.concatenate((arrays.get('series:' + channel, numpy.zeros((0, num_regions))), values))
+			arrays['series:' + channel] = series
+			if normalization is not None and len(values):
+				summary_keys = sorted(key for key in arrays if key.startswith('summary:%s:' % channel))
+				summary = old_bounds = None
+				if summary_keys:
+					summary = normalization.summary_from_arrays([arrays[key] for key in summary_keys])
+					old_bounds = normalization.bounds(summary)
+				summary = normalization.summarize(values, summary)
+				bounds = normalization.bounds(summary)
+				if old_bounds is not None and all(numpy.array_equal(old, new_bound)
+												  for old, new_bound in zip(old_bounds, bounds)):
+					normalized = numpy.concatenate((arrays['normalized:' + channel], normalization.scale(values, summary)))
+				else:
+					normalized = normalization.scale(series, summary)
+					renormalized.append(channel)
+				for i, summary_array in enumerate(normalization.summary_arrays(summary)):
+					arrays['summary:%s:%d' % (channel, i)] = summary_array
+				arrays['normalized:' + channel] = normalized
+			if smooth is not None and channel in smooth.tails:
+				tail = smooth.tails[channel]
+				if isinstance(tail, tuple):
+					arrays['state:' + channel], arrays['last:' + channel] = tail
+				else:
+					arrays['tail:' + channel] = tail
+		arrays['times'] = numpy.concatenate((arrays.get('times', numpy.zeros(0)), new_times))
+
+		self._save_arrays(name, arrays)
+		self.state['variables'][name] = {'last': float(read.dataset.hours[read.last - 1]),
+										 'seen': smooth.seen if smooth is not None else 0}
+		return (read.last - read.first, renormalized)
+
+	def update(self):
+		''' Bring every variable up to date and rewrite the outputs. Returns a
+		dict from variable to (records read, channels normalized again). '''
+		updated = {}
+		for variable in self.pipeline.variables:
+			updated[variable['name']] = self._update_variable(variable)
+		with open(self._path('state.json.tmp'), 'w') as f:
+			json.dump(self.state, f)
+		os.rename(self._path('state.json.tmp'), self._path('state.json'))
+		self.write_outputs()
+		return updated
+
+	def arrays(self, variable):
+		''' The stored arrays of a variable (see the module docstring). '''
+		return self._load_arrays(variable['name'])
+
+	def data(self):
+		''' (times, data): the stored output in get_all_data's structure,
+		normalized where the spec normalizes, cut to the records every
+		variable has. '''
+		stored = [(variable, self.arrays(variable)) for variable in self.pipeline.variables
+				  if variable['name'] in self.state['variables']]
+		if not stored:
+			return (numpy.zeros(0), [])
+		length = min(len(arrays['times']) for variable, arrays in stored)
+		channels = {}
+		for variable, arrays in stored:
+			kind = 'normalized:' if variable['normalization'] else 'series:'
+			for channel in self.pipeline.channels(variable):
+				channels[channel] = arrays[kind + channel][:length]
+		data = [dict((channel, values[:, i].tolist()) for channel, values in channels.items())
+				for i in range(len(self.pipeline.keys()))]
+		return (stored[0][1]['times'][:length], data)
+
+	def write_outputs(self):
+		times, data = self.data()
+		region_keys = self.pipeline.keys()
+		for output in self.pipeline.outputs:
+			if output.lower().endswith('.mid'):
+				midi.write(output, data, ranges=self.pipeline.ranges(), region_names=[str(key) for key in region_keys])
+			else:
+				export.write(output, data, region_keys=region_keys, times=times, ranges=self.pipeline.ranges())
+
+def test_incremental_update():
+	import shutil
+	from datetime import datetime
+	import parser
+	values = parser._fixture_grid(40, num_lons=9, num_lats=16)
+	hours = parser._month_hours(datetime(1959, 1, 1), len(values))
+	tmpdir = tempfile.mkdtemp()
+	try:
+		filename = os.path.join(tmpdir, 'air.nc')
+		spec = {'variables': [{'name': 'air', 'path': filename}], 'statistics': ['max'], 'block_size': 7,
+				'outputs': [os.path.join(tmpdir, 'out.gtp')]}
+		# A year's lead-in, then 1960 to mid-1961...
+		parser._write_test_file(filename, 'air', values[:30], hours[:30])
+		updater = Updater(pipeline.Pipeline(spec), os.path.join(tmpdir, 'state'))
+		assert updater.update() == {'air': (30, ['air', 'air_max'])}
+		assert Updater(pipeline.Pipeline(spec), os.path.join(tmpdir, 'state')).update() == {'air': (0, [])}
+		# ...then the same file with ten more months in it, the last of which
+		# are hotter than ever.
+		values[35:] += 100
+		parser._write_test_file(filename, 'air', values, hours)
+		updater = Updater(pipeline.Pipeline(spec), os.path.join(tmpdir, 'state'))
+		assert updater.update() == {'air': (10, ['air', 'air_max'])}
+		incremental = updater.arrays(pipeline.Pipeline(spec).variables[0])
+		written = export.load(os.path.join(tmpdir, 'out.gtp')).to_list()
+
+		full = pipeline.Pipeline(dict(spec, end=datetime(2000, 1, 1), outputs=[]))
+		expected = full.series(normalized=False)
+		expected_normalized = full.data()
+		# Records repeating ones already seen don't extend the range, so only
+		# they get normalized.
+		values[36:] = values[20:24]
+		unsmoothed = dict(spec, smoothing=None)
+		parser._write_test_file(filename, 'air', values[:36], hours[:36])
+		shutil.rmtree(os.path.join(tmpdir, 'state'))
+		updater = Updater(pipeline.Pipeline(unsmoothed), os.path.join(tmpdir, 'state'))
+		updater.update()
+		parser._write_test_file(filename, 'air', values, hours)
+		assert updater.update() == {'air': (4, [])}
+		appended = export.load(os.path.join(tmpdir, 'out.gtp')).to_list()
+		assert appended == pipeline.Pipeline(dict(unsmoothed, end=datetime(2000, 1, 1), outputs=[])).data()
+		# A file with fewer records than were read is rebuilt from scratch.
+		parser._write_test_file(filename, 'air', values[:32], hours[:32])
+		assert updater.update() == {'air': (20, ['air', 'air_max'])}
+		shrunk = export.load(os.path.join(tmpdir, 'out.gtp')).to_list()
+		assert shrunk == pipeline.Pipeline(dict(unsmoothed, end=datetime(2000, 1, 1), outputs=[])).data()
+	finally:
+		shutil.rmtree(tmpdir)
+	for channel in ('air', 'air_max'):
+		keys = full.keys()
+		assert numpy.allclose(incremental['series:' + channel], [[expected[channel][key][t] for key in keys]
+																  for t in range(28)], rtol=1e-12)
+	assert written == expected_normalized
+	assert numpy.allclose(incremental['times'], hours[12:])
+
+if __name__ == '__main__':
+	# python incremental.py spec.json state_dir: bring a spec's outputs up to
+	# date (e.g. from a daily cron job).
+	import sys
+	for var, (records, renormalized) in sorted(Updater(pipeline.load(sys.argv[1]), sys.argv[2]).update().items()):
+		print '%s: %d new records%s' % (var, records, ', normalized again: ' + ', '.join(renormalized) if renormalized else '')
@@ -0,0 +1,264 @@
+'''
+Opt-in instrumentation of pipeline.py's stages, for seeing where a slow
+rebuild spends its time.
+
+Pass an Instruments to a Pipeline (or to parser.get_data, get_all_data or
+get_all_region_series) and every chunk through every stage is recorded as an
+event, a dict of:
+	event        'chunk', or 'end' when the stage's stream runs out
+	variable     the variable the stage is working on
+	stage        read, reduce, cache (cached series), smooth, normalize,
+	             emit; and pool for the up-front parallel reduction (with
+	             workers > 1; its own events come from the worker processes,
+	             which aren't instrumented)
+	start        the chunk's first record (None at the end)
+	records      how many records the chunk holds
+	seconds      wall time spent in the stage itself, not waiting on the
+	             stages before it
+	cells        values in the chunk: grid cells coming out of read, region
+	             values after reduce
+	bytes        their size in memory (for read, what was read from disk)
+	missing      how many of them are missing
+	peak_rss_kb  the process's peak RSS so far
+Events are kept in events, and passed to sink (a callable, e.g. json_lines)
+as they happen; summary() totals them per stage as a table. Counting
+what's missing in a raw block touches every page of it, so that's done
+inside the read stage's time: that is what reads the block from disk.
+
+Without Instruments nothing is wrapped, so there's no overhead at all.
+
+With profile set to a stage's name, a Sampler samples the Python stack
+(every interval seconds of CPU time, by SIGPROF) while that stage, and not the
+ones before it, is running; profile_table() lists where the samples landed.
+Sampling is Unix only, and from the main thread.
+'''
+import collections
+import json
+import signal
+import time
+import numpy
+from dataset import peak_memory_kb
+
+default_interval = 0.001
+
+def measure_block(chunk):
+	''' Counts for a Read chunk of (start, raw block, packing). '''
+	start, block, packing = chunk
+	valid = packing.valid(block)
+	missing = 0 if valid is None else int(valid.size - numpy.count_nonzero(valid))
+	return {'start': start, 'records': len(block), 'cells': int(block.size), 'bytes': int(block.nbytes),
+			'missing': missing}
+
+def measure_channels(chunk):
+	''' Counts for a chunk of (start, {channel: (time, region) array}). '''
+	start, channels = chunk
+	values = list(channels.values())
+	return {'start': start, 'records': len(values[0]) if values else 0,
+			'cells': sum(int(array.size) for array in values), 'bytes': sum(int(array.nbytes) for array in values),
+			'missing': sum(int(numpy.isnan(array).sum()) for array in values)}
+
+def json_lines(f):
+	''' A sink writing each event to the open file f as a line of JSON. '''
+	def sink(event):
+		f.write(json.dumps(event, sort_keys=True) + '\n')
+	return sink
+
+class Sampler(object):
+	''' A sampling profiler: counts the Python stacks that SIGPROF lands in,
+	every interval seconds of CPU time, whenever accept() says to. '''
+	def __init__(self, interval=default_interval, accept=None):
+		self.interval = interval
+		self.accept = accept
+		self.counts = collections.Counter()
+		self._previous = None
+
+	def _sample(self, signum, frame):
+		if self.accept is not None and not self.accept():
+			return
+		stack = []
+		while frame is not None:
+			stack.append((frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name))
+			frame = frame.f_back
+		self.counts[tuple(reversed(stack))] += 1
+
+	def start(self):
+		self._previous = signal.signal(signal.SIGPROF, self._sample)
+		signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+	def stop(self):
+		signal.setitimer(signal.ITIMER_PROF, 0)
+		signal.signal(signal.SIGPROF, self._previous or signal.SIG_DFL)
+
+	def table(self, limit=20):
+		''' Lines listing the lines that samples landed in, then the functions
+		they landed under, most sampled first. '''
+		total = float(sum(self.counts.values()))
+		own = collections.Counter()
+		under = collections.Counter()
+		for stack, count in self.counts.items():
+			filename, line, name = stack[-1]
+			own['%s:%d %s' % (filename, line, name)] += count
+			for function in set('%s %s' % (filename, name) for (filename, line, name) in stack):
+				under[function] += count
+		lines = ['%d samples' % total]
+		for title, counter in (('own', own), ('total', under)):
+			lines.append('%6s  %s' % (title, 'where'))
+			for where, count in counter.most_common(limit):
+				lines.append('%5.1f%%  %s' % (100 * count / total, where))
+		return lines
+
+class Instruments(object):
+	''' Records events (see the module docstring) for the stages passed
+	through stage(). '''
+	def __init__(self, sink=None, profile=None, interval=default_interval):
+		self.sink = sink
+		self.events = []
+		self.profile = profile
+		self.sampler = Sampler(interval, self._profiling) if profile else None
+		# [stage, seconds spent in the stages before it] for each stage
+		# that's running, innermost last.
+		self._running = []
+
+	def _profiling(self):
+		return bool(self._running) and self._running[-1][0] == self.profile
+
+	def record(self, event):
+		self.events.append(event)
+		if self.sink is not None:
+			self.sink(event)
+
+	def _timed(self, stage, function):
+		''' (function(), seconds spent in it less in other stages). '''
+		self._running.append([stage, 0.0])
+		started = time.time()
+		try:
+			result = function()
+		finally:
+			elapsed = time.time() - started
+			waited = self._running.pop()[1]
+			if self._running:
+				self._running[-1][1] += elapsed
+		return (result, elapsed - waited)
+
+	def stage(self, stage, variable, chunks, measure=measure_channels, measure_inside=False):
+		''' Pass chunks through, recording an event for each. measure gives
+		a chunk's counts; with measure_inside, the time it takes counts as
+		the stage's (as for read, see the module docstring). '''
+		iterator = iter(chunks)
+		end = object()
+		def step():
+			chunk = next(iterator, end)
+			return (chunk, measure(chunk) if measure_inside and chunk is not end else None)
+		if stage == self.profile:
+			self.sampler.start()
+		try:
+			while True:
+				(chunk, counts), seconds = self._timed(stage, step)
+				if chunk is end:
+					self.record({'event': 'end', 'variable': variable, 'stage': stage, 'start': None, 'records': 0,
+								 'seconds': seconds, 'cells': 0, 'bytes': 0, 'missing': 0,
+								 'peak_rss_kb': peak_memory_kb()})
+					return
+				event = {'event': 'chunk', 'variable': variable, 'stage': stage, 'seconds': seconds,
+						 'peak_rss_kb': peak_memory_kb()}
+				event.update(counts or measure(chunk))
+				self.record(event)
+				yield chunk
+				# Let go of the chunk (a Read block points into an mmap) before
+				# the next one, which may close its file.
+				chunk = counts = None
+		finally:
+			if stage == self.profile:
+				self.sampler.stop()
+
+	def call(self, stage, variable, function, *args):
+		''' function(*args), recorded as a single event. '''
+		if stage == self.profile:
+			self.sampler.start()
+		try:
+			result, seconds = self._timed(stage, lambda: function(*args))
+		finally:
+			if stage == self.profile:
+				self.sampler.stop()
+		self.record({'event': 'end', 'variable': variable, 'stage': stage, 'start': None, 'records': 0,
+					 'seconds': seconds, 'cells': 0, 'bytes': 0, 'missing': 0, 'peak_rss_kb': peak_memory_kb()})
+		return result
+
+	def totals(self):
+		''' Per (variable, stage), in the order they first ran: a dict of
+		chunks and the sums of the events' counts, and the highest peak RSS. '''
+		totals = collections.OrderedDict()
+		for event in self.events:
+			total = totals.setdefault((event['variable'], event['stage']), {'chunks': 0, 'records': 0, 'seconds': 0.0,
+																			 'cells': 0, 'bytes': 0, 'missing': 0,
+																			 'peak_rss_kb': 0})
+			total['chunks'] += event['event'] == 'chunk'
+			for name in ('records', 'seconds', 'cells', 'bytes', 'missing'):
+				total[name] += event[name]
+			total['peak_rss_kb'] = max(total['peak_rss_kb'], event['peak_rss_kb'])
+		return totals
+
+	def summary(self):
+		''' The totals as table lines. '''
+		lines = ['%-10s %-10s %6s %8s %9s %14s %10s %10s %9s' % ('variable', 'stage', 'chunks', 'records', 'seconds',
+																 'cells/s', 'MB', 'missing', 'peak MB')]
+		for (variable, stage), total in self.totals().items():
+			rate = '%.0f' % (total['cells'] / total['seconds']) if total['seconds'] > 0 and total['cells'] else '-'
+			lines.append('%-10s %-10s %6d %8d %9.3f %14s %10.1f %10d %9.1f' % (
+				variable or '-', stage, total['chunks'], total['records'], total['seconds'], rate,
+				total['bytes'] / 1048576.0, total['missing'], total['peak_rss_kb'] / 1024.0))
+		return lines
+
+	def profile_table(self, limit=20):
+		return self.sampler.table(limit) if self.sampler is not None else []
+
+def test_instruments():
+	import os, shutil, tempfile, warnings
+	from datetime import datetime
+	import parser
+	import pipeline
+	values = parser._fixture_grid(40, num_lons=9, num_lats=16, missing_value=-9999.0)
+	hours = parser._month_hours(datetime(1959, 1, 1), len(values))
+	tmpdir = tempfile.mkdtemp()
+	try:
+		filename = os.path.join(tmpdir, 'air.nc')
+		parser._write_test_file(filename, 'air', values, hours, missing_value=-9999.0)
+		lines = []
+		instruments = Instruments(sink=lambda event: lines.append(json.dumps(event)), profile='reduce')
+		# Holding on to a raw block would keep its file's mmap open.
+		with warnings.catch_warnings(record=True) as caught:
+			warnings.simplefilter('always')
+			series = parser.get_data('air', filename, instruments=instruments)
+		assert not [warning for warning in caught if 'mmap' in str(warning.message)], caught[0].message
+		assert series == parser.get_data('air', filename)
+	finally:
+		shutil.rmtree(tmpdir)
+	totals = instruments.totals()
+	assert list(totals) == [('air', stage) for stage in ('read', 'reduce', 'smooth', 'normalize')]
+	assert len(lines) == len(instruments.events) and json.loads(lines[0])['stage'] == 'read'
+	# A year's lead-in, then 1960 to 1961.
+	read = totals[('air', 'read')]
+	assert read['records'] == 40 and read['cells'] == 40 * 16 * 9 and read['bytes'] == read['cells'] * 4
+	assert read['missing'] == numpy.count_nonzero(values == -9999.0) > 0
+	assert totals[('air', 'normalize')]['records'] == 28 and totals[('air', 'normalize')]['cells'] == 28 * 8
+	assert all(event['seconds'] >= 0 for event in instruments.events)
+	assert len(instruments.summary()) == 5 and instruments.profile_table()[0].endswith('samples')
+
+if __name__ == '__main__':
+	# python instrument.py spec.json [stage [events.jsonl]]: run a pipeline.py
+	# spec, printing how long each stage took (and with a stage, where its
+	# time went), and writing the events to events.jsonl if given.
+	import sys
+	import pipeline
+	events_file = open(sys.argv[3], 'w') if len(sys.argv) > 3 else None
+	instruments = Instruments(json_lines(events_file) if events_file else None,
+							  profile=sys.argv[2] if len(sys.argv) > 2 else None)
+	instrumented = pipeline.load(sys.argv[1])
+	instrumented.instruments = instruments
+	try:
+		instrumented.run()
+	finally:
+		if events_file:
+			events_file.close()
+	print '\n'.join(instruments.summary())
+	print '\n'.join(instruments.profile_table())
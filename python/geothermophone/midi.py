@@ -0,0 +1,236 @@
+'''
+Writes get_all_data's output straight to a Standard MIDI File of control
+changes, so the control data can be dropped into Live as clips instead of being
+recorded in real time through MyPipe (AudioToDo steps 4 and 5).
+
+The file is format 1: a tempo track, then one track per region, each on its
+own MIDI channel, with one CC lane per variable. Samples are spaced
+seconds_per_sample apart.
+
+Values are sent at the resolution of the range they were normalized onto:
+	0..127     as-is on a 7-bit CC
+	0..255     scaled down onto a 7-bit CC
+	0..65535   scaled onto 14 bits and sent as a CC pair: the MSB on cc and
+	           the LSB on cc + 32, as the MIDI spec lays out for CCs 0-31
+An event is only written when a lane's value changes.
+
+Every region needs a channel of its own and every lane a controller of its
+own, or their CC streams would overwrite each other: so at most 16 regions,
+CCs up to 119 (the rest are channel mode messages), and 14-bit variables on
+CCs below 32, whose LSB partners don't collide with another lane. write()
+checks all that before writing anything; check_cc_numbers does it for
+playback.MidiSink too.
+
+Encoding is done with numpy over whole tracks rather than per event, so a full
+50-year render takes a few milliseconds.
+'''
+import struct
+import numpy
+
+default_first_cc = 20
+max_cc = 119
+num_channels = 16
+ticks_per_beat = 480
+tempo_bpm = 120
+control_change = 0xB0
+
+def default_cc_numbers(variables, first_cc=default_first_cc):
+	''' Consecutive CCs from first_cc, in the order of variables. '''
+	return dict((var, first_cc + i) for i, var in enumerate(variables))
+
+def check_cc_numbers(cc_numbers, wide=()):
+	''' Assert that every variable's CC, and for those in wide (sent as 14-bit
+	pairs) its LSB partner cc + 32, is a controller no other lane uses. '''
+	used = {}
+	for var in sorted(cc_numbers):
+		cc = cc_numbers[var]
+		assert 0 <= cc <= max_cc, 'CC %d for %s is out of range (controllers run from 0 to %d)' % (cc, var, max_cc)
+		ccs = [cc]
+		if var in wide:
+			assert cc < 32, ('%s is sent as a 14-bit CC pair, which needs a CC below 32 (for the LSB on cc + 32), '
+							 'not %d: pass cc_numbers, or normalize it onto 0..255' % (var, cc))
+			ccs.append(cc + 32)
+		for controller in ccs:
+			assert controller not in used, 'CC %d is used by both %s and %s' % (controller, used[controller], var)
+			used[controller] = var
+
+def check_channels(channels):
+	''' Assert that every region has a MIDI channel of its own. '''
+	assert all(0 <= channel < num_channels for channel in channels), 'MIDI channels run from 0 to 15'
+	shared = sorted(set(channel for channel in channels if list(channels).count(channel) > 1))
+	assert not shared, 'Regions share MIDI channels %s, so their CCs would overwrite each other' % shared
+
+def _range_max(values, value_range):
+	if value_range is not None:
+		return value_range[1]
+	return 255 if values.max() <= 255 else 65535
+
+def _lanes(series, cc, channel, value_range, sample_ticks):
+	''' (ticks, status, controller, value) arrays for one variable in one
+	region, only where the value changes. '''
+	values = numpy.asarray(series, dtype=numpy.int64)
+	if not len(values):
+		return []
+	range_max = _range_max(values, value_range)
+	changed = numpy.concatenate(([True], values[1:] != values[:-1]))
+	ticks = sample_ticks[changed]
+	values = values[changed]
+	status = control_change | channel
+	if range_max <= 127:
+		return [(ticks, status, cc, values)]
+	if range_max <= 255:
+		return [(ticks, status, cc, values * 127 // range_max)]
+	assert cc < 32, 'CC %d has no LSB partner; 14-bit values need a CC below 32' % cc
+	fine = values * 16383 // range_max
+	# MSB first, then LSB, at the same tick.
+	return [(ticks, status, cc, fine >> 7), (ticks, status, cc + 32, fine & 0x7F)]
+
+def _variable_length(deltas):
+	''' Variable-length quantity encoding of an int array, as a (n, 4) byte
+	array plus a (n, 4) mask of which bytes are used. '''
+	groups = numpy.stack([(deltas >> shift) & 0x7F for shift in (21, 14, 7, 0)], axis=1)
+	used = numpy.stack([deltas >= 1 << 21, deltas >= 1 << 14, deltas >= 1 << 7,
+						numpy.ones(len(deltas), dtype=bool)], axis=1)
+	groups[:, :3] |= 0x80 # continuation bits
+	return (groups, used)
+
+def _meta(delta, kind, payload):
+	return struct.pack('>BBB', delta, 0xFF, kind) + bytes(bytearray([len(payload)])) + payload
+
+def _track(lanes, name):
+	''' Encode a track chunk from a list of lanes. '''
+	chunk = _meta(0, 0x03, name.encode('utf-8'))
+	if lanes:
+		ticks = numpy.concatenate([lane[0] for lane in lanes])
+		status = numpy.concatenate([numpy.full(len(lane[0]), lane[1]) for lane in lanes])
+		controller = numpy.concatenate([numpy.full(len(lane[0]), lane[2]) for lane in lanes])
+		values = numpy.concatenate([lane[3] for lane in lanes])
+		# Stable sort by tick keeps lanes (and so MSB before LSB) in order.
+		order = numpy.argsort(ticks, kind='mergesort')
+		ticks = ticks[order]
+		deltas = numpy.diff(numpy.concatenate(([0], ticks)))
+		groups, used = _variable_length(deltas)
+		rows = numpy.concatenate((groups, status[order, numpy.newaxis], controller[order, numpy.newaxis],
+								  values[order, numpy.newaxis]), axis=1)
+		mask = numpy.concatenate((used, numpy.ones((len(rows), 3), dtype=bool)), axis=1)
+		chunk += rows[mask].astype(numpy.uint8).tobytes()
+	chunk += _meta(0, 0x2F, b'')
+	return b'MTrk' + struct.pack('>I', len(chunk)) + chunk
+
+def write(filename, data, seconds_per_sample=0.1, cc_numbers=None, channels=None, ranges=None, region_names=None):
+	''' Write data (a list, per region, of dicts from variable to a list of
+	normalized values) as a MIDI file.
+	seconds_per_sample -- time between successive values
+	cc_numbers         -- dict from variable to CC number; defaults to
+	                      consecutive CCs from default_first_cc, in sorted
+	                      variable order
+	channels           -- MIDI channel (0-15) per region, each different;
+	                      defaults to the region index
+	ranges             -- dict from variable to the (min, max) it was
+	                      normalized onto; guessed from the values otherwise
+	region_names       -- track names; default 'region 0', 'region 1'... '''
+	variables = sorted(data[0].keys()) if data else []
+	ranges = ranges or {}
+	if cc_numbers is None:
+		cc_numbers = default_cc_numbers(variables)
+	wide = [var for var in variables
+			if any(len(region[var]) and _range_max(numpy.asarray(region[var]), ranges.get(var)) > 255
+				   for region in data)]
+	check_cc_numbers(dict((var, cc_numbers[var]) for var in variables), wide)
+	if channels is None:
+		assert len(data) <= num_channels, \
+			'%d regions, but there are only %d MIDI channels: write fewer regions at a time' % (len(data), num_channels)
+		channels = list(range(len(data)))
+	check_channels(channels)
+	if region_names is None:
+		region_names = ['region %d' % i for i in range(len(data))]
+
+	ticks_per_second = ticks_per_beat * tempo_bpm / 60.0
+	microseconds_per_beat = int(round(60e6 / tempo_bpm))
+
+	tracks = [b'MTrk' + struct.pack('>I', 7 + 4) +
+			  struct.pack('>BBBB', 0, 0xFF, 0x51, 3) + struct.pack('>I', microseconds_per_beat)[1:] +
+			  _meta(0, 0x2F, b'')]
+	for region, channel, name in zip(data, channels, region_names):
+		lanes = []
+		for var in variables:
+			num_samples = len(region[var])
+			sample_ticks = numpy.round(numpy.arange(num_samples) * seconds_per_sample * ticks_per_second).astype(numpy.int64)
+			lanes.extend(_lanes(region[var], cc_numbers[var], channel, ranges.get(var), sample_ticks))
+		tracks.append(_track(lanes, str(name)))
+
+	with open(filename, 'wb') as f:
+		f.write(b'MThd' + struct.pack('>IHHH', 6, 1, len(tracks), ticks_per_beat))
+		for track in tracks:
+			f.write(track)
+
+def _read_variable_length(data, pos):
+	value = 0
+	while True:
+		byte = data[pos]
+		pos += 1
+		value = (value << 7) | (byte & 0x7F)
+		if not byte & 0x80:
+			return (value, pos)
+
+def read_control_changes(filename):
+	''' Read back a file from write(): a list, per track, of
+	(tick, channel, controller, value) tuples. Only understands what write()
+	produces (meta events and control changes without running status). '''
+	with open(filename, 'rb') as f:
+		data = bytearray(f.read())
+	(length, file_format, num_tracks, division) = struct.unpack('>IHHH', bytes(data[4:14]))
+	pos = 8 + length
+	tracks = []
+	for i in range(num_tracks):
+		assert bytes(data[pos:pos + 4]) == b'MTrk'
+		(length,) = struct.unpack('>I', bytes(data[pos + 4:pos + 8]))
+		pos += 8
+		end = pos + length
+		tick = 0
+		events = []
+		while pos < end:
+			delta, pos = _read_variable_length(data, pos)
+			tick += delta
+			if data[pos] == 0xFF:
+				pos += 3 + data[pos + 2]
+			else:
+				events.append((tick, data[pos] & 0x0F, data[pos + 1], data[pos + 2]))
+				pos += 3
+		tracks.append(events)
+	return tracks
+
+def test_write_read_control_changes():
+	import os, shutil, tempfile
+	data = [{'air': [0, 0, 255, 128], 'wspd': [0, 65535, 65535, 300]},
+			{'air': [10, 20, 30, 40], 'wspd': [1, 2, 3, 4]}]
+	tmpdir = tempfile.mkdtemp()
+	try:
+		filename = os.path.join(tmpdir, 'out.mid')
+		write(filename, data, seconds_per_sample=1.0, ranges={'air': (0, 255), 'wspd': (0, 65535)})
+		tracks = read_control_changes(filename)
+	finally:
+		shutil.rmtree(tmpdir)
+	assert len(tracks) == 3 and tracks[0] == []
+	# 120 bpm at 480 ticks per beat is 960 ticks per second.
+	assert tracks[1] == [(0, 0, 20, 0), (0, 0, 21, 0), (0, 0, 53, 0),
+						 (960, 0, 21, 127), (960, 0, 53, 127),
+						 (1920, 0, 20, 127),
+						 (2880, 0, 20, 63), (2880, 0, 21, 0), (2880, 0, 53, 74)], tracks[1]
+	assert [event[:3] for event in tracks[2][:3]] == [(0, 1, 20), (0, 1, 21), (0, 1, 53)]
+
+def test_write_checks_limits():
+	import os
+	def fails(function):
+		try:
+			function()
+		except AssertionError as error:
+			return str(error)
+		assert False, 'Expected an AssertionError'
+	# Thirteen 14-bit variables run past CC 31.
+	wide = [dict(('v%02d' % i, [0, 65535]) for i in range(13))]
+	assert 'v12' in fails(lambda: write(os.devnull, wide))
+	assert 'overwrite' in fails(lambda: write(os.devnull, [{'air': [0]}] * 2, channels=[3, 3]))
+	assert '17 regions' in fails(lambda: write(os.devnull, [{'air': [0]}] * 17))
+	assert 'used by both' in fails(lambda: check_cc_numbers({'air': 20, 'wspd': 52}, wide=['air']))
+	write(os.devnull, [dict(('v%02d' % i, [0, 255]) for i in range(13))])
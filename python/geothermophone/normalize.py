@@ -0,0 +1,155 @@
+'''
+Array-backed normalization of region series onto integer control ranges.
+
+Values are (time, region) arrays, so every region is handled in one go, and the
+results are the smallest unsigned type that holds the target range (uint8 for
+0-255, uint16 for 0-65535) rather than lists of Python ints.
+
+The arithmetic matches the old per-value loops in parser.py exactly:
+percent = (value - old_min) / (old_max - old_min), scaled onto the new range
+and truncated. Two cases the loops couldn't handle:
+	- a flat channel (old_max == old_min) maps to new_min instead of dividing
+	  by zero
+	- nan values (regions with no data) also map to new_min
+
+Min/max scaling lets one outlier (prate's actual_range goes up to 5.9e-4
+where typical values are ~1e-6) squash everything else into a few steps, so
+there are two more ways to normalize, each per region or over all of them:
+	percentile  scale between two percentiles (1 and 99 by default),
+	            clipping values beyond them
+	equalize    histogram equalization: map each value to the fraction of
+	            values below it, so every step gets used about as often
+Both take their percentiles from quantiles.py sketches, which can be built a
+chunk at a time and merged, so they work in one pass over data that doesn't
+fit in memory (see pipeline.Normalize).
+'''
+import warnings
+import numpy
+from quantiles import ColumnSketches
+
+default_percentiles = (1.0, 99.0)
+
+def output_dtype(new_min, new_max):
+	''' Smallest unsigned integer type holding new_min..new_max. '''
+	assert 0 <= new_min <= new_max, 'Target range %s..%s must be non-negative' % (new_min, new_max)
+	for dtype in (numpy.uint8, numpy.uint16, numpy.uint32):
+		if new_max <= numpy.iinfo(dtype).max:
+			return dtype
+	return numpy.uint64
+
+def series_to_array(data):
+	''' Turn a {key: list of values} dict into (sorted keys, (time, region) array). '''
+	keys = sorted(data.keys())
+	values = numpy.array([data[key] for key in keys], dtype=float).T
+	return (keys, values.reshape(-1, len(keys)))
+
+def array_to_series(keys, values):
+	''' Inverse of series_to_array. '''
+	return dict((key, values[:, i].tolist()) for i, key in enumerate(keys))
+
+def channel_min_max(values):
+	''' Per-region (mins, maxes) of a (time, region) array, ignoring nan. '''
+	values = numpy.asarray(values, dtype=float)
+	with warnings.catch_warnings():
+		warnings.simplefilter('ignore', RuntimeWarning) # all-nan regions
+		return (numpy.nanmin(values, axis=0), numpy.nanmax(values, axis=0))
+
+def absolute_min_max(values):
+	''' (min, max) over all regions at once, ignoring nan. '''
+	values = numpy.asarray(values, dtype=float)
+	with warnings.catch_warnings():
+		warnings.simplefilter('ignore', RuntimeWarning) # all-nan input
+		return (float(numpy.nanmin(values)), float(numpy.nanmax(values)))
+
+def scale(values, old_min, old_max, new_min, new_max):
+	''' Map old_min..old_max onto new_min..new_max, as floats. old_min and
+	old_max can be scalars or per-region arrays. '''
+	values = numpy.asarray(values, dtype=float)
+	old_diff = numpy.asarray(old_max, dtype=float) - old_min
+	flat = old_diff == 0
+	with numpy.errstate(invalid='ignore', divide='ignore'):
+		percent = (values - old_min) / numpy.where(flat, 1.0, old_diff)
+	percent = numpy.where(flat | numpy.isnan(percent), 0.0, percent)
+	return percent * (new_max - new_min) + new_min
+
+def to_integers(scaled, new_min, new_max):
+	''' Truncate scaled values into the compact type for new_min..new_max. '''
+	return numpy.clip(numpy.trunc(scaled), new_min, new_max).astype(output_dtype(new_min, new_max))
+
+def normalize_relative(values, new_min=0, new_max=255):
+	''' Scale each region onto new_min..new_max using its own min and max. '''
+	(mins, maxes) = channel_min_max(values)
+	return to_integers(scale(values, mins, maxes, new_min, new_max), new_min, new_max)
+
+def normalize_absolute(values, new_min=0, new_max=65535):
+	''' Scale all regions onto new_min..new_max using the overall min and max,
+	so regions stay comparable with each other. '''
+	(old_min, old_max) = absolute_min_max(values)
+	return to_integers(scale(values, old_min, old_max, new_min, new_max), new_min, new_max)
+
+def sketches(values, absolute=False):
+	''' ColumnSketches of a (time, region) array: one per region, or with
+	absolute, one over all of them. '''
+	values = numpy.asarray(values, dtype=float)
+	return ColumnSketches(1 if absolute else values.shape[1]).update(values)
+
+def percentile_bounds(sketches, low=default_percentiles[0], high=default_percentiles[1]):
+	''' The (low, high) percentiles of each sketched column. '''
+	bounds = sketches.quantiles([low / 100.0, high / 100.0])
+	return (bounds[0], bounds[1])
+
+def equalize(values, sketches, new_min, new_max):
+	''' Map values onto new_min..new_max by where they fall in the sketched
+	distributions (the cdf rescaled so the smallest value maps to new_min), as
+	floats. '''
+	values = numpy.asarray(values, dtype=float)
+	fractions = sketches.cdf(values)
+	lowest = sketches.cdf(sketches.quantiles([0.0]))
+	with numpy.errstate(invalid='ignore', divide='ignore'):
+		percent = numpy.clip((fractions - lowest) / (1 - lowest), 0.0, 1.0)
+	percent = numpy.where(numpy.isnan(percent), 0.0, percent)
+	return percent * (new_max - new_min) + new_min
+
+def normalize_percentile(values, low=default_percentiles[0], high=default_percentiles[1], new_min=0, new_max=255,
+						 absolute=False):
+	''' Scale values between their low and high percentiles onto
+	new_min..new_max, clipping beyond them: each region by its own, or with
+	absolute, all regions by the overall ones. '''
+	(lows, highs) = percentile_bounds(sketches(values, absolute), low, high)
+	return to_integers(scale(values, lows, highs, new_min, new_max), new_min, new_max)
+
+def normalize_equalized(values, new_min=0, new_max=255, absolute=False):
+	''' Histogram-equalize values onto new_min..new_max: each region by its
+	own distribution, or with absolute, all regions by the overall one. '''
+	return to_integers(equalize(values, sketches(values, absolute), new_min, new_max), new_min, new_max)
+
+def test_normalize_relative():
+	values = numpy.array([[0., 10., 5.],
+	                      [1., 20., 5.],
+	                      [2., numpy.nan, 5.]])
+	normalized = normalize_relative(values)
+	assert normalized.dtype == numpy.uint8
+	assert normalized.tolist() == [[0, 0, 0], [127, 255, 0], [255, 0, 0]], normalized.tolist()
+
+def test_normalize_absolute_array():
+	values = numpy.array([[0., 3.], [1., 4.], [2., 5.]])
+	normalized = normalize_absolute(values)
+	assert normalized.dtype == numpy.uint16
+	assert normalized.T.tolist() == [[0, 13107, 26214], [39321, 52428, 65535]]
+	assert normalize_absolute(numpy.ones((4, 2))).tolist() == [[0, 0]] * 4
+
+def test_normalize_outliers():
+	# Like prate: values around 1e-6, one month at 5.9e-4.
+	random = numpy.random.RandomState(0)
+	values = random.lognormal(-14, 0.5, size=(600, 2))
+	values[100, 0] = 5.9e-4
+	values[7, 1] = numpy.nan
+	assert len(numpy.unique(normalize_relative(values)[:, 0])) < 5, 'The outlier squashes min/max scaling'
+	clipped = normalize_percentile(values)
+	assert clipped[100, 0] == 255 and clipped[7, 1] == 0
+	assert len(numpy.unique(clipped[:, 0])) > 100
+	# Equalized steps are used about equally often, over all regions too.
+	equalized = normalize_equalized(values, absolute=True, new_max=65535)
+	assert equalized.dtype == numpy.uint16 and equalized.min() == 0 and equalized.max() == 65535
+	counts = numpy.bincount(normalize_equalized(values).ravel() // 32, minlength=8)
+	assert counts.min() > 0.8 * counts.mean(), counts
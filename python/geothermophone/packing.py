@@ -0,0 +1,108 @@
+'''
+Decoding of packed NetCDF variables.
+
+Several of the NCEP variables (wspd, prate...) are stored as int16 with
+scale_factor and add_offset attributes: the real value is
+	scale_factor * raw + add_offset
+and raw values equal to missing_value or _FillValue are missing. See
+http://www.esrl.noaa.gov/psd/data/gridded/faq.html#2
+
+Rather than unpacking every cell, the reducers sum the raw values of each
+region and decode the sums, since
+	sum(scale * raw + offset) = scale * sum(raw) + offset * count
+(and likewise with weights). So a packed block is only ever held as int16,
+a quarter the size of the float64 copy decoding it up front would need.
+'''
+import numpy
+
+def _attribute(variable, name, default=None):
+	value = getattr(variable, name, None)
+	if value is None:
+		return default
+	return numpy.ravel(value)[0]
+
+class Packing(object):
+	''' How a variable's raw values map to real ones, and which are missing. '''
+	def __init__(self, scale_factor=1.0, add_offset=0.0, missing_values=()):
+		self.scale_factor = float(scale_factor)
+		self.add_offset = float(add_offset)
+		self.missing_values = tuple(value for value in missing_values if value is not None)
+
+	@classmethod
+	def of(cls, variable):
+		''' The packing of a netcdf_variable, from its attributes. '''
+		return cls(_attribute(variable, 'scale_factor', 1.0), _attribute(variable, 'add_offset', 0.0),
+				   (_attribute(variable, 'missing_value'), _attribute(variable, '_FillValue')))
+
+	def is_packed(self):
+		return self.scale_factor != 1.0 or self.add_offset != 0.0
+
+	def valid(self, raw):
+		''' Boolean array of which raw values aren't missing, or None if none
+		can be. Compares in the raw dtype, so no decoded copy is made. '''
+		if not self.missing_values:
+			return None
+		raw = numpy.asarray(raw)
+		valid = None
+		for missing_value in self.missing_values:
+			if numpy.isnan(missing_value):
+				matches = numpy.isnan(raw)
+			else:
+				raw_missing = numpy.asarray(missing_value).astype(raw.dtype)
+				if raw_missing != missing_value:
+					continue # can't occur in this dtype
+				matches = raw == raw_missing
+			valid = ~matches if valid is None else valid & ~matches
+		return valid
+
+	def decode(self, raw):
+		''' Real values as float64 (for when the values themselves are needed;
+		missing cells are decoded too, so mask them with valid()). '''
+		values = numpy.asarray(raw, dtype=numpy.float64)
+		if self.is_packed():
+			values = values * self.scale_factor + self.add_offset
+		return values
+
+	def decode_sums(self, sums, counts):
+		''' Decode per-region sums of raw values, given how many values (or how
+		much weight) went into each. '''
+		if not self.is_packed():
+			return sums
+		return sums * self.scale_factor + counts * self.add_offset
+
+def pack(values, scale_factor, add_offset, missing_value=32766, dtype=numpy.int16):
+	''' Pack real values (nan for missing) the way the NCEP files are. '''
+	raw = numpy.round((numpy.asarray(values, dtype=float) - add_offset) / scale_factor)
+	return numpy.where(numpy.isnan(raw), missing_value, raw).astype(dtype)
+
+def test_packed_reduction():
+	import os, shutil, tempfile
+	from scipy.io import netcdf
+	import parser
+	from reducer import RegionReducer
+	# Like wspd: metres per second around 0..20, packed with offset 225.45.
+	scale_factor, add_offset = 0.01, 225.45
+	real = parser._fixture_grid(6, num_lons=9, num_lats=16).astype(float) + 40
+	real.reshape(6, -1)[:, ::5] = numpy.nan
+	raw = pack(real, scale_factor, add_offset)
+	assert raw.dtype == numpy.int16 and raw[0, 0, 0] == 32766
+	tmpdir = tempfile.mkdtemp()
+	try:
+		filename = os.path.join(tmpdir, 'wspd.nc')
+		parser._write_test_file(filename, 'wspd', raw, parser._month_hours(parser.starttime, len(raw)), numpy.int16(32766))
+		f = netcdf.netcdf_file(filename, 'a')
+		f.variables['wspd'].scale_factor = numpy.float32(scale_factor)
+		f.variables['wspd'].add_offset = numpy.float32(add_offset)
+		f.close()
+		series = parser.get_region_series('wspd', filename, runningAve=False)
+	finally:
+		shutil.rmtree(tmpdir)
+
+	# Means of the (float32 rounded) decoded values, ignoring the missing ones.
+	decoded = raw * float(numpy.float32(scale_factor)) + float(numpy.float32(add_offset))
+	decoded[raw == 32766] = numpy.nan
+	reducer = RegionReducer(*parser.LonLatSplitter(9, 16).label_grid())
+	for i, key in enumerate(reducer.keys):
+		cells = decoded[:, reducer.labels.reshape(9, 16) == i]
+		assert numpy.allclose(series[key], numpy.nanmean(cells, axis=1), rtol=1e-12), key
+		assert numpy.allclose(series[key], numpy.nanmean(real[:, reducer.labels.reshape(9, 16) == i], axis=1), atol=0.01)
@@ -77,27 +77,57 @@ Output list of times, containing:
 To start:
 	do air.
 '''
-from datetime import timedelta, datetime
+from datetime import datetime
 import math
+import os
+import sys
 from scipy.io import netcdf
 import numpy
+from cache import RegionCache
+import export
+import midi
+import normalize
+from packing import Packing
+from reducer import RegionReducer
+import regions
+import regrid
+import timeaxis
 
-basetime = datetime(1901, 1, 1, 0, 0, 0)
 starttime = datetime(1960, 1, 1, 0, 0, 0)
 endtime = datetime(2010, 1, 1, 0, 0, 0)
-timeoffset = timedelta(days=693962) # Arbitrary offset by trial and error
+
+# Split regions by the files' own lat/lon coordinates (see regrid.py), so that
+# variables on different grids get the same octant boundaries. Files without
+# coordinate variables, or this set to False, fall back to splitting by index.
+regions_by_coordinates = True
+# How cells count towards a region's mean when splitting by coordinates:
+# 'area' weights them by their area on the sphere, 'degrees' by their extent
+# in lat/lon (which lets the many tiny polar cells dominate). See regrid.py.
+region_weighting = 'area'
+# Regions to split the globe into instead of the octants: a regions.Regions, or
+# the name of a JSON file of region definitions (see regions.py). None means
+# the octants above.
+region_definitions = None
+# Extra channels to sonify for every variable, besides its regional mean: any
+# of RegionStats.statistics, e.g. ('std', 'min', 'max') for how variable each
+# region is. They come out of get_all_data as '<var>_<statistic>'.
+region_statistics = ()
+
+monthly_sources = (
+	('air', '/Users/egg/Temp/GriddedData/air.mon.mean.nc'),
+	('prate', '/Users/egg/Temp/GriddedData/prate.sfc.mon.mean.nc',),
+	('rhum', '/Users/egg/Temp/GriddedData/rhum.mon.mean.nc'),
+	('wspd', '/Users/egg/Temp/GriddedData/wspd.mon.mean.nc'),
+)
 
 def from_datetime(dt):
-	''' Convert from datetime to hours since 1-1-1 00:00:0.0 '''
-	new_dt = dt	+ timeoffset - basetime
-	seconds = new_dt.total_seconds()
-	hours = seconds / (60 * 60)
-	return hours
+	''' Convert from datetime to hours since 1-1-1 00:00:0.0 (see timeaxis.py
+	for arrays, and other units). '''
+	return float(timeaxis.encode([dt])[0])
 
 def to_datetime(hours):
 	''' Convert from hours since 1-1-1 00:00:0.0 to datetime '''
-	td = timedelta(hours=hours)
-	return td + basetime - timeoffset
+	return timeaxis.decode([hours])[0].astype(datetime)
 
 def test_to_from_datetime():
 	test_hours = 7000
@@ -105,15 +135,45 @@ def test_to_from_datetime():
 	hours = from_datetime(dt)
 	assert hours == test_hours, 'Going to and then from datetime didn\'t get us back to the original'
 
+def time_window(hours, start, end):
+	''' Return (first, last) such that hours[first:last] are the records with
+	start <= time < end. hours must be sorted, as the time axis in the files is,
+	so this is a binary search rather than a conversion per record. '''
+	first = numpy.searchsorted(hours, from_datetime(start), side='left')
+	last = numpy.searchsorted(hours, from_datetime(end), side='left')
+	return (int(first), int(max(first, last)))
+
+def test_time_window():
+	hours = [from_datetime(datetime(year, 1, 1)) for year in range(1955, 1965)]
+	assert time_window(hours, datetime(1960, 1, 1), datetime(1963, 1, 1)) == (5, 8)
+	assert time_window(hours, datetime(1959, 6, 1), datetime(1960, 1, 2)) == (5, 6)
+	assert time_window(hours, datetime(1970, 1, 1), datetime(1980, 1, 1)) == (10, 10)
+
 class LonLatSplitter(object):
 	''' Name and params follow unconventional ordering in files '''
+	num_lon_bins = 4
+	num_lat_bins = 2
+
 	def __init__(self, lon_range, lat_range):
 		''' Note that we can use either the range of indices or the actual
 		 range of lat/lon values as long as we're consistent. '''
 		self.lon_range = lon_range
 		self.lat_range = lat_range
-		self.lon_divisor = lon_range / 4.0
-		self.lat_divisor = lat_range / 2.0
+		self.lon_divisor = lon_range / float(self.num_lon_bins)
+		self.lat_divisor = lat_range / float(self.num_lat_bins)
+
+	@classmethod
+	def keys(cls):
+		''' All the octant keys, in the order get_all_data lists octants. '''
+		return [(lon_key, lat_key)
+				for lon_key in range(cls.num_lon_bins)
+				for lat_key in range(cls.num_lat_bins)]
+
+	@classmethod
+	def layout(cls):
+		''' Describes how the grid gets split, independent of the grid size
+		(e.g. for cache keys). '''
+		return [cls.__name__, cls.num_lon_bins, cls.num_lat_bins, regions_by_coordinates, region_weighting]
 
 	def split_to_octs(self, lon, lat):
 		''' return the key (0..3, 0..1) for which octant the lat/lon is in. '''
@@ -124,6 +184,19 @@ class LonLatSplitter(object):
 		lat_key = int(math.floor(lat / self.lat_divisor))
 		return (lon_key, lat_key)
 
+	def label_grid(self):
+		''' Return (labels, keys) for the whole grid at once: an int array of
+		shape (lon_range, lat_range) holding each cell's index into keys, and
+		the octant keys in index order. Only makes sense for index ranges. '''
+		lon_keys = numpy.floor(numpy.arange(self.lon_range) / self.lon_divisor).astype(int)
+		lat_keys = numpy.floor(numpy.arange(self.lat_range) / self.lat_divisor).astype(int)
+		num_lat_keys = lat_keys.max() + 1
+		labels = lon_keys[:, numpy.newaxis] * num_lat_keys + lat_keys[numpy.newaxis, :]
+		keys = [(lon_key, lat_key)
+				for lon_key in range(lon_keys.max() + 1)
+				for lat_key in range(num_lat_keys)]
+		return (labels, keys)
+
 def _test_var(var, filename):
 	print; print
 	print 'testing', var
@@ -138,67 +211,43 @@ def _test_var(var, filename):
 	print 'lat,', len(data[time][lon])
 	print 'lon range:', f.variables['lon'].actual_range
 	print 'lat range:', f.variables['lat'].actual_range
-	print 'apparent date:', to_datetime(f.variables['time'][0])
+	print 'apparent date:', timeaxis.TimeAxis.from_variable(f.variables['time']).dates[0]
+
+# The functions below keep the dict-of-lists interface the rest of the code
+# (and sonify) expects; the work is done on arrays in normalize.py.
 
 def get_channel_min_max(data):
 	''' Return the min and max of each channel
 	as a dict from channel key to (min, max) '''
-	results = {}
-	for key, vals in data.items():
-		min = vals[0]
-		max = vals[0]
-		for val in vals:
-			if val < min:
-				min = val
-			elif val > max:
-				max = val
-		results[key] = (min, max)
-	return results
+	keys, values = normalize.series_to_array(data)
+	mins, maxes = normalize.channel_min_max(values)
+	return dict((key, (mins[i], maxes[i])) for i, key in enumerate(keys))
 
 def get_absolute_min_max(data):
 	''' Return min and max of each channel as a tuple. '''
-	channel_min_maxes = get_channel_min_max(data)
-	min = None
-	max = None
-	for key, (cur_min, cur_max) in channel_min_maxes.items():
-		if min is None or cur_min < min:
-			min = cur_min
-		if max is None or cur_max > max:
-			max = cur_max
-	return (float(min), float(max))
+	keys, values = normalize.series_to_array(data)
+	return normalize.absolute_min_max(values)
+
+def _normalized_series(keys, scaled, new_min, new_max, num_type):
+	if num_type is int:
+		return normalize.array_to_series(keys, normalize.to_integers(scaled, new_min, new_max))
+	return dict((key, [num_type(val) for val in scaled[:, i]]) for i, key in enumerate(keys))
 
 def normalize_relative(data, new_min=0, new_max=255, num_type=int):
-	results = {}
-	channel_min_maxes = get_channel_min_max(data)
-	new_diff = new_max - new_min
-	for octant in data.keys():
-		old_vals = data[octant]
-		(old_min, old_max) = channel_min_maxes[octant]
-		new_vals = []
-		old_diff = old_max - old_min
-		for old_val in old_vals:
-			percent = (old_val - old_min) / float(old_diff)
-			new_val = percent * new_diff + new_min
-			new_vals.append(num_type(new_val))
-		results[octant] = new_vals
-	return results
+	''' Scale each channel onto new_min..new_max by its own min/max. See
+	normalize.normalize_relative for the array version. '''
+	keys, values = normalize.series_to_array(data)
+	mins, maxes = normalize.channel_min_max(values)
+	scaled = normalize.scale(values, mins, maxes, new_min, new_max)
+	return _normalized_series(keys, scaled, new_min, new_max, num_type)
 
 def normalize_absolute(data, new_min=0, new_max=65535, num_type=int):
-	(old_min, old_max) = get_absolute_min_max(data)
-	old_diff = old_max - old_min
-	new_diff = new_max - new_min
-	# print 'old_diff:', old_diff
-	# print 'new_diff:', new_diff
-	results = {}
-	for channel, old_vals in data.items():
-		new_vals = []
-		for old_val in old_vals:
-			percent = (old_val - old_min) / float(old_diff)
-			new_val = percent * new_diff + new_min
-			# print 'old_val: %s, percent: %s, new_val: %s'%(old_val, percent, new_val)
-			new_vals.append(num_type(new_val))
-		results[channel] = new_vals
-	return results
+	''' Scale all channels onto new_min..new_max by the overall min/max. See
+	normalize.normalize_absolute for the array version. '''
+	keys, values = normalize.series_to_array(data)
+	(old_min, old_max) = normalize.absolute_min_max(values)
+	scaled = normalize.scale(values, old_min, old_max, new_min, new_max)
+	return _normalized_series(keys, scaled, new_min, new_max, num_type)
 
 def test_normalize_absolute():
 	data = {'a': [0, 1, 2],
@@ -208,66 +257,157 @@ def test_normalize_absolute():
 	assert normalized_data == expected_data, \
 		'Normalized data (%s) does not match expected results (%s).' % (normalized_data, expected_data)
 
-def get_data(var, filename, runningAve=True, relative_normalization=True):
-	# Returns a list (time) of dicts(octants) of value (wait, not true)
+def test_normalize_relative_flat_channel():
+	data = {'a': [7.0, 7.0, 7.0],
+	        'b': [1.0, 2.0, 3.0]}
+	assert normalize_relative(data) == {'a': [0, 0, 0], 'b': [0, 127, 255]}
+	assert get_channel_min_max(data) == {'a': (7.0, 7.0), 'b': (1.0, 3.0)}
+
+# Records per job when reducing in parallel. Each variable is split into
+# chunks this long so that long records spread over all the workers too.
+parallel_chunk_records = 240
+
+def _coordinates(f, data):
+	''' (lats, lons) coordinate values for a (time, lat, lon) variable, or
+	(None, None) if the file doesn't have them. '''
+	names = data.dimensions[1:]
+	if all(name in f.variables for name in names):
+		return tuple(f.variables[name][:].copy() for name in names)
+	return (None, None)
+
+_loaded_regions = {}
+
+def get_regions():
+	''' The regions.Regions given by region_definitions, or None for the
+	octants. '''
+	if isinstance(region_definitions, basestring):
+		if region_definitions not in _loaded_regions:
+			_loaded_regions[region_definitions] = regions.load(region_definitions)
+		return _loaded_regions[region_definitions]
+	return region_definitions
+
+def region_keys():
+	''' Keys of the regions in use, in the order get_all_data lists them. '''
+	if get_regions() is not None:
+		return get_regions().keys()
+	return LonLatSplitter.keys()
+
+def region_layout():
+	''' Describes how the grid gets split, for cache keys. '''
+	if get_regions() is not None:
+		return get_regions().layout() + [region_weighting]
+	return LonLatSplitter.layout()
+
+def make_octant_reducer(grid_shape, lats=None, lons=None, regions=None):
+	''' The reducer for splitting a grid into regions. With regions (a
+	regions.Regions) given, or region_definitions set, those regions, validated
+	against this grid. Otherwise the octants: by coordinates when we have them
+	and regions_by_coordinates is set, otherwise by index. '''
+	if regions is None:
+		regions = get_regions()
+	if regions is not None:
+		return regions.reducer(grid_shape, lats, lons, region_weighting)
+	if regions_by_coordinates and lats is not None and lons is not None:
+		return regrid.octant_reducer(lats, lons, weighting=region_weighting)
+	return RegionReducer(*LonLatSplitter(*grid_shape).label_grid())
+
+def reduce_records(var, filename, first, last, statistics=False, regions=None):
+	''' Reduce records first..last-1 of var to per-octant (sums, counts), each
+	shaped (time, octant), or with statistics, to a RegionStats. regions is as
+	for make_octant_reducer. Opens the file itself so it can run in a worker
+	process. '''
+	# mmap so that only the records inside the window ever get paged in.
+	f = netcdf.netcdf_file(filename, 'r', mmap=True)
+	try:
+		data = f.variables[var]
+		reducer = make_octant_reducer(data.shape[1:], *(_coordinates(f, data) + (regions,)))
+		# Packed variables are decoded per region, after summing (see packing.py).
+		if statistics:
+			return reducer.reduce_range_stats(data.data, first, last, packing=Packing.of(data))
+		return reducer.reduce_range(data.data, first, last, packing=Packing.of(data))
+	finally:
+		# Nothing may keep pointing into the mmap once the file is closed.
+		data = None
+		f.close()
+
+def _reduce_job(job):
+	return reduce_records(*job)
+
+def _run_reduce_jobs(jobs, workers=None):
+	''' Run reduce_records over a list of (var, filename, first, last, statistics, regions) jobs,
+	in a pool of worker processes if workers > 1. Results come back in job
+	order either way. '''
+	if not workers or workers <= 1 or len(jobs) <= 1:
+		return [_reduce_job(job) for job in jobs]
+	import multiprocessing
+	pool = multiprocessing.Pool(min(workers, len(jobs)))
+	try:
+		return pool.map(_reduce_job, jobs, chunksize=1)
+	finally:
+		pool.close()
+		pool.join()
+
+def get_record_times(filename):
+	''' Times (hours since 1-1-1) of the records between starttime and endtime,
+	i.e. the time of each value get_data returns for this file. '''
+	axis = get_time_axis(filename)
+	first, last = axis.select(starttime, endtime)
+	return axis.hours[first:last]
+
+def get_time_axis(filename):
+	''' The file's time axis, decoded from its units (see timeaxis.py). '''
+	f = netcdf.netcdf_file(filename, 'r', mmap=True)
+	try:
+		return timeaxis.TimeAxis.from_variable(f.variables['time'])
+	finally:
+		f.close()
+
+def channel_name(var, statistic='mean'):
+	''' The name a variable's statistic goes by in the results: the variable
+	itself for the mean, '<var>_<statistic>' otherwise. '''
+	return var if statistic == 'mean' else '%s_%s' % (var, statistic)
+
+def _spec(sources, runningAve=True, window=12, statistics=(), relative_normalization=None):
+	''' The pipeline.py spec of get_data and friends: sources is a list of
+	(var, filename), relative_normalization None to leave the series
+	unnormalized. '''
+	normalization = {True: 'relative', False: 'absolute', None: None}[relative_normalization]
+	return {'variables': [{'name': var, 'path': filename} for var, filename in sources],
+			'start': starttime, 'end': endtime, 'statistics': list(statistics),
+			'smoothing': 'boxcar' if runningAve else None, 'window': window,
+			'normalization': normalization}
+
+def get_all_region_series(sources, runningAve=True, cache=None, window=12, workers=None, statistics=(),
+						  instruments=None):
+	''' get_region_series for each (var, filename) in sources, returned as a
+	dict from var to its series. With workers > 1, the variables and chunks
+	of each variable's records are reduced in parallel; the partial sums are
+	put back together in order before smoothing, so the results are exactly
+	the same as the serial ones. statistics (see RegionStats) adds a series
+	for each, under channel_name(var, statistic), from the same pass over the
+	data. instruments (an instrument.Instruments) records how long each stage
+	takes. '''
+	import pipeline
+	spec = _spec(sources, runningAve, window, statistics)
+	return pipeline.Pipeline(spec, instruments=instruments).series(cache, workers)
+
+def get_region_series(var, filename, runningAve=True, cache=None, window=12, workers=None):
+	''' Reduce the file to a dict from octant key to a list of mean values
+	over time, before any normalization. runningAve smooths over the previous
+	window records (12 months cancels out the annual cycle). If cache (a
+	RegionCache) is given, results are looked up there first and stored there
+	afterwards. workers > 1 reduces chunks of the record in parallel. '''
+	return get_all_region_series([(var, filename)], runningAve, cache, window, workers)[var]
+
+def get_data(var, filename, runningAve=True, relative_normalization=True, cache=None, window=12, workers=None,
+			 instruments=None):
+	# Returns a dict from octant to a list of normalized values over time.
 	# Set runningAve to be true if you want to cancel out the diurnal cycle
-	f = netcdf.netcdf_file(filename, 'r')
-	data = f.variables[var]
-
-	results = []
-	num_lons = len(data[0])
-	num_lats = len(data[0][0])
-	oct_splitter = LonLatSplitter(num_lons, num_lats)
-	if runningAve:
-		local_starttime = starttime - timedelta(days=365)
-	else:
-		local_starttime = starttime
-
-	for time in range(len(data.data)):
-		date = f.variables['time'][time]
-		if to_datetime(date) < local_starttime or to_datetime(date) >= endtime:
-			continue
-
-		results_for_t = {}
-		for lon in range(len(data[time])):
-			for lat in range(len(data[time][lon])):
-				oct_key = oct_splitter.split_to_octs(lon, lat)
-				results_for_oct = results_for_t.setdefault(oct_key, []) # list because numpy.mean doesn't like sets
-				value = data[time][lon][lat]
-				if value != data.missing_value:
-					results_for_oct.append(value)
-		results.append(results_for_t)
-
-
-	# Now we reconfigure to a dict of octants, containing 8 lists of lists of
-	# values by time.
-	keys = results[0].keys()
-	result_lists = {}
-	for results_for_time in results:
-		for key in keys:
-			result_lists.setdefault(key, []).append(results_for_time[key])
-
-	# Now we go through and replace each set of values with its average
-	for octant, vals in result_lists.items():
-		for i, vals_for_t in enumerate(vals):
-			vals[i] = numpy.mean(vals_for_t)
-
-	# Take a 12-month running average to cancel out annual cycle
-	if runningAve:
-		for octant, vals in result_lists.items():
-			new_vals = []
-			for t in range(12, len(vals)):
-				new_vals.append(numpy.mean(vals[t-12:t]))
-			result_lists[octant] = new_vals
-
-	if relative_normalization:
-		normalized_results = normalize_relative(result_lists)
-	else:
-		normalized_results = normalize_absolute(result_lists)
-
-	return normalized_results
+	import pipeline
+	spec = _spec([(var, filename)], runningAve, window, relative_normalization=relative_normalization)
+	return pipeline.Pipeline(spec, instruments=instruments).series(cache, workers)[var]
 
-def get_all_data():
+def get_all_data(cache=None, workers=None, statistics=None, instruments=None):
 	''' And return it the way sonify likes it  '''
 	# set up a top-level function which calls get_data for each var and collates it.
 	# 12-month average for all vars, or no? Might be interesting to leave at least
@@ -276,31 +416,20 @@ def get_all_data():
 	# - a list (each member is an octant)
 	# - containing dicts from variable (air, prate, etc) to a list of values
     #TD: consider doing some vars with absolute normalization
-
-	results_dict = {}
-	for var, filename in (
-	('air', '/Users/egg/Temp/GriddedData/air.mon.mean.nc'),
-	('prate', '/Users/egg/Temp/GriddedData/prate.sfc.mon.mean.nc',),
-	('rhum', '/Users/egg/Temp/GriddedData/rhum.mon.mean.nc'),
-	('wspd', '/Users/egg/Temp/GriddedData/wspd.mon.mean.nc'),
-	):
-		cur_results = get_data(var, filename, runningAve=True)
-		for octant, data in cur_results.items():
-			results_dict.setdefault(octant, {})[var] = data
-	results_list = []
-	for octant in sorted(results_dict.keys()):
-		results_list.append(results_dict[octant])
-	return results_list
+	# workers > 1 reduces the variables (and chunks of each) in a process pool.
+	# statistics (default region_statistics) adds those channels per variable.
+	# instruments (an instrument.Instruments) times each stage; see instrument.py.
+	# See pipeline.py for running other variables, files or settings.
+	import pipeline
+	if statistics is None:
+		statistics = region_statistics
+	spec = _spec(monthly_sources, runningAve=True, statistics=statistics, relative_normalization=True)
+	return pipeline.Pipeline(spec, instruments=instruments).data(cache, workers)
 
 
 def test_all_vars():
 	''' Really just prints a bunch of stuff about each var, no actual tests. '''
-	for var, filename in (
-			('air', '/Users/egg/Temp/GriddedData/air.mon.mean.nc'),
-			('prate', '/Users/egg/Temp/GriddedData/prate.sfc.mon.mean.nc',),
-			('rhum', '/Users/egg/Temp/GriddedData/rhum.mon.mean.nc'),
-			('wspd', '/Users/egg/Temp/GriddedData/wspd.mon.mean.nc'),
-		):
+	for var, filename in monthly_sources:
 		_test_var(var, filename)
 
 def test_lon_lat_splitter():
@@ -314,6 +443,240 @@ def test_lon_lat_splitter():
 	test_vals(72, 143, (3, 1))
 	test_vals(37, 73, (2, 1))
 
+test_values_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'test_values')
+
+def _load_test_values(filename):
+	''' Read back a file written by print_data_dict. '''
+	results = {}
+	with open(filename) as f:
+		lines = [line.strip() for line in f if line.strip()]
+	for header, vals in zip(lines[::2], lines[1::2]):
+		octant = tuple(int(x) for x in header.split(':')[1].strip(' ()').split(','))
+		results[octant] = [int(x) for x in vals.strip('[]').split(',')]
+	return results
+
+def _month_hours(first_month, num_months):
+	''' Hours (file time units) for the 1st of num_months consecutive months,
+	first_month being a datetime. '''
+	hours = []
+	for i in range(num_months):
+		months = first_month.month - 1 + i
+		dt = datetime(first_month.year + months // 12, months % 12 + 1, 1)
+		hours.append(from_datetime(dt))
+	return hours
+
+def _write_test_file(filename, var, values, hours, missing_value=None, lats=None, lons=None):
+	''' Write a (time, lon, lat) array out as a small NCEP-style NetCDF file,
+	with lat/lon coordinate variables if they're given. '''
+	f = netcdf.netcdf_file(filename, 'w')
+	f.createDimension('time', len(hours))
+	f.createDimension('lat', values.shape[1])
+	f.createDimension('lon', values.shape[2])
+	for name, coordinates in (('lat', lats), ('lon', lons)):
+		if coordinates is not None:
+			f.createVariable(name, 'f', (name,))[:] = coordinates
+	time = f.createVariable('time', 'd', ('time',))
+	time[:] = hours
+	time.units = 'hours since 1-1-1 00:00:0.0'
+	data = f.createVariable(var, values.dtype.char, ('time', 'lat', 'lon'))
+	data[:] = values
+	if missing_value is not None:
+		data.missing_value = missing_value
+	f.close()
+
+def _fixture_grid(num_months, num_lons=73, num_lats=144, missing_value=None):
+	''' A (time, lon, lat) grid built from the air_values.txt fixture: each cell
+	carries its octant's fixture value (scaled to look like a temperature) plus
+	a cell-dependent wiggle, with a sprinkling of missing cells. '''
+	fixture = _load_test_values(os.path.join(test_values_dir, 'air_values.txt'))
+	lls = LonLatSplitter(num_lons, num_lats)
+	values = numpy.empty((num_months, num_lons, num_lats), dtype=numpy.float32)
+	for lon in range(num_lons):
+		for lat in range(num_lats):
+			series = numpy.array(fixture[lls.split_to_octs(lon, lat)][:num_months])
+			values[:, lon, lat] = series / 1000.0 - 30 + numpy.cos(lon * 0.3 + lat * 0.7)
+	if missing_value is not None:
+		values.reshape(num_months, -1)[:, ::7] = missing_value
+	return values
+
+def test_get_region_series_matches_loop():
+	''' The vectorized reducer should agree with the per-cell loop get_data
+	used to run. '''
+	import shutil, tempfile
+	missing_value = numpy.float32(-9.96921e+36)
+	values = _fixture_grid(30, missing_value=missing_value)
+	hours = _month_hours(datetime(1959, 7, 1), len(values))
+	tmpdir = tempfile.mkdtemp()
+	try:
+		filename = os.path.join(tmpdir, 'air.nc')
+		_write_test_file(filename, 'air', values, hours, missing_value)
+		series = get_region_series('air', filename, runningAve=False)
+	finally:
+		shutil.rmtree(tmpdir)
+
+	# The old loop, verbatim apart from reading from the array directly.
+	oct_splitter = LonLatSplitter(values.shape[1], values.shape[2])
+	expected = {}
+	for time in range(len(values)):
+		if to_datetime(hours[time]) < starttime or to_datetime(hours[time]) >= endtime:
+			continue
+		results_for_t = {}
+		for lon in range(values.shape[1]):
+			for lat in range(values.shape[2]):
+				oct_key = oct_splitter.split_to_octs(lon, lat)
+				value = values[time][lon][lat]
+				if value != missing_value:
+					results_for_t.setdefault(oct_key, []).append(value)
+		for key, vals in results_for_t.items():
+			expected.setdefault(key, []).append(numpy.mean(vals))
+
+	assert sorted(series.keys()) == sorted(expected.keys())
+	for key in expected:
+		assert len(series[key]) == 24, 'Expected 24 months in the window, got %d' % len(series[key])
+		assert numpy.allclose(series[key], expected[key], rtol=1e-6), \
+			'Octant %s: %s does not match loop output %s' % (key, series[key], expected[key])
+	assert normalize_relative(series) == normalize_relative(expected)
+
+def test_get_region_series_running_average():
+	''' The cumulative-sum smoother should match the old
+	numpy.mean(vals[t-12:t]) loop. '''
+	import shutil, tempfile
+	values = _fixture_grid(40, num_lons=9, num_lats=16)
+	hours = _month_hours(datetime(1958, 9, 1), len(values))
+	tmpdir = tempfile.mkdtemp()
+	try:
+		filename = os.path.join(tmpdir, 'air.nc')
+		_write_test_file(filename, 'air', values, hours)
+		smoothed = get_region_series('air', filename, runningAve=True)
+	finally:
+		shutil.rmtree(tmpdir)
+
+	# Unsmoothed means from 1959-01 (record 4) on, then the old loop.
+	reducer = RegionReducer(*LonLatSplitter(9, 16).label_grid())
+	raw = reducer.to_series(reducer.means(*reducer.reduce_block(values[4:])))
+	for octant, vals in raw.items():
+		expected = [numpy.mean(vals[t-12:t]) for t in range(12, len(vals))]
+		assert len(expected) == 24
+		assert numpy.allclose(smoothed[octant], expected, rtol=1e-12), \
+			'Octant %s: %s does not match %s' % (octant, smoothed[octant], expected)
+
+def test_get_data_cached():
+	import shutil, tempfile
+	values = _fixture_grid(36, num_lons=9, num_lats=16)
+	hours = _month_hours(datetime(1959, 1, 1), len(values))
+	tmpdir = tempfile.mkdtemp()
+	try:
+		filename = os.path.join(tmpdir, 'air.nc')
+		_write_test_file(filename, 'air', values, hours)
+		cache = RegionCache(os.path.join(tmpdir, 'cache'))
+		relative = get_data('air', filename, cache=cache)
+		absolute = get_data('air', filename, relative_normalization=False, cache=cache)
+		assert (cache.hits, cache.misses) == (1, 1), 'Second call should be served from the cache'
+		assert relative == get_data('air', filename)
+		assert absolute == get_data('air', filename, relative_normalization=False)
+	finally:
+		shutil.rmtree(tmpdir)
+
+def test_get_all_region_series_parallel():
+	import shutil, tempfile
+	global parallel_chunk_records
+	tmpdir = tempfile.mkdtemp()
+	old_chunk_records = parallel_chunk_records
+	try:
+		sources = []
+		for i, var in enumerate(('air', 'rhum', 'wspd')):
+			values = _fixture_grid(48, num_lons=9 + i, num_lats=16)
+			filename = os.path.join(tmpdir, var + '.nc')
+			_write_test_file(filename, var, values[:, :, ::-1] + i, _month_hours(datetime(1958, 1, 1), len(values)))
+			sources.append((var, filename))
+		serial = get_all_region_series(sources)
+		parallel_chunk_records = 7
+		parallel = get_all_region_series(sources, workers=3)
+	finally:
+		parallel_chunk_records = old_chunk_records
+		shutil.rmtree(tmpdir)
+	for var, filename in sources:
+		for octant in serial[var]:
+			assert numpy.array_equal(serial[var][octant], parallel[var][octant]), \
+				'%s %s: parallel output differs from serial' % (var, octant)
+
+def test_get_region_series_across_grids():
+	''' With coordinates in the files, prate's Gaussian grid and air's regular
+	grid should agree on a field that only depends on position. '''
+	import shutil, tempfile
+	tmpdir = tempfile.mkdtemp()
+	try:
+		series = []
+		for lats, lons in ((regrid.regular_lats(73), regrid.regular_lons(144)),
+						   (regrid.gaussian_lats(94), regrid.regular_lons(192))):
+			lat_grid, lon_grid = numpy.meshgrid(lats, lons, indexing='ij')
+			field = 20 * numpy.cos(numpy.radians(lat_grid)) + numpy.sin(numpy.radians(lon_grid))
+			values = numpy.array([field + month for month in range(3)], dtype=numpy.float32)
+			filename = os.path.join(tmpdir, '%d.nc' % len(lats))
+			_write_test_file(filename, 'air', values, _month_hours(starttime, 3), lats=lats, lons=lons)
+			series.append(get_region_series('air', filename, runningAve=False))
+	finally:
+		shutil.rmtree(tmpdir)
+	for octant in LonLatSplitter.keys():
+		assert numpy.allclose(series[0][octant], series[1][octant], rtol=0.005), \
+			'Octant %s: %s vs %s' % (octant, series[0][octant], series[1][octant])
+
+def test_get_region_series_custom_regions():
+	import json, shutil, tempfile
+	global region_definitions
+	lats = regrid.regular_lats(13)
+	lons = regrid.regular_lons(24)
+	values = _fixture_grid(3, num_lons=13, num_lats=24)
+	tmpdir = tempfile.mkdtemp()
+	old_definitions = region_definitions
+	try:
+		filename = os.path.join(tmpdir, 'air.nc')
+		_write_test_file(filename, 'air', values, _month_hours(starttime, 3), lats=lats, lons=lons)
+		region_definitions = os.path.join(tmpdir, 'regions.json')
+		with open(region_definitions, 'w') as f:
+			json.dump({'regions': [{'key': 'tropics', 'lat': [-30, 30]},
+								   {'key': 'north', 'lat': [30, 90], 'lon': [90, 270]}]}, f)
+		series = get_region_series('air', filename, runningAve=False)
+		assert region_keys() == ['tropics', 'north']
+	finally:
+		region_definitions = old_definitions
+		shutil.rmtree(tmpdir)
+	lat_grid, lon_grid = numpy.meshgrid(lats, lons, indexing='ij')
+	tropics = (lat_grid >= -30) & (lat_grid < 30)
+	north = (lat_grid >= 30) & (lon_grid >= 90) & (lon_grid < 270)
+	# Weighted by cell area, as region_weighting = 'area' has it.
+	areas = regrid.cell_areas(lats, lons)
+	assert sorted(series) == ['north', 'tropics']
+	for key, cells in (('tropics', tropics), ('north', north)):
+		expected = (values[:, cells] * areas[cells]).sum(axis=1) / areas[cells].sum()
+		assert numpy.allclose(series[key], expected), key
+		assert not numpy.allclose(series[key], values[:, cells].mean(axis=1)), key
+
+def test_get_all_region_series_statistics():
+	import shutil, tempfile
+	values = _fixture_grid(14, num_lons=9, num_lats=16).astype(float) + 273.15
+	tmpdir = tempfile.mkdtemp()
+	try:
+		filename = os.path.join(tmpdir, 'air.nc')
+		_write_test_file(filename, 'air', values, _month_hours(starttime, len(values)))
+		cache = RegionCache(os.path.join(tmpdir, 'cache'))
+		series = get_all_region_series([('air', filename)], runningAve=False, cache=cache,
+									   statistics=('std', 'min', 'max'))
+		plain = get_region_series('air', filename, runningAve=False)
+		cached = get_all_region_series([('air', filename)], runningAve=False, cache=cache,
+									   statistics=('std', 'min', 'max'))
+	finally:
+		shutil.rmtree(tmpdir)
+	assert sorted(series) == ['air', 'air_max', 'air_min', 'air_std']
+	assert cached == series and cache.hits == 4
+	labels, keys = LonLatSplitter(9, 16).label_grid()
+	for i, octant in enumerate(keys):
+		cells = values[:, labels == i]
+		assert numpy.allclose(series['air'][octant], plain[octant], rtol=1e-12)
+		assert numpy.allclose(series['air_std'][octant], cells.std(axis=1))
+		assert series['air_min'][octant] == cells.min(axis=1).tolist()
+		assert series['air_max'][octant] == cells.max(axis=1).tolist()
+
 def get_data_for_amos():
 	data = get_data('air', '/Users/egg/Temp/GriddedData/air.mon.mean.nc')
 	print_data_dict(data)
@@ -328,6 +691,23 @@ def print_data_list(data):
 	 dicts from variable to list of values over time. '''
 	print data
 
+def write_data_list(filename, data):
+	''' Writes get_all_data's output in the binary format (see export.py)
+	instead of printing it, or as a MIDI file of CCs (see midi.py) if
+	filename ends in .mid. '''
+	# get_all_data normalizes every variable relatively, onto 0..255.
+	ranges = dict((var, (0, 255)) for var in (data[0] if data else ()))
+	if filename.lower().endswith('.mid'):
+		midi.write(filename, data, ranges=ranges, region_names=[str(key) for key in region_keys()])
+		return
+	export.write(filename, data, region_keys=region_keys(),
+				 times=get_record_times(monthly_sources[0][1]), ranges=ranges)
+
 if __name__ == '__main__':
-	normalized_results = get_all_data()
-	print_data_list(normalized_results)
+	# python parser.py [output file]: print the data, or write it out in
+	# binary (or as MIDI, for a .mid file).
+	normalized_results = get_all_data(cache=RegionCache())
+	if len(sys.argv) > 1:
+		write_data_list(sys.argv[1], normalized_results)
+	else:
+		print_data_list(normalized_results)
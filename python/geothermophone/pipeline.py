@@ -0,0 +1,604 @@
+'''
+get_data as a chain of stages, configured from a declarative spec:
+
+	Read -> Reduce -> Smooth -> Normalize -> Emit
+
+Each stage is an object whose stream() consumes and yields chunks of
+consecutive records, so a variable's grids are only ever in memory a block at
+a time, however long the record is:
+	Read       yields (start, raw block, packing), as Dataset.blocks does;
+	           start is the block's first record in the source's time axis
+	Reduce     yields (start, channels): channels is a dict from channel name
+	           (see parser.channel_name) to a (time, region) array
+	Smooth     running average over the previous window records, keeping a
+	           window's worth of records between chunks
+	Normalize  scales channels onto integer control ranges, by min and max,
+	           percentiles or histogram equalization (see normalize.py)
+	Emit       writes chunks into an export.py file as they pass through
+Normalize is the one stage that has to see everything before yielding
+anything, since the range comes from the whole series. What it holds is the
+reduced series (records x regions), never the grids.
+
+A spec is a dict (or a JSON file of one, see load):
+	{"variables": [{"name": "air", "path": "air.mon.mean.nc"},
+	               {"name": "t2m", "path": "t2m/*.nc", "window": 1461},
+	               {"name": "prate", "path": "prate.sfc.mon.mean.nc",
+	                "normalization": "absolute"}],
+	 "start": "1960-01-01", "end": "2010-01-01",
+	 "regions": "regions.json",
+	 "statistics": ["std"],
+	 "smoothing": "boxcar", "window": 12,
+	 "normalization": "relative",
+	 "outputs": ["data.gtp", "data.mid"]}
+Everything but variables is optional (see defaults). Variables may override
+any of variable_settings. A path is a file, a directory or a glob (see
+dataset.py). regions is a regions.py JSON file, the dict one holds, or a
+regions.Regions; without it, parser.py's regions are used. smoothing and
+normalization may be null to leave the series as they are. Paths in a JSON
+spec are relative to it.
+
+parser.get_data, get_all_region_series and get_all_data are presets of this.
+
+With instruments (an instrument.Instruments), every stage's chunks are timed
+and counted on their way through.
+'''
+from datetime import datetime
+import json
+import os
+import numpy
+from cache import RegionCache, file_signature
+from dataset import Dataset
+import export
+import instrument
+import midi
+import normalize
+import parser
+from quantiles import ColumnSketches
+from reducer import RegionStats
+import reducer
+import regions
+import smoothing
+import timeaxis
+
+defaults = {
+	'start': None, # parser.starttime
+	'end': None, # parser.endtime
+	'regions': None,
+	'statistics': [],
+	'smoothing': 'boxcar',
+	'window': 12,
+	'normalization': 'relative',
+	'range': None, # 0..255 for relative normalizations, 0..65535 for absolute
+	'percentiles': list(normalize.default_percentiles), # for the *_percentile normalizations
+	'block_size': reducer.default_block_size,
+	'outputs': [],
+}
+variable_settings = ('statistics', 'smoothing', 'window', 'normalization', 'range', 'percentiles')
+normalizations = ('relative', 'absolute', 'relative_percentile', 'absolute_percentile',
+				  'relative_equalized', 'absolute_equalized')
+default_ranges = {'relative': (0, 255), 'absolute': (0, 65535)}
+
+def _isoformat(date):
+	return timeaxis.to_datetime64(date).astype(datetime).isoformat()
+
+class Read(object):
+	''' Raw records of one variable from start (less lead_in records, to feed
+	a running average) up to end, or to the last record if end is None. '''
+	def __init__(self, var, path, start, end, lead_in=0, block_size=reducer.default_block_size):
+		self.var = var
+		self.dataset = Dataset(var, path)
+		first, self.last = parser.time_window(self.dataset.hours, start, end or datetime.max)
+		self.first = max(first - lead_in, 0)
+		self.block_size = block_size
+
+	def __len__(self):
+		return self.last - self.first
+
+	def stream(self):
+		return self.dataset.blocks(self.first, self.last, self.block_size)
+
+class Reduce(object):
+	''' Raw chunks to region channels: the variable's mean, plus one channel
+	per statistic (see RegionStats) from the same pass over each block. '''
+	def __init__(self, var, reducer, statistics=('mean',)):
+		self.var = var
+		self.reducer = reducer
+		self.statistics = list(statistics)
+
+	def channels(self, reduced):
+		''' The channels of a reduce_block (or reduce_block_stats) result. '''
+		if isinstance(reduced, RegionStats):
+			return dict((parser.channel_name(self.var, statistic), reduced.channel(statistic))
+						for statistic in self.statistics)
+		return {self.var: self.reducer.means(*reduced)}
+
+	def reduce(self, block, packing=None):
+		if len(self.statistics) > 1:
+			return self.reducer.reduce_block_stats(block, packing=packing)
+		return self.reducer.reduce_block(block, packing=packing)
+
+	def stream(self, chunks):
+		for start, block, packing in chunks:
+			reduced = self.reduce(block, packing)
+			# Let go of the block (which may point into an mmap) before yielding.
+			block = None
+			yield (start, self.channels(reduced))
+
+def rechunk(chunks, size):
+	''' The same records in chunks of exactly size (bar the last). '''
+	pending = []
+	pending_start = None
+	for start, channels in chunks:
+		if pending_start is None:
+			pending_start = start
+		pending.append(channels)
+		length = sum(len(next(iter(part.values()))) for part in pending)
+		if length < size:
+			continue
+		joined = dict((name, numpy.concatenate([part[name] for part in pending])) for name in pending[0])
+		for offset in range(0, length - size + 1, size):
+			yield (pending_start + offset, dict((name, values[offset:offset + size]) for name, values in joined.items()))
+		rest = length // size * size
+		pending = [dict((name, values[rest:]) for name, values in joined.items())] if rest < length else []
+		pending_start = pending_start + rest if pending else None
+	if pending:
+		yield (pending_start, dict((name, numpy.concatenate([part[name] for part in pending])) for name in pending[0]))
+
+class Smooth(object):
+	''' Running average over the *previous* window records: the output at
+	record t averages records t-window..t-1. So the stream's first window
+	records only feed the average, and the last full window (ending on the
+	last record) isn't used, as get_region_series has always done.
+
+	Records are smoothed block_size at a time whatever chunks they come in,
+	so the results don't depend on how the reducing was split up.
+
+	All it carries between chunks is in tails and seen (records so far), so a
+	later stream can carry on where this one stopped (see incremental.py):
+	for each channel, the last window records for the boxcar kernel, or
+	(filter state, last valid record) for the exponential one. '''
+	def __init__(self, window=12, kernel='boxcar', block_size=reducer.default_block_size, tails=None, seen=0):
+		assert kernel in smoothing.kernels, 'Unknown kernel %r (expected one of %s)' % (kernel, smoothing.kernels)
+		self.window = window
+		self.kernel = kernel
+		self.block_size = block_size
+		self.tails = dict(tails or {})
+		self.seen = seen
+
+	def _boxcar(self, name, values):
+		# Each chunk is averaged with the window's worth of records before it,
+		# by the same cumulative sums as the whole series would be.
+		values = numpy.concatenate((self.tails.get(name, values[:0]), values))
+		self.tails[name] = values[-self.window:]
+		return smoothing.running_mean(values, self.window)[:-1]
+
+	def _exponential(self, name, values):
+		# As smoothing.RunningSmoother, emitting the state before each record.
+		alpha = 2.0 / (self.window + 1)
+		state, last = self.tails.get(name, (numpy.full(values.shape[1], numpy.nan),) * 2)
+		smoothed = []
+		for i, row in enumerate(values):
+			if self.seen + i >= self.window:
+				smoothed.append(state)
+			last = numpy.where(numpy.isnan(row), last, row)
+			state = numpy.where(numpy.isnan(state), last, state + alpha * (last - state))
+		self.tails[name] = (state, last)
+		return numpy.array(smoothed).reshape(-1, values.shape[1])
+
+	def stream(self, chunks):
+		for start, channels in rechunk(chunks, self.block_size):
+			length = len(next(iter(channels.values())))
+			if self.kernel == 'boxcar':
+				smoothed = dict((name, self._boxcar(name, values)) for name, values in channels.items())
+			else:
+				smoothed = dict((name, self._exponential(name, values)) for name, values in channels.items())
+			skip = max(self.window - self.seen, 0)
+			self.seen += length
+			if skip < length:
+				yield (start + skip, smoothed)
+
+class Normalize(object):
+	''' Scale each channel onto new_min..new_max. relative normalizations
+	take each region on its own and absolute ones all regions together, as
+	parser.normalize_relative and normalize_absolute do:
+		relative, absolute    by min and max
+		*_percentile          between the given percentiles, clipping beyond
+		*_equalized           histogram equalization
+	The percentiles come from quantiles.py sketches, built from the chunks in
+	the same pass as the min and max would be. '''
+	def __init__(self, kind='relative', new_min=None, new_max=None, percentiles=normalize.default_percentiles):
+		assert kind in normalizations, 'Unknown normalization %r (expected one of %s)' % (kind, normalizations)
+		self.kind = kind
+		self.absolute = kind.startswith('absolute')
+		self.method = kind.split('_')[1] if '_' in kind else 'min_max'
+		self.percentiles = tuple(percentiles)
+		default_min, default_max = default_ranges[kind.split('_')[0]]
+		self.new_min = default_min if new_min is None else new_min
+		self.new_max = default_max if new_max is None else new_max
+
+	def summarize(self, values, summary=None):
+		''' Fold values into the summary the scaling comes from, which is
+		(low, high) for min/max scaling and a quantiles.ColumnSketches
+		otherwise. Sketches are updated in place. '''
+		if self.method != 'min_max':
+			if summary is None:
+				summary = ColumnSketches(1 if self.absolute else values.shape[1])
+			return summary.update(values)
+		if self.absolute:
+			values_low, values_high = normalize.absolute_min_max(values)
+		else:
+			values_low, values_high = normalize.channel_min_max(values)
+		if summary is None:
+			return (values_low, values_high)
+		return (numpy.fmin(summary[0], values_low), numpy.fmax(summary[1], values_high))
+
+	def bounds(self, summary):
+		''' What a summary scales values by: (low, high), or for equalization,
+		the sketched percentiles. '''
+		if self.method == 'min_max':
+			return summary
+		if self.method == 'percentile':
+			return normalize.percentile_bounds(summary, *self.percentiles)
+		return (summary.quantiles(numpy.linspace(0, 1, 101)),)
+
+	def scale(self, values, summary):
+		if self.method == 'equalized':
+			scaled = normalize.equalize(values, summary, self.new_min, self.new_max)
+		else:
+			low, high = self.bounds(summary)
+			scaled = normalize.scale(values, low, high, self.new_min, self.new_max)
+		return normalize.to_integers(scaled, self.new_min, self.new_max)
+
+	def summary_arrays(self, summary):
+		''' A summary as a list of arrays, for storing (see incremental.py). '''
+		if self.method == 'min_max':
+			return [numpy.asarray(bound) for bound in summary]
+		return [summary.to_array()]
+
+	def summary_from_arrays(self, arrays):
+		if self.method == 'min_max':
+			return tuple(arrays)
+		return ColumnSketches.from_array(arrays[0])
+
+	def stream(self, chunks):
+		chunks = list(chunks)
+		summaries = {}
+		for start, channels in chunks:
+			for name, values in channels.items():
+				summaries[name] = self.summarize(values, summaries.get(name))
+		for i, (start, channels) in enumerate(chunks):
+			chunks[i] = None
+			yield (start, dict((name, self.scale(values, summaries[name])) for name, values in channels.items()))
+
+class Emit(object):
+	''' Write chunks into an export.py file as they pass through. The file is
+	laid out up front for num_samples records, so nothing accumulates here. '''
+	def __init__(self, filename, channels, region_keys, num_samples, ranges=None, times=None):
+		self.file = export.create(filename, channels, region_keys, num_samples,
+								  times=times is not None, ranges=ranges)
+		if times is not None:
+			self.file.times[:] = times
+
+	def stream(self, chunks, first=0):
+		''' first is the record the file's first sample comes from. '''
+		for start, channels in chunks:
+			offset = start - first
+			for name, values in channels.items():
+				self.file.series(name)[:, offset:offset + len(values)] = values.T
+			yield (start, channels)
+
+	def close(self):
+		self.file.close()
+
+class Pipeline(object):
+	''' The stages for each variable of a spec. '''
+	def __init__(self, spec, directory=None, instruments=None):
+		''' directory is where relative paths in the spec are looked for. '''
+		unknown = set(spec) - set(defaults) - set(['variables'])
+		assert not unknown, 'Unknown settings %s (expected some of %s)' % (sorted(unknown), sorted(defaults))
+		self.directory = directory
+		self.spec = dict(defaults)
+		self.spec.update(spec)
+		self.start = parser.starttime if self.spec['start'] is None else self.spec['start']
+		self.end = parser.endtime if self.spec['end'] is None else self.spec['end']
+		self.regions = self._regions(self.spec['regions'])
+		self.variables = [self._variable(variable) for variable in self.spec['variables']]
+		names = [variable['name'] for variable in self.variables]
+		assert len(set(names)) == len(names), 'Variable names must be unique'
+		self.outputs = [self._path(output) for output in self.spec['outputs']]
+		self._reads = {}
+		self.instruments = instruments
+
+	def _path(self, path):
+		return os.path.join(self.directory or '', path)
+
+	def _regions(self, spec):
+		if isinstance(spec, basestring):
+			return regions.load(self._path(spec))
+		if isinstance(spec, dict):
+			return regions.parse(spec, self.directory)
+		return spec
+
+	def _variable(self, spec):
+		if isinstance(spec, (list, tuple)):
+			spec = {'name': spec[0], 'path': spec[1]}
+		unknown = set(spec) - set(variable_settings) - set(['name', 'path'])
+		assert not unknown, 'Variable %s has unknown settings %s' % (spec.get('name'), sorted(unknown))
+		variable = dict((name, self.spec[name]) for name in variable_settings)
+		variable.update(spec)
+		variable['path'] = self._path(variable['path'])
+		variable['statistics'] = ['mean'] + [statistic for statistic in variable['statistics'] if statistic != 'mean']
+		assert variable['normalization'] in normalizations + (None,), \
+			'Unknown normalization %r (expected one of %s)' % (variable['normalization'], normalizations)
+		return variable
+
+	def channels(self, variable):
+		''' Names of a variable's channels, the mean first. '''
+		return [parser.channel_name(variable['name'], statistic) for statistic in variable['statistics']]
+
+	def keys(self):
+		''' Region keys, in column order. '''
+		if self.regions is not None:
+			return self.regions.keys()
+		return parser.region_keys()
+
+	def layout(self):
+		if self.regions is not None:
+			return self.regions.layout() + [parser.region_weighting]
+		return parser.region_layout()
+
+	def read(self, variable):
+		''' The Read stage for a variable (opening its files once). '''
+		if variable['name'] not in self._reads:
+			lead_in = variable['window'] if variable['smoothing'] else 0
+			self._reads[variable['name']] = Read(variable['name'], variable['path'], self.start, self.end,
+												 lead_in, self.spec['block_size'])
+		return self._reads[variable['name']]
+
+	def output_window(self, variable):
+		''' (first, last): the records the variable's output covers. '''
+		read = self.read(variable)
+		if variable['smoothing']:
+			return (min(read.first + variable['window'], read.last), read.last)
+		return (read.first, read.last)
+
+	def _reducer(self, read):
+		dataset = read.dataset
+		region_reducer = parser.make_octant_reducer(dataset.grid_shape, dataset.lats, dataset.lons, self.regions)
+		assert region_reducer.keys == self.keys(), 'Reducer regions are out of order'
+		return region_reducer
+
+	def _cache_keys(self, cache, variable):
+		dataset = self.read(variable).dataset
+		params = {'var': variable['name'], 'layout': self.layout(), 'start': _isoformat(self.start),
+				  'end': _isoformat(self.end), 'runningAve': bool(variable['smoothing']), 'window': variable['window']}
+		if variable['smoothing'] not in (None, 'boxcar'):
+			params['kernel'] = variable['smoothing']
+		if len(dataset.filenames) > 1:
+			params['files'] = [[os.path.abspath(filename), file_signature(filename, cache.hash_contents)]
+							   for filename in dataset.filenames[1:]]
+		keys = {}
+		for statistic, name in zip(variable['statistics'], self.channels(variable)):
+			statistic_params = {'statistic': statistic} if statistic != 'mean' else {}
+			statistic_params.update(params)
+			keys[name] = cache.make_key(dataset.filenames[0], **statistic_params)
+		return keys
+
+	def _cached(self, variable, series):
+		first, last = self.output_window(variable)
+		channels = dict((name, numpy.array([series[name][key] for key in self.keys()], dtype=float).T
+						 .reshape(-1, len(self.keys()))) for name in series)
+		if len(next(iter(channels.values()))):
+			yield (first, channels)
+
+	def _store(self, chunks, cache, cache_keys):
+		parts = []
+		for chunk in chunks:
+			parts.append(chunk[1])
+			yield chunk
+		for name, key in cache_keys.items():
+			values = numpy.concatenate([part[name] for part in parts]) if parts else numpy.zeros((0, len(self.keys())))
+			cache.put(key, self.to_series(values))
+
+	def _jobs(self, variable):
+		''' parser.reduce_records jobs covering the variable's records, in
+		parser.parallel_chunk_records chunks within each file, with the record
+		index each starts at. '''
+		read = self.read(variable)
+		jobs = []
+		file_start = 0
+		for filename, length in zip(read.dataset.filenames, read.dataset.file_lengths):
+			start, stop = max(read.first, file_start), min(read.last, file_start + length)
+			for chunk_start in range(start, stop, parser.parallel_chunk_records):
+				chunk_stop = min(chunk_start + parser.parallel_chunk_records, stop)
+				jobs.append((chunk_start, (variable['name'], filename, chunk_start - file_start, chunk_stop - file_start,
+										   len(variable['statistics']) > 1, self.regions)))
+			file_start += length
+		return jobs
+
+	def _instrumented(self, stage, variable, chunks, **options):
+		if self.instruments is None:
+			return chunks
+		return self.instruments.stage(stage, variable['name'], chunks, **options)
+
+	def _reduced(self, starts, results, reduce_stage):
+		for start, reduced in zip(starts, results):
+			yield (start, reduce_stage.channels(reduced))
+
+	def streams(self, cache=None, workers=None, normalized=True):
+		''' Yield (variable, chunks) for each variable, chunks coming out of
+		its last stage. With a cache (a RegionCache), smoothed series are looked
+		up there first and stored there afterwards (once chunks is used up).
+		With workers > 1, every variable that isn't cached is reduced up front
+		in a pool of worker processes, chunks of each variable's records in
+		parallel; the results are exactly the same as streaming. '''
+		plans = []
+		jobs = []
+		for variable in self.variables:
+			cache_keys = None
+			if cache is not None:
+				cache_keys = self._cache_keys(cache, variable)
+				cached = [cache.get(cache_keys[name]) for name in self.channels(variable)]
+				if all(series is not None for series in cached):
+					chunks = self._cached(variable, dict(zip(self.channels(variable), cached)))
+					plans.append((variable, self._instrumented('cache', variable, chunks), None, None, None))
+					continue
+			reduce_stage = Reduce(variable['name'], self._reducer(self.read(variable)), variable['statistics'])
+			starts = None
+			if workers and workers > 1:
+				variable_jobs = self._jobs(variable)
+				jobs.extend(job for (start, job) in variable_jobs)
+				starts = [start for (start, job) in variable_jobs]
+			plans.append((variable, None, cache_keys, reduce_stage, starts))
+
+		if self.instruments is not None and jobs:
+			results = iter(self.instruments.call('pool', None, parser._run_reduce_jobs, jobs, workers))
+		else:
+			results = iter(parser._run_reduce_jobs(jobs, workers))
+		for variable, chunks, cache_keys, reduce_stage, starts in plans:
+			if chunks is None:
+				if starts is None:
+					chunks = self._instrumented('read', variable, self.read(variable).stream(),
+												measure=instrument.measure_block, measure_inside=True)
+					chunks = reduce_stage.stream(chunks)
+				else:
+					chunks = self._reduced(starts, [next(results) for start in starts], reduce_stage)
+				chunks = self._instrumented('reduce', variable, chunks)
+				if variable['smoothing']:
+					chunks = Smooth(variable['window'], variable['smoothing'], self.spec['block_size']).stream(chunks)
+					chunks = self._instrumented('smooth', variable, chunks)
+				if cache_keys is not None:
+					chunks = self._store(chunks, cache, cache_keys)
+			if normalized and variable['normalization']:
+				new_min, new_max = variable['range'] or (None, None)
+				chunks = Normalize(variable['normalization'], new_min, new_max, variable['percentiles']).stream(chunks)
+				chunks = self._instrumented('normalize', variable, chunks)
+			yield (variable, chunks)
+
+	def to_series(self, values):
+		''' A (time, region) array as a {region key: list} dict. '''
+		return dict((key, values[:, i].tolist()) for i, key in enumerate(self.keys()))
+
+	def _collect(self, variable, chunks):
+		parts = dict((name, []) for name in self.channels(variable))
+		for start, channels in chunks:
+			for name, values in channels.items():
+				parts[name].append(values)
+		return dict((name, self.to_series(numpy.concatenate(values) if values else numpy.zeros((0, len(self.keys())))))
+					for name, values in parts.items())
+
+	def series(self, cache=None, workers=None, normalized=True):
+		''' Run every variable through, returning a dict from channel name to
+		its {region key: list of values} series. '''
+		results = {}
+		for variable, chunks in self.streams(cache, workers, normalized):
+			results.update(self._collect(variable, chunks))
+		return results
+
+	def _data(self, series):
+		return [dict((name, series[name][key]) for name in series) for key in self.keys()]
+
+	def data(self, cache=None, workers=None):
+		''' The normalized series in get_all_data's structure: a list, per
+		region, of dicts from channel to a list of values. '''
+		return self._data(self.series(cache, workers))
+
+	def ranges(self):
+		''' Dict from each normalized channel to the range it's scaled onto. '''
+		ranges = {}
+		for variable in self.variables:
+			if variable['normalization']:
+				new_range = variable['range'] or default_ranges[variable['normalization'].split('_')[0]]
+				ranges.update((name, tuple(new_range)) for name in self.channels(variable))
+		return ranges
+
+	def run(self, cache=None, workers=None):
+		''' Run every variable through, writing the spec's outputs: export.py
+		files chunk by chunk, MIDI files (which midi.py encodes whole) from the
+		collected data. '''
+		windows = dict((variable['name'], self.output_window(variable)) for variable in self.variables)
+		lengths = set(last - first for (first, last) in windows.values())
+		assert len(lengths) <= 1, 'Variables cover different numbers of records: %s' % windows
+		midi_outputs = [output for output in self.outputs if output.lower().endswith('.mid')]
+		emitters = []
+		series = {}
+		try:
+			if self.variables:
+				first, last = windows[self.variables[0]['name']]
+				times = self.read(self.variables[0]).dataset.hours[first:last]
+				channels = [name for variable in self.variables for name in self.channels(variable)]
+				emitters = [Emit(output, channels, self.keys(), last - first, self.ranges(), times)
+							for output in self.outputs if output not in midi_outputs]
+			for variable, chunks in self.streams(cache, workers):
+				for emitter in emitters:
+					chunks = self._instrumented('emit', variable, emitter.stream(chunks, windows[variable['name']][0]))
+				if midi_outputs:
+					series.update(self._collect(variable, chunks))
+				else:
+					for chunk in chunks:
+						pass
+		finally:
+			for emitter in emitters:
+				emitter.close()
+		for output in midi_outputs:
+			midi.write(output, self._data(series), ranges=self.ranges(),
+					   region_names=[str(key) for key in self.keys()])
+
+def load(filename):
+	''' A Pipeline from a JSON spec file. '''
+	with open(filename) as f:
+		spec = json.load(f)
+	return Pipeline(spec, directory=os.path.dirname(os.path.abspath(filename)))
+
+def test_pipeline_stages():
+	import shutil, tempfile
+	from reducer import RegionReducer
+	values = parser._fixture_grid(40, num_lons=9, num_lats=16)
+	hours = parser._month_hours(datetime(1958, 9, 1), len(values))
+	tmpdir = tempfile.mkdtemp()
+	try:
+		filename = os.path.join(tmpdir, 'air.nc')
+		parser._write_test_file(filename, 'air', values, hours)
+		spec = {'variables': [{'name': 'air', 'path': 'air.nc'}], 'normalization': None, 'block_size': 5,
+				'statistics': ['max'], 'outputs': ['out.gtp']}
+		with open(os.path.join(tmpdir, 'spec.json'), 'w') as f:
+			json.dump(spec, f)
+		pipeline = load(os.path.join(tmpdir, 'spec.json'))
+		# Read five records at a time, then smooth over the previous twelve.
+		chunks = list(Reduce('air', pipeline._reducer(pipeline.read(pipeline.variables[0])), ['mean', 'max'])
+					  .stream(pipeline.read(pipeline.variables[0]).stream()))
+		# 1960 starts at record 16, so the lead-in starts at record 4.
+		assert [start for start, channels in chunks] == list(range(4, 40, 5))
+		smoothed = list(Smooth(12, block_size=5).stream(chunks))
+		assert [start for start, channels in smoothed] == [16, 19, 24, 29, 34, 39]
+		series = pipeline.series()
+		exponential = Pipeline(dict(spec, smoothing='exponential', outputs=[]), tmpdir).series()
+		normalized = Pipeline(dict(spec, normalization='relative', outputs=[]), tmpdir).data()
+		equalized = Pipeline(dict(spec, normalization='absolute_equalized', outputs=[]), tmpdir).series()
+		pipeline.run()
+		written = export.load(os.path.join(tmpdir, 'out.gtp'))
+		assert written.variables == ['air', 'air_max'] and written.ranges == {}
+		assert numpy.array_equal(written.series('air'), [series['air'][key] for key in pipeline.keys()])
+		assert numpy.allclose(written.times, hours[16:])
+		written.close()
+	finally:
+		shutil.rmtree(tmpdir)
+
+	# The same as smoothing the whole record at once.
+	reducer = RegionReducer(*parser.LonLatSplitter(9, 16).label_grid())
+	means = reducer.means(*reducer.reduce_block(values[4:]))
+	expected = reducer.to_series(smoothing.smooth(means, 12)[:-1])
+	expected_exponential = reducer.to_series(smoothing.smooth(means, 12, 'exponential', 'trailing')[11:-1])
+	for key in reducer.keys:
+		assert numpy.allclose(series['air'][key], expected[key], rtol=1e-12), key
+		assert numpy.allclose(exponential['air'][key], expected_exponential[key], rtol=1e-12), key
+	assert len(series['air_max'][(0, 0)]) == 24
+	assert normalized[0]['air'] == parser.normalize_relative(series['air'])[(0, 0)]
+	keys, values = normalize.series_to_array(series['air'])
+	assert normalize.series_to_array(equalized['air'])[1].tolist() == \
+		normalize.normalize_equalized(values, new_max=65535, absolute=True).tolist()
+
+if __name__ == '__main__':
+	# python pipeline.py spec.json: run a spec, writing its outputs.
+	import sys
+	load(sys.argv[1]).run(cache=RegionCache())
@@ -0,0 +1,338 @@
+'''
+Real-time playback of get_all_data's output as control messages, for running
+the installation live.
+
+A Player steps through the samples at a fixed rate and hands each tick's
+messages to a sink. Every tick has an absolute deadline (start + tick / rate),
+so a late wake-up doesn't push the rest of the piece back the way sleeping
+for a fixed period would. If we do fall behind, every tick whose deadline has
+passed goes out to the sink in one batch.
+
+Only values that changed since the previous tick are sent. A message is a
+(region index, variable, value) tuple.
+
+Sinks:
+	MemorySink -- keeps everything it's sent, for tests
+	UdpSink    -- one OSC bundle per batch, with a message per value at
+	              /geothermophone/<region>/<variable>
+	MidiSink   -- CCs to a MIDI output port, mapped the same way as midi.py
+	              (needs python-rtmidi)
+
+Timing is recorded per tick in a TimingStats: how late each tick went out,
+a histogram of that lateness, and the jitter between successive sends.
+
+The player is a deadline-driven loop on absolute times, run in the caller's
+thread or on one of its own: it sleeps until just before each deadline, then
+spins for the last millisecond (spin) so the send lands on time.
+'''
+import socket
+import struct
+import threading
+import time
+import numpy
+
+default_rate = 10.0
+
+# Upper edges of the lateness histogram bins, in seconds.
+lateness_bins = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, float('inf'))
+
+class TimingStats(object):
+	''' Per-tick lateness (seconds after the deadline each tick was sent). '''
+	def __init__(self, period):
+		self.period = period
+		self.deadlines = []
+		self.sent = []
+
+	def record(self, deadline, sent):
+		self.deadlines.append(deadline)
+		self.sent.append(sent)
+
+	def lateness(self):
+		return numpy.array(self.sent) - numpy.array(self.deadlines)
+
+	def histogram(self):
+		''' List of (upper edge in seconds, number of ticks). '''
+		counts = numpy.histogram(self.lateness(), bins=(-float('inf'),) + lateness_bins)[0]
+		return list(zip(lateness_bins, counts.tolist()))
+
+	def jitter(self):
+		''' Standard deviation of the gap between sends, less the period. '''
+		if len(self.sent) < 2:
+			return 0.0
+		return float(numpy.std(numpy.diff(self.sent) - self.period))
+
+	def summary(self):
+		lateness = self.lateness()
+		if not len(lateness):
+			return 'no ticks played'
+		lines = ['ticks: %d' % len(lateness),
+				 'lateness: mean %.3f ms, max %.3f ms' % (lateness.mean() * 1e3, lateness.max() * 1e3),
+				 'jitter: %.3f ms' % (self.jitter() * 1e3)]
+		for edge, count in self.histogram():
+			lines.append('  <= %8s ms: %d' % ('%.1f' % (edge * 1e3) if edge != float('inf') else 'inf', count))
+		return '\n'.join(lines)
+
+class MemorySink(object):
+	''' Keeps every batch it's sent, as (tick indices, messages). '''
+	def __init__(self):
+		self.batches = []
+
+	def send(self, ticks, messages):
+		self.batches.append((list(ticks), list(messages)))
+
+	def close(self):
+		pass
+
+def _osc_string(s):
+	s = s.encode('utf-8') + b'\0'
+	return s + b'\0' * (-len(s) % 4)
+
+def osc_message(address, value):
+	''' An OSC message carrying one int32. '''
+	return _osc_string(address) + _osc_string(',i') + struct.pack('>i', int(value))
+
+def osc_bundle(messages):
+	''' An OSC bundle to be handled immediately (time tag 1). '''
+	parts = [_osc_string('#bundle'), struct.pack('>Q', 1)]
+	for message in messages:
+		parts.append(struct.pack('>i', len(message)))
+		parts.append(message)
+	return b''.join(parts)
+
+def parse_osc_bundle(packet):
+	''' Inverse of osc_bundle for what we send: a list of (address, value). '''
+	messages = []
+	pos = 16
+	while pos < len(packet):
+		(size,) = struct.unpack('>i', packet[pos:pos + 4])
+		message = packet[pos + 4:pos + 4 + size]
+		address = message[:message.index(b'\0')].decode('utf-8')
+		messages.append((address, struct.unpack('>i', message[-4:])[0]))
+		pos += 4 + size
+	return messages
+
+class UdpSink(object):
+	''' Sends each batch as one OSC bundle over UDP. '''
+	def __init__(self, host='127.0.0.1', port=57120, prefix='/geothermophone'):
+		self.address = (host, port)
+		self.prefix = prefix
+		self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+	def send(self, ticks, messages):
+		if messages:
+			self.socket.sendto(osc_bundle([osc_message('%s/%d/%s' % (self.prefix, region, var), value)
+										   for (region, var, value) in messages]), self.address)
+
+	def close(self):
+		self.socket.close()
+
+class MidiSink(object):
+	''' Sends CCs to a MIDI output port: one channel per region and one CC per
+	variable, as in midi.write (7-bit for 0..255 data, 14-bit pairs beyond).
+	Variables without a CC in cc_numbers get the next one from
+	midi.default_first_cc, those in variables up front, the rest as they're
+	first sent; either way midi.check_cc_numbers vets them. '''
+	def __init__(self, port_name=None, cc_numbers=None, ranges=None, variables=()):
+		try:
+			import rtmidi
+		except ImportError:
+			raise ImportError('MidiSink needs python-rtmidi (pip install python-rtmidi)')
+		import midi
+		self.midi = midi
+		self.output = rtmidi.MidiOut()
+		ports = self.output.get_ports()
+		if port_name is None:
+			self.output.open_virtual_port('geothermophone')
+		else:
+			self.output.open_port(ports.index(port_name))
+		self.cc_numbers = dict(cc_numbers or {})
+		self.ranges = ranges or {}
+		self._check()
+		for var in variables:
+			self._cc(var)
+
+	def _check(self):
+		self.midi.check_cc_numbers(self.cc_numbers, [var for var in self.cc_numbers
+													 if self.ranges.get(var, (0, 255))[1] > 255])
+
+	def _cc(self, var):
+		if var not in self.cc_numbers:
+			self.cc_numbers[var] = self.midi.default_first_cc + len(self.cc_numbers)
+			self._check()
+		return self.cc_numbers[var]
+
+	def send(self, ticks, messages):
+		for (region, var, value) in messages:
+			cc = self._cc(var)
+			assert region < self.midi.num_channels, \
+				'Region %d has no MIDI channel of its own (there are only %d)' % (region, self.midi.num_channels)
+			status = self.midi.control_change | region
+			range_max = self.ranges.get(var, (0, 255))[1]
+			if range_max <= 127:
+				self.output.send_message([status, cc, value])
+			elif range_max <= 255:
+				self.output.send_message([status, cc, value * 127 // range_max])
+			else:
+				fine = value * 16383 // range_max
+				self.output.send_message([status, cc, fine >> 7])
+				self.output.send_message([status, cc + 32, fine & 0x7F])
+
+	def close(self):
+		self.output.close_port()
+
+class Player(object):
+	''' Plays data (a list, per region, of dicts from variable to values) to a
+	sink at rate ticks per second. data can also be a controlrate.Renderer,
+	which is played at its own rate and rendered a block at a time as
+	playback reaches it. '''
+	def __init__(self, data, sink, rate=default_rate, spin=0.001, clock=time.time, sleep=time.sleep,
+				 block_size=1024):
+		self.sink = sink
+		self.rate = float(rate)
+		self.spin = spin
+		self.clock = clock
+		self.sleep = sleep
+		self.renderer = None
+		if hasattr(data, 'render'):
+			self.renderer = data
+			self.rate = data.rate
+			self.variables = list(data.variables)
+			self.num_ticks = len(data)
+			self.block_size = block_size
+			self._block = (0, data.render(0, block_size, quantize=True))
+		else:
+			self.variables = sorted(data[0].keys()) if data else []
+			self.num_ticks = min(len(region[var]) for region in data for var in self.variables) if data else 0
+			self.values = dict((var, numpy.array([region[var][:self.num_ticks] for region in data]))
+							   for var in self.variables)
+		self.stats = TimingStats(1.0 / self.rate)
+		self._stopping = threading.Event()
+		self._thread = None
+
+	def _column(self, var, tick):
+		''' Every region's value of var at tick. '''
+		if self.renderer is None:
+			return self.values[var][:, tick]
+		start, block = self._block
+		if not start <= tick < start + block[var].shape[1]:
+			# Start a tick early, so the previous tick is in the block too.
+			start = max(tick - 1, 0)
+			self._block = (start, self.renderer.render(start, start + self.block_size, quantize=True))
+			block = self._block[1]
+		return block[var][:, tick - start]
+
+	def messages(self, tick):
+		''' Messages for tick: every value on the first tick, then changes. '''
+		messages = []
+		for var in self.variables:
+			values = self._column(var, tick)
+			if tick == 0:
+				regions = numpy.arange(len(values))
+			else:
+				regions = numpy.nonzero(values != self._column(var, tick - 1))[0]
+			messages.extend((int(region), var, int(values[region])) for region in regions)
+		return messages
+
+	def play(self):
+		''' Play from the start; returns when done or stopped. '''
+		start = self.clock()
+		tick = 0
+		while tick < self.num_ticks and not self._stopping.is_set():
+			deadline = start + tick / self.rate
+			remaining = deadline - self.clock()
+			if remaining > self.spin:
+				self.sleep(remaining - self.spin)
+			while self.clock() < deadline:
+				pass
+			# Everything due by now goes out together.
+			now = self.clock()
+			due = [tick]
+			while due[-1] + 1 < self.num_ticks and start + (due[-1] + 1) / self.rate <= now:
+				due.append(due[-1] + 1)
+			messages = []
+			for t in due:
+				messages.extend(self.messages(t))
+			self.sink.send(due, messages)
+			sent = self.clock()
+			for t in due:
+				self.stats.record(start + t / self.rate, sent)
+			tick = due[-1] + 1
+		return self.stats
+
+	def start(self):
+		''' Play on a background thread. '''
+		self._stopping.clear()
+		self._thread = threading.Thread(target=self.play)
+		self._thread.daemon = True
+		self._thread.start()
+
+	def stop(self):
+		self._stopping.set()
+		if self._thread is not None:
+			self._thread.join()
+			self._thread = None
+
+def test_player_batches_late_ticks():
+	# A fake clock that wakes up 2.5 ticks late once, at tick 3.
+	now = [0.0]
+	def clock():
+		return now[0]
+	def sleep(seconds):
+		now[0] += seconds + (0.25 if abs(now[0] + seconds - 0.3) < 1e-9 else 0.0)
+	data = [{'air': [0, 1, 1, 2, 3, 4, 5], 'wspd': [9, 9, 9, 9, 9, 9, 8]}]
+	sink = MemorySink()
+	stats = Player(data, sink, rate=10, spin=0, clock=clock, sleep=sleep).play()
+	assert [ticks for ticks, messages in sink.batches] == [[0], [1], [2], [3, 4, 5], [6]]
+	assert sink.batches[0][1] == [(0, 'air', 0), (0, 'wspd', 9)]
+	assert sink.batches[3][1] == [(0, 'air', 2), (0, 'air', 3), (0, 'air', 4)]
+	assert sink.batches[4][1] == [(0, 'air', 5), (0, 'wspd', 8)]
+	lateness = stats.lateness()
+	assert numpy.allclose(lateness, [0, 0, 0, 0.25, 0.15, 0.05, 0])
+	# Ticks after the hiccup are back on their original deadlines.
+	assert numpy.allclose(stats.deadlines, numpy.arange(7) / 10.0)
+
+def test_player_udp():
+	listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	listener.bind(('127.0.0.1', 0))
+	listener.settimeout(2)
+	sink = UdpSink(port=listener.getsockname()[1])
+	try:
+		data = [{'air': [0, 1, 2]}, {'air': [5, 5, 6]}]
+		stats = Player(data, sink, rate=200).play()
+		received = [parse_osc_bundle(listener.recv(65536)) for i in range(3)]
+	finally:
+		sink.close()
+		listener.close()
+	assert received == [[('/geothermophone/0/air', 0), ('/geothermophone/1/air', 5)],
+						[('/geothermophone/0/air', 1)],
+						[('/geothermophone/0/air', 2), ('/geothermophone/1/air', 6)]]
+	assert len(stats.lateness()) == 3 and sum(count for edge, count in stats.histogram()) == 3
+
+def test_player_renderer():
+	import controlrate
+	now = [0.0]
+	def sleep(seconds):
+		now[0] += seconds
+	renderer = controlrate.Renderer([{'air': [0, 10, 0]}], duration=0.25, rate=100, kind='linear',
+									   ranges={'air': (0, 255)})
+	sink = MemorySink()
+	Player(renderer, sink, spin=0, clock=lambda: now[0], sleep=sleep, block_size=4).play()
+	assert len(sink.batches) == 25 and numpy.allclose(sink.batches[-1][0][0] / 100.0, now[0])
+	# Each tick sends only what changed: up to 10 and back down.
+	values = [value for ticks, messages in sink.batches for (region, var, value) in messages]
+	assert values == list(range(11)) + list(range(9, -1, -1)), values
+
+if __name__ == '__main__':
+	# python playback.py data.gtp [rate [port]]: play a file written by
+	# parser.py to OSC on localhost, then print the timing summary.
+	import sys
+	import export
+	exported = export.load(sys.argv[1])
+	rate = float(sys.argv[2]) if len(sys.argv) > 2 else default_rate
+	port = int(sys.argv[3]) if len(sys.argv) > 3 else 57120
+	sink = UdpSink(port=port)
+	try:
+		stats = Player(exported.to_list(), sink, rate=rate).play()
+	finally:
+		sink.close()
+	print stats.summary()
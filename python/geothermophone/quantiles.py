@@ -0,0 +1,186 @@
+'''
+Streaming quantile sketches, for normalizing by percentiles (or equalizing
+histograms) without holding the series in memory.
+
+A QuantileSketch is a KLL sketch (Karnin, Lang & Liberty, "Optimal Quantile
+Approximation in Streams", 2016): a stack of compactors, level h holding
+values that each stand for 2**h of the originals. When a level outgrows its
+capacity it's sorted and every other value (starting at random from the first
+or the second) moves up a level. Capacities shrink by 2/3 going down from the
+top, so the whole sketch holds O(k) values however long the stream, and ranks
+come out within about 1.7/k of the total count (so ~1% with the default k).
+
+Sketches merge by pooling their levels and compacting again, so sketches of
+chunks of records (or of parallel jobs, or of last month and this month)
+combine into the sketch of all of them. ColumnSketches keeps one per column of
+(time, region) arrays. Missing values (nan) are skipped.
+'''
+import math
+import numpy
+
+default_k = 200
+
+class QuantileSketch(object):
+	''' KLL sketch of a stream of values. '''
+	def __init__(self, k=default_k, seed=0):
+		self.k = k
+		self.count = 0
+		self.levels = [numpy.zeros(0)]
+		self._random = numpy.random.RandomState(seed)
+
+	def __len__(self):
+		''' How many values have gone in. '''
+		return self.count
+
+	def _capacity(self, level):
+		depth = len(self.levels) - level - 1
+		return max(int(math.ceil(self.k * (2.0 / 3) ** depth)), 2)
+
+	def _compact(self):
+		level = 0
+		while level < len(self.levels):
+			items = self.levels[level]
+			if len(items) > self._capacity(level):
+				if level + 1 == len(self.levels):
+					self.levels.append(numpy.zeros(0))
+				items = numpy.sort(items)
+				# With an odd number, the largest value stays behind.
+				pairs = len(items) // 2 * 2
+				self.levels[level + 1] = numpy.concatenate((self.levels[level + 1],
+															items[self._random.randint(2):pairs:2]))
+				self.levels[level] = items[pairs:]
+			level += 1
+
+	def update(self, values):
+		''' Add values (any shape); nan ones are skipped. '''
+		values = numpy.asarray(values, dtype=float).ravel()
+		values = values[~numpy.isnan(values)]
+		self.count += len(values)
+		self.levels[0] = numpy.concatenate((self.levels[0], values))
+		self._compact()
+		return self
+
+	def merge(self, other):
+		''' Fold another sketch into this one. '''
+		while len(self.levels) < len(other.levels):
+			self.levels.append(numpy.zeros(0))
+		for level, items in enumerate(other.levels):
+			self.levels[level] = numpy.concatenate((self.levels[level], items))
+		self.count += other.count
+		self._compact()
+		return self
+
+	def _sorted(self):
+		''' (values, cumulative weights), sorted by value. '''
+		values = numpy.concatenate(self.levels)
+		weights = numpy.concatenate([numpy.full(len(items), 2.0 ** level) for level, items in enumerate(self.levels)])
+		order = numpy.argsort(values, kind='mergesort')
+		return (values[order], numpy.cumsum(weights[order]))
+
+	def quantiles(self, fractions):
+		''' Estimated values at each fraction (0..1) of the way through the
+		sorted stream; nan if nothing has gone in. '''
+		fractions = numpy.asarray(fractions, dtype=float)
+		values, weights = self._sorted()
+		if not len(values):
+			return numpy.full(fractions.shape, numpy.nan)
+		index = numpy.searchsorted(weights, fractions * weights[-1], side='left')
+		return values[numpy.clip(index, 0, len(values) - 1)]
+
+	def cdf(self, values):
+		''' Estimated fraction of the stream <= each of values (nan stays nan). '''
+		values = numpy.asarray(values, dtype=float)
+		items, weights = self._sorted()
+		if not len(items):
+			return numpy.full(values.shape, numpy.nan)
+		index = numpy.searchsorted(items, values, side='right')
+		fractions = numpy.where(index > 0, weights[numpy.maximum(index - 1, 0)], 0.0) / weights[-1]
+		return numpy.where(numpy.isnan(values), numpy.nan, fractions)
+
+	def to_array(self):
+		''' The sketch as a flat float array, for storing alongside results. '''
+		return numpy.concatenate([[self.k, self.count, len(self.levels)], [len(items) for items in self.levels]]
+								 + self.levels)
+
+	@classmethod
+	def from_array(cls, array):
+		k, count, num_levels = [int(value) for value in array[:3]]
+		sketch = cls(k, seed=count)
+		sketch.count = count
+		sizes = array[3:3 + num_levels].astype(int)
+		offsets = 3 + num_levels + numpy.concatenate(([0], numpy.cumsum(sizes)))
+		sketch.levels = [numpy.array(array[offsets[i]:offsets[i + 1]]) for i in range(num_levels)]
+		return sketch
+
+class ColumnSketches(object):
+	''' A QuantileSketch per column of (time, column) arrays. A single column's
+	sketch applies to every column in quantiles and cdf, which is how absolute
+	(all regions together) normalization uses it. '''
+	def __init__(self, num_columns, k=default_k, sketches=None):
+		self.sketches = sketches or [QuantileSketch(k, seed=i) for i in range(num_columns)]
+
+	def __len__(self):
+		return len(self.sketches)
+
+	def update(self, values):
+		''' Add a (time, column) array, or any array for a single sketch. '''
+		values = numpy.asarray(values, dtype=float)
+		if len(self.sketches) == 1:
+			self.sketches[0].update(values)
+		else:
+			assert values.shape[1] == len(self.sketches), \
+				'Values have %d columns but there are %d sketches' % (values.shape[1], len(self.sketches))
+			for i, sketch in enumerate(self.sketches):
+				sketch.update(values[:, i])
+		return self
+
+	def merge(self, other):
+		assert len(other) == len(self), 'Can only merge sketches of as many columns'
+		for sketch, other_sketch in zip(self.sketches, other.sketches):
+			sketch.merge(other_sketch)
+		return self
+
+	def quantiles(self, fractions):
+		''' (fraction, column) array of estimated quantiles. '''
+		return numpy.array([sketch.quantiles(fractions) for sketch in self.sketches]).reshape(len(self), -1).T
+
+	def cdf(self, values):
+		''' Estimated fractions <= values, column by column. '''
+		values = numpy.asarray(values, dtype=float)
+		if len(self.sketches) == 1:
+			return self.sketches[0].cdf(values)
+		return numpy.array([sketch.cdf(values[:, i]) for i, sketch in enumerate(self.sketches)]).T.reshape(values.shape)
+
+	def to_array(self):
+		arrays = [sketch.to_array() for sketch in self.sketches]
+		return numpy.concatenate([[len(arrays)], [len(array) for array in arrays]] + arrays)
+
+	@classmethod
+	def from_array(cls, array):
+		num_columns = int(array[0])
+		offsets = 1 + num_columns + numpy.concatenate(([0], numpy.cumsum(array[1:1 + num_columns].astype(int))))
+		return cls(num_columns, sketches=[QuantileSketch.from_array(array[offsets[i]:offsets[i + 1]])
+										  for i in range(num_columns)])
+
+def test_quantile_sketch():
+	values = numpy.random.RandomState(1).lognormal(size=100000)
+	fractions = numpy.array([0.01, 0.1, 0.5, 0.9, 0.99])
+	# Fed in blocks, and as three sketches merged.
+	sketch = QuantileSketch()
+	for start in range(0, len(values), 1000):
+		sketch.update(values[start:start + 1000])
+	parts = [QuantileSketch(seed=i).update(values[i::3]) for i in range(3)]
+	merged = parts[0].merge(parts[1]).merge(parts[2])
+	for estimate in (sketch, merged):
+		assert len(estimate) == len(values) and sum(len(items) for items in estimate.levels) < 1000
+		# Within 2% of the true rank.
+		ranks = numpy.searchsorted(numpy.sort(values), estimate.quantiles(fractions)) / float(len(values))
+		assert numpy.all(numpy.abs(ranks - fractions) < 0.02), ranks
+		assert numpy.all(numpy.abs(estimate.cdf(numpy.percentile(values, fractions * 100)) - fractions) < 0.02)
+	restored = QuantileSketch.from_array(merged.to_array())
+	assert numpy.array_equal(restored.quantiles(fractions), merged.quantiles(fractions))
+	# Small streams are kept exactly.
+	small = QuantileSketch().update([3.0, numpy.nan, 1.0, 2.0])
+	assert small.quantiles([0, 0.5, 1]).tolist() == [1.0, 2.0, 3.0] and small.cdf([0.5, 2.0, numpy.nan])[:2].tolist() == [0, 2 / 3.0]
+	columns = ColumnSketches.from_array(ColumnSketches(2).update(numpy.array([[1.0, 10.0], [2.0, 20.0]])).to_array())
+	assert columns.quantiles([1.0]).tolist() == [[2.0, 20.0]]
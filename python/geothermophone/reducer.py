@@ -0,0 +1,392 @@
+'''
+Vectorized reduction of gridded data down to per-region values.
+
+get_data used to walk every time, lon and lat in Python and call split_to_octs
+on each cell. Instead we build a label grid once (an int per cell saying which
+region it belongs to) and reduce whole blocks of time steps with numpy.bincount.
+Integer blocks (packed variables, see packing.py) are summed exactly in their
+own dtype instead, with numpy.add.reduceat over the cells sorted by region.
+
+Blocks are (time, lon, lat), following the unusual ordering used in parser.py.
+'''
+import numpy
+
+# Number of time records reduced per bincount call. Big enough that the numpy
+# overhead disappears, small enough that the index arrays stay a few MB.
+default_block_size = 120
+# WeightedRegionReducer multiplies blocks by its weights this many cells at a
+# time (whole records, at least one), so the float copy the sparse product
+# needs stays about 1 MB however big the block.
+weighted_chunk_cells = 1 << 17
+
+def _valid(values, missing_value=None, packing=None):
+	''' Which values aren't missing, or None if they all count. '''
+	if packing is not None:
+		return packing.valid(values)
+	if missing_value is not None:
+		return values != missing_value
+	return None
+
+class RegionReducer(object):
+	''' Reduces (time, lon, lat) blocks to per-region sums, counts and means. '''
+	count_dtype = numpy.intp
+
+	def __init__(self, labels, keys):
+		''' labels is an int array shaped like one time step of the grid, giving
+		the index (into keys) of the region each cell belongs to, or -1 for
+		cells that aren't in any region. '''
+		self.labels = numpy.asarray(labels, dtype=numpy.intp).ravel()
+		self.keys = list(keys)
+		self.num_regions = len(self.keys)
+		assert self.labels.min() >= -1 and self.labels.max() < self.num_regions, \
+			'Labels must index into the %d region keys' % self.num_regions
+		self.in_region = (self.labels >= 0) if self.labels.min() < 0 else None
+		# The cells in region order, for _reduce_integers and reduce_block_stats.
+		order = numpy.argsort(self.labels, kind='mergesort')
+		cells = order[self.labels[order] >= 0]
+		self._set_region_cells(cells, numpy.bincount(self.labels[cells], minlength=self.num_regions))
+
+	def _set_region_cells(self, cells, sizes, cell_weights=None):
+		''' cells lists each region's cells in turn (sizes[i] of them for region
+		i), so per-region reductions can be runs of numpy.ufunc.reduceat over
+		the block's cells gathered in that order. '''
+		self._cells = cells
+		self._sizes = sizes
+		self._starts = (numpy.cumsum(sizes) - sizes)[sizes > 0]
+		self._cell_weights = cell_weights
+
+	def reduce_block(self, block, missing_value=None, packing=None):
+		''' Return (sums, counts), each shaped (time, region), for a block of
+		shape (time, lon, lat). Cells equal to missing_value are left out.
+		packing (a packing.Packing), if given, says which raw values are missing
+		instead, and the sums are decoded from the raw ones per region. '''
+		block = numpy.asarray(block)
+		num_times = block.shape[0]
+		values = block.reshape(num_times, -1)
+		assert values.shape[1] == len(self.labels), \
+			'Block has %d cells per time but labels cover %d' % (values.shape[1], len(self.labels))
+		valid = _valid(values, missing_value, packing)
+		if values.dtype.kind in 'iu':
+			sums, counts = self._reduce_integers(values, valid)
+		else:
+			sums, counts = self._reduce_floats(values, valid)
+		if packing is not None:
+			sums = packing.decode_sums(sums, counts)
+		return (sums, counts)
+
+	def _reduce_floats(self, values, valid):
+		num_times = values.shape[0]
+		# Shift each time step's labels into its own range so one bincount
+		# covers the whole block.
+		index = self.labels + (numpy.arange(num_times) * self.num_regions)[:, numpy.newaxis]
+		if valid is not None or self.in_region is not None:
+			if valid is None:
+				valid = numpy.ones(values.shape, dtype=bool)
+			if self.in_region is not None:
+				valid &= self.in_region
+			index = index[valid]
+			values = values[valid]
+		else:
+			index = index.ravel()
+			values = values.ravel()
+
+		size = num_times * self.num_regions
+		sums = numpy.bincount(index, weights=values, minlength=size)
+		counts = numpy.bincount(index, minlength=size)
+		return (sums.reshape(num_times, self.num_regions),
+				counts.reshape(num_times, self.num_regions))
+
+	def _reduce_integers(self, values, valid):
+		''' Integer (e.g. packed int16) blocks are summed exactly, in int64,
+		without converting them to float: the cells are gathered in region order
+		(a copy in the raw dtype) and each region's run summed with reduceat. '''
+		num_times = values.shape[0]
+		sums = numpy.zeros((num_times, self.num_regions))
+		counts = numpy.tile(self._sizes, (num_times, 1))
+		if not len(self._cells):
+			return (sums, counts)
+		values = values[:, self._cells]
+		nonempty = self._sizes > 0
+		if valid is not None:
+			valid = valid[:, self._cells]
+			values = numpy.where(valid, values, numpy.zeros(1, dtype=values.dtype))
+			counts[:, nonempty] = numpy.add.reduceat(valid, self._starts, axis=1, dtype=numpy.intp)
+		sums[:, nonempty] = numpy.add.reduceat(values, self._starts, axis=1, dtype=numpy.int64)
+		return (sums, counts)
+
+	def reduce_block_stats(self, block, missing_value=None, packing=None):
+		''' Return a RegionStats of each region's values at each time in a block
+		of shape (time, lon, lat): count (total weight, for a weighted reducer),
+		mean, variance, min and max, all from the one block in memory. The
+		variance is summed from deviations from the region's mean, not as
+		E[x^2] - E[x]^2, so it doesn't lose precision on values like Kelvin
+		temperatures with a large mean and a small spread. '''
+		block = numpy.asarray(block)
+		num_times = block.shape[0]
+		values = block.reshape(num_times, -1)
+		shape = (num_times, self.num_regions)
+		stats = RegionStats(numpy.zeros(shape), numpy.full(shape, numpy.nan), numpy.zeros(shape),
+							numpy.full(shape, numpy.nan), numpy.full(shape, numpy.nan))
+		if not len(self._cells):
+			return stats
+		valid = _valid(values, missing_value, packing)
+		values = values[:, self._cells].astype(float)
+		valid = valid[:, self._cells] if valid is not None else None
+		if self._cell_weights is not None:
+			weights = self._cell_weights[numpy.newaxis, :] * (valid if valid is not None else 1.0)
+		else:
+			weights = valid.astype(float) if valid is not None else None
+		nonempty = self._sizes > 0
+		def region_sums(x):
+			return numpy.add.reduceat(x, self._starts, axis=1)
+
+		if weights is not None:
+			values = numpy.where(weights > 0, values, 0.0)
+			counts = region_sums(weights)
+			sums = region_sums(values * weights)
+		else:
+			counts = numpy.tile(self._sizes[nonempty].astype(float), (num_times, 1))
+			sums = region_sums(values)
+		with numpy.errstate(invalid='ignore', divide='ignore'):
+			means = sums / counts
+		deviations = values - numpy.repeat(numpy.nan_to_num(means), self._sizes[nonempty], axis=1)
+		squares = deviations * deviations
+		if weights is not None:
+			squares *= weights
+		present = weights > 0 if weights is not None else numpy.ones(values.shape, dtype=bool)
+		stats.count[:, nonempty] = counts
+		stats.mean[:, nonempty] = means
+		stats.m2[:, nonempty] = region_sums(squares)
+		stats.min[:, nonempty] = numpy.minimum.reduceat(numpy.where(present, values, numpy.inf), self._starts, axis=1)
+		stats.max[:, nonempty] = numpy.maximum.reduceat(numpy.where(present, values, -numpy.inf), self._starts, axis=1)
+		empty = stats.count == 0
+		stats.min[empty] = stats.max[empty] = numpy.nan
+		if packing is not None:
+			stats = stats.decode(packing)
+		return stats
+
+	def reduce_range_stats(self, data, first, last, missing_value=None, block_size=default_block_size, packing=None):
+		''' reduce_block_stats over records first..last-1, a block at a time. '''
+		return RegionStats.concatenate([self.reduce_block_stats(data[start:min(start + block_size, last)],
+																missing_value, packing)
+										for start in range(first, last, block_size)], self.num_regions)
+
+	def reduce_range(self, data, first, last, missing_value=None, block_size=default_block_size, packing=None):
+		''' Reduce records first..last-1 of a (time, lon, lat) array a block at a
+		time. Blocks are plain slices, so with a memory-mapped array only the
+		requested records are read. Returns (sums, counts) shaped (time, region). '''
+		sums = numpy.zeros((last - first, self.num_regions))
+		counts = numpy.zeros((last - first, self.num_regions), dtype=self.count_dtype)
+		for start in range(first, last, block_size):
+			stop = min(start + block_size, last)
+			block = data[start:stop]
+			sums[start-first:stop-first], counts[start-first:stop-first] = \
+				self.reduce_block(block, missing_value, packing)
+		return (sums, counts)
+
+	def means(self, sums, counts):
+		''' Per-region means. Regions with no valid cells come out as nan,
+		same as numpy.mean of an empty list did. '''
+		with numpy.errstate(invalid='ignore', divide='ignore'):
+			return sums / counts
+
+	def to_series(self, values):
+		''' Convert a (time, region) array to the {region key: list} dicts the
+		normalizers and get_all_data work with. '''
+		return dict((key, values[:, i].tolist()) for i, key in enumerate(self.keys))
+
+class WeightedRegionReducer(RegionReducer):
+	''' Like RegionReducer, but each cell contributes to regions through a
+	(cell, region) weight matrix rather than a single label, so a cell
+	straddling a boundary can count partly towards each side (see regrid.py).
+	"counts" are then the total weight of the valid cells in each region. '''
+	count_dtype = float
+
+	def __init__(self, weights, keys):
+		''' weights is a scipy.sparse matrix shaped (cells, regions), cells
+		being in the same order as a flattened time step of the grid. '''
+		self.weights = weights.tocsr()
+		self.weights_t = self.weights.T.tocsr()
+		self.region_totals = self.weights_t.dot(numpy.ones(self.weights.shape[0]))
+		self.keys = list(keys)
+		self.num_regions = len(self.keys)
+		assert self.weights.shape[1] == self.num_regions, \
+			'Weights cover %d regions but there are %d keys' % (self.weights.shape[1], self.num_regions)
+		# Row i of weights_t holds region i's cells and their weights.
+		self._set_region_cells(self.weights_t.indices, numpy.diff(self.weights_t.indptr), self.weights_t.data)
+
+	def reduce_block(self, block, missing_value=None, packing=None):
+		''' Return (weighted sums, total weights), each shaped (time, region),
+		for a block of shape (time, lon, lat): two sparse products, taken
+		weighted_chunk_cells at a time. With a packing, the products are taken
+		over the raw values and decoded after. '''
+		block = numpy.asarray(block)
+		num_times = block.shape[0]
+		values = block.reshape(num_times, -1)
+		assert values.shape[1] == self.weights.shape[0], \
+			'Block has %d cells per time but weights cover %d' % (values.shape[1], self.weights.shape[0])
+		sums = numpy.zeros((num_times, self.num_regions))
+		totals = numpy.tile(self.region_totals, (num_times, 1))
+		step = max(weighted_chunk_cells // max(values.shape[1], 1), 1)
+		for start in range(0, num_times, step):
+			part = values[start:start + step]
+			valid = _valid(part, missing_value, packing)
+			if valid is not None:
+				part = numpy.where(valid, part, numpy.zeros(1, dtype=part.dtype))
+				totals[start:start + step] = self.weights_t.dot(valid.T.astype(float)).T
+			sums[start:start + step] = self.weights_t.dot(part.T.astype(float)).T
+		if packing is not None:
+			sums = packing.decode_sums(sums, totals)
+		return (sums, totals)
+
+class RegionStats(object):
+	''' Per-region summary statistics, each a (time, region) array: count (or
+	total weight), mean, m2 (sum of squared deviations from the mean), min and
+	max. Regions with no valid cells have a count of 0 and nan elsewhere.
+
+	Stats of disjoint sets of cells merge without another pass over the data
+	(Chan et al.'s parallel form of Welford's algorithm), and stats of
+	successive blocks of records concatenate. '''
+	statistics = ('count', 'mean', 'variance', 'std', 'min', 'max')
+
+	def __init__(self, count, mean, m2, min, max):
+		self.count = count
+		self.mean = mean
+		self.m2 = m2
+		self.min = min
+		self.max = max
+
+	def variance(self):
+		''' Population variance (weighted, for a weighted reducer). '''
+		with numpy.errstate(invalid='ignore', divide='ignore'):
+			return self.m2 / self.count
+
+	def std(self):
+		return numpy.sqrt(self.variance())
+
+	def channel(self, name):
+		''' The (time, region) array of one of the statistics. '''
+		assert name in self.statistics, 'Unknown statistic %r (expected one of %s)' % (name, self.statistics)
+		value = getattr(self, name)
+		return value() if callable(value) else value
+
+	def decode(self, packing):
+		''' Stats of packed raw values converted to stats of the real ones. '''
+		if not packing.is_packed():
+			return self
+		scale, offset = packing.scale_factor, packing.add_offset
+		low, high = (self.min, self.max) if scale > 0 else (self.max, self.min)
+		return RegionStats(self.count, self.mean * scale + offset, self.m2 * scale * scale,
+						   low * scale + offset, high * scale + offset)
+
+	def merge(self, other):
+		''' Stats of the union of the cells behind self and other. '''
+		count = self.count + other.count
+		with numpy.errstate(invalid='ignore', divide='ignore'):
+			delta = other.mean - self.mean
+			mean = numpy.where(other.count == 0, self.mean,
+							   numpy.where(self.count == 0, other.mean, self.mean + delta * other.count / count))
+			m2 = self.m2 + other.m2 + numpy.where((self.count > 0) & (other.count > 0),
+												  delta * delta * self.count * other.count / count, 0.0)
+		return RegionStats(count, mean, m2, numpy.fmin(self.min, other.min), numpy.fmax(self.max, other.max))
+
+	@classmethod
+	def concatenate(cls, parts, num_regions):
+		''' Join stats of successive blocks of records along time. '''
+		if not parts:
+			empty = numpy.zeros((0, num_regions))
+			return cls(empty, empty, empty, empty, empty)
+		return cls(*[numpy.concatenate([getattr(part, name) for part in parts])
+					 for name in ('count', 'mean', 'm2', 'min', 'max')])
+
+def test_reduce_block():
+	labels = numpy.array([[0, 0, 1],
+	                      [2, 2, 1]])
+	reducer = RegionReducer(labels, ['a', 'b', 'c'])
+	block = numpy.array([[[1., 3., 5.],
+	                      [-1., 7., 9.]],
+	                     [[2., 2., -1.],
+	                      [-1., -1., -1.]]])
+	sums, counts = reducer.reduce_block(block, missing_value=-1.)
+	assert sums.tolist() == [[4., 14., 7.], [4., 0., 0.]], 'Unexpected sums %s' % sums
+	assert counts.tolist() == [[2, 2, 1], [2, 0, 0]], 'Unexpected counts %s' % counts
+	means = reducer.means(sums, counts)
+	assert means[0].tolist() == [2., 7., 7.]
+	assert numpy.isnan(means[1, 1]) and numpy.isnan(means[1, 2])
+
+def test_reduce_block_integers():
+	''' Integer blocks take the reduceat path, which should agree with
+	bincount, including for cells outside every region and empty regions. '''
+	from packing import Packing
+	labels = numpy.array([[0, -1, 3],
+	                      [3, 0, 0]])
+	reducer = RegionReducer(labels, ['a', 'b', 'c', 'd'])
+	block = numpy.array([[[100, 5, 30],
+	                      [-32767, 20, 40]],
+	                     [[-32767, 7, -32767],
+	                      [10, 50, 60]]], dtype=numpy.int16)
+	sums, counts = reducer.reduce_block(block, missing_value=-32767)
+	float_sums, float_counts = reducer.reduce_block(block.astype(float), missing_value=-32767)
+	assert sums.tolist() == float_sums.tolist() == [[160., 0., 0., 30.], [110., 0., 0., 10.]], sums
+	assert counts.tolist() == float_counts.tolist() == [[3, 0, 0, 1], [2, 0, 0, 1]], counts
+	packing = Packing(0.5, 10.0, [-32767])
+	sums, counts = reducer.reduce_block(block, packing=packing)
+	assert sums.tolist() == [[110., 0., 0., 25.], [75., 0., 0., 15.]], sums
+
+def test_reduce_block_stats():
+	import regrid
+	rng = numpy.random.RandomState(0)
+	block = 280 + rng.standard_normal((3, 5, 4)) # Kelvin-ish: big mean, small spread
+	block[0, 1, 2] = block[2, 0, 0] = -1
+	labels = numpy.array([[0, 0, 1, 1]] * 3 + [[2, 2, -1, -1]] * 2)
+	reducer = RegionReducer(labels, ['a', 'b', 'c', 'd'])
+	stats = reducer.reduce_block_stats(block, missing_value=-1)
+	for t in range(3):
+		for region in range(3):
+			cells = block[t][(labels == region) & (block[t] != -1)]
+			assert stats.count[t, region] == len(cells)
+			assert numpy.allclose([stats.mean[t, region], stats.variance()[t, region]], [cells.mean(), cells.var()])
+			assert (stats.min[t, region], stats.max[t, region]) == (cells.min(), cells.max())
+		assert stats.count[t, 3] == 0 and numpy.isnan(stats.mean[t, 3]) and numpy.isnan(stats.max[t, 3])
+	sums, counts = reducer.reduce_block(block, missing_value=-1)
+	assert numpy.allclose(stats.mean[:, :3], sums[:, :3] / counts[:, :3])
+
+	# Merging the stats of two halves of each region matches the whole.
+	left = numpy.where(numpy.arange(4) < 1, labels, -1)
+	right = numpy.where(numpy.arange(4) >= 1, labels, -1)
+	merged = RegionReducer(left, reducer.keys).reduce_block_stats(block, -1).merge(
+		RegionReducer(right, reducer.keys).reduce_block_stats(block, -1))
+	for name in RegionStats.statistics:
+		assert numpy.allclose(merged.channel(name), stats.channel(name), equal_nan=True), name
+
+	# Weighted stats on a real grid.
+	lats, lons = regrid.regular_lats(5), regrid.regular_lons(4)
+	weighted = regrid.octant_reducer(lats, lons, weighting='area')
+	stats = weighted.reduce_block_stats(block, missing_value=-1)
+	weights = weighted.weights.toarray()
+	for t in range(3):
+		values = block[t].ravel()
+		w = weights[:, 0] * (values != -1)
+		mean = (w * values).sum() / w.sum()
+		assert numpy.allclose([stats.mean[t, 0], stats.variance()[t, 0]], [mean, (w * (values - mean) ** 2).sum() / w.sum()])
+		assert stats.max[t, 0] == values[w > 0].max()
+	assert numpy.allclose(stats.mean, numpy.divide(*weighted.reduce_block(block, -1)))
+
+def test_weighted_reduce_in_chunks():
+	import regrid
+	from packing import Packing
+	global weighted_chunk_cells
+	lats, lons = regrid.regular_lats(9), regrid.regular_lons(16)
+	weighted = regrid.octant_reducer(lats, lons, weighting='area')
+	block = numpy.random.RandomState(0).randint(-100, 100, (7, 9, 16)).astype(numpy.int16)
+	block[2, 3, 4] = block[5, 0, 0] = 32766
+	packing = Packing(0.01, 200.0, [32766])
+	whole = weighted.reduce_block(block, packing=packing)
+	saved = weighted_chunk_cells
+	try:
+		# Two records (and a bit) at a time.
+		weighted_chunk_cells = 2 * 9 * 16 + 5
+		chunked = weighted.reduce_block(block, packing=packing)
+	finally:
+		weighted_chunk_cells = saved
+	assert numpy.allclose(whole[0], chunked[0], rtol=1e-12) and numpy.array_equal(whole[1], chunked[1])
@@ -0,0 +1,271 @@
+'''
+Region definitions: which cells of a grid make up which region, for splitting
+the globe into something other than LonLatSplitter's eight octants.
+
+A Regions is an ordered list of (key, definition) pairs. Each definition is a
+dict of criteria, and a cell belongs to the region if it meets all of them:
+	bin     [lon_key, num_lon_bins, lat_key, num_lat_bins] -- one bin of an
+	        even split by index, exactly as LonLatSplitter splits
+	lat     [south, north] -- cell centre latitude in degrees
+	lon     [west, east] -- cell centre longitude in degrees (0..360, wrapping
+	        if west > east)
+	polygon [[lat, lon], ...] -- cell centre inside the polygon (e.g. a
+	        continent, or a panel of the tetrahedral globe)
+	mask    a boolean (lat, lon) array, or the name of a .npy file holding
+	        one (e.g. land vs ocean)
+Criteria other than bin need the file's coordinates.
+
+For a given grid, the definitions are compiled to an integer label array (-1
+for cells in no region), so reducing with RegionReducer costs the same for
+hundreds of regions as it does for eight. With weighting='area' (see
+parser.region_weighting) and the file's coordinates, each cell counts by its
+area on the sphere instead, through a WeightedRegionReducer, so the small
+cells near the poles don't dominate; unlike regrid's octants, a cell still
+belongs wholly to the one region its centre is in. Compiling also validates the
+definitions against the grid: masks must match its shape, regions mustn't
+overlap, and none may come out empty.
+
+Regions can be loaded from a JSON file:
+	{"regions": [{"key": "tropics", "lat": [-23.5, 23.5]},
+	             {"key": "arctic", "lat": [66.5, 90]},
+	             {"key": "europe", "polygon": [[36, 350], [36, 40], [71, 40], [71, 350]],
+	              "mask": "land.npy"}]}
+or just {"bins": [num_lon_bins, num_lat_bins]}. Keys that are lists become
+tuples. Mask filenames are relative to the JSON file.
+
+Note on naming: as in parser.py, the grid's first axis is what the files call
+latitude but parser.py calls "lon", and bins follow parser.py's naming.
+'''
+import hashlib
+import json
+import os
+import numpy
+from scipy import sparse
+import regrid
+from reducer import RegionReducer, WeightedRegionReducer
+
+criteria = ('bin', 'lat', 'lon', 'polygon', 'mask')
+
+def _bin_mask(grid_shape, lon_key, num_lon_bins, lat_key, num_lat_bins):
+	lon_bins = numpy.floor(numpy.arange(grid_shape[0]) / (grid_shape[0] / float(num_lon_bins))).astype(int)
+	lat_bins = numpy.floor(numpy.arange(grid_shape[1]) / (grid_shape[1] / float(num_lat_bins))).astype(int)
+	return (lon_bins == lon_key)[:, numpy.newaxis] & (lat_bins == lat_key)[numpy.newaxis, :]
+
+def _lon_in(lons, west, east):
+	lons = numpy.mod(lons, 360.0)
+	west = west % 360.0
+	if east != 360:
+		east = east % 360.0
+	if west <= east:
+		return (lons >= west) & (lons < east)
+	return (lons >= west) | (lons < east)
+
+def points_in_polygon(lats, lons, vertices):
+	''' Boolean array of whether each (lat, lon) point is inside the polygon
+	with the given [lat, lon] vertices (even-odd rule). Longitudes are
+	compared as given, and shifted by 360 either way, so a polygon can cross
+	the 0/360 line if its vertices run past 360 (or below 0). '''
+	vertices = numpy.asarray(vertices, dtype=float)
+	inside = numpy.zeros(numpy.shape(lats), dtype=bool)
+	for shift in (-360.0, 0.0, 360.0):
+		y = numpy.asarray(lats, dtype=float)
+		x = numpy.asarray(lons, dtype=float) + shift
+		crossings = numpy.zeros(y.shape, dtype=bool)
+		for (y0, x0), (y1, x1) in zip(vertices, numpy.roll(vertices, -1, axis=0)):
+			if y0 == y1:
+				continue
+			spans = (y0 > y) != (y1 > y)
+			x_cross = x0 + (y - y0) * (x1 - x0) / (y1 - y0)
+			crossings ^= spans & (x < x_cross)
+		inside |= crossings
+	return inside
+
+class Regions(object):
+	''' An ordered set of region definitions. '''
+	def __init__(self, definitions, directory=None):
+		''' definitions is a list of (key, definition dict) pairs. directory is
+		where mask files are looked for. '''
+		self.definitions = [(key, dict(definition)) for (key, definition) in definitions]
+		self.directory = directory
+		self._labels = {}
+		for key, definition in self.definitions:
+			unknown = set(definition) - set(criteria)
+			assert not unknown, 'Region %s has unknown criteria %s (expected some of %s)' % (key, sorted(unknown), criteria)
+			assert definition, 'Region %s has no criteria' % (key,)
+		assert len(set(self.keys())) == len(self.definitions), 'Region keys must be unique'
+
+	def keys(self):
+		''' Region keys, in the order the regions are listed in. '''
+		return [key for (key, definition) in self.definitions]
+
+	def _mask_array(self, mask):
+		if isinstance(mask, basestring):
+			return numpy.load(os.path.join(self.directory or '', mask))
+		return numpy.asarray(mask)
+
+	def layout(self):
+		''' Describes the regions independent of any grid (e.g. for cache
+		keys): mask arrays are replaced by a hash of their contents. '''
+		sha1 = hashlib.sha1()
+		for key, definition in self.definitions:
+			for name in criteria:
+				if name == 'mask' and name in definition:
+					sha1.update(numpy.ascontiguousarray(self._mask_array(definition[name]), dtype=bool).tobytes())
+				elif name in definition:
+					sha1.update(json.dumps([key, name, definition[name]]).encode('utf-8'))
+		return [type(self).__name__, len(self.definitions), sha1.hexdigest()]
+
+	def region_mask(self, definition, grid_shape, lats=None, lons=None):
+		''' Boolean grid_shape array of the cells meeting every criterion. '''
+		mask = numpy.ones(grid_shape, dtype=bool)
+		if 'bin' in definition:
+			mask &= _bin_mask(grid_shape, *definition['bin'])
+		needs_coordinates = [name for name in ('lat', 'lon', 'polygon') if name in definition]
+		if needs_coordinates:
+			assert lats is not None and lons is not None, \
+				'Regions defined by %s need the file\'s lat/lon coordinates' % ', '.join(needs_coordinates)
+			lat_grid, lon_grid = numpy.meshgrid(lats, lons, indexing='ij')
+			if 'lat' in definition:
+				south, north = sorted(definition['lat'])
+				mask &= (lat_grid >= south) & (lat_grid <= north) if north == 90 else \
+					(lat_grid >= south) & (lat_grid < north)
+			if 'lon' in definition:
+				mask &= _lon_in(lon_grid, *definition['lon'])
+			if 'polygon' in definition:
+				mask &= points_in_polygon(lat_grid, lon_grid, definition['polygon'])
+		if 'mask' in definition:
+			region_mask = self._mask_array(definition['mask'])
+			assert region_mask.shape == tuple(grid_shape), \
+				'Mask has shape %s but the grid is %s' % (region_mask.shape, tuple(grid_shape))
+			mask &= region_mask.astype(bool)
+		return mask
+
+	def labels(self, grid_shape, lats=None, lons=None):
+		''' Compile the regions for a grid to an int array shaped like the
+		grid, holding each cell's index into keys(), or -1 for cells in no
+		region. Cached per grid. '''
+		grid_shape = tuple(grid_shape)
+		cache_key = (grid_shape,) + tuple(None if a is None else numpy.asarray(a, dtype=float).tobytes()
+										  for a in (lats, lons))
+		if cache_key not in self._labels:
+			labels = numpy.full(grid_shape, -1, dtype=numpy.intp)
+			for i, (key, definition) in enumerate(self.definitions):
+				mask = self.region_mask(definition, grid_shape, lats, lons)
+				assert mask.any(), 'Region %s has no cells on a %s grid' % (key, grid_shape)
+				overlap = mask & (labels >= 0)
+				assert not overlap.any(), 'Region %s overlaps region %s' % (key, self.definitions[labels[overlap][0]][0])
+				labels[mask] = i
+			self._labels[cache_key] = labels
+		return self._labels[cache_key]
+
+	def reducer(self, grid_shape, lats=None, lons=None, weighting=None):
+		''' A reducer for the regions on a grid: a RegionReducer, or with
+		weighting='area' and coordinates, a WeightedRegionReducer weighting
+		each cell by its area. '''
+		labels = self.labels(grid_shape, lats, lons)
+		if weighting != 'area' or lats is None or lons is None:
+			return RegionReducer(labels, self.keys())
+		cells = numpy.flatnonzero(labels >= 0)
+		areas = regrid.cell_areas(lats, lons).ravel()
+		weights = sparse.csr_matrix((areas[cells], (cells, labels.ravel()[cells])),
+									shape=(labels.size, len(self.definitions)))
+		return WeightedRegionReducer(weights, self.keys())
+
+def bins(num_lon_bins=4, num_lat_bins=2):
+	''' An even split by index into num_lon_bins x num_lat_bins regions, keyed
+	(lon_key, lat_key); bins(4, 2) is LonLatSplitter's octants. '''
+	return Regions([((lon_key, lat_key), {'bin': [lon_key, num_lon_bins, lat_key, num_lat_bins]})
+					for lon_key in range(num_lon_bins)
+					for lat_key in range(num_lat_bins)])
+
+def edges(lat_edges, lon_edges):
+	''' Boxes between (possibly irregular) edges in degrees, keyed
+	(lat band, lon bin) like regrid's octants. '''
+	return Regions([((a, b), {'lat': sorted(lat_edges[a:a + 2]), 'lon': list(lon_edges[b:b + 2])})
+					for a in range(len(lat_edges) - 1)
+					for b in range(len(lon_edges) - 1)])
+
+def _key(key):
+	return tuple(key) if isinstance(key, list) else key
+
+def parse(spec, directory=None):
+	''' Regions from the dict a JSON file holds (see the module docstring).
+	directory is where mask files are looked for. '''
+	if 'bins' in spec:
+		return bins(*spec['bins'])
+	definitions = []
+	for region in spec['regions']:
+		region = dict(region)
+		definitions.append((_key(region.pop('key')), region))
+	return Regions(definitions, directory=directory)
+
+def load(filename):
+	''' Read Regions from a JSON file (see the module docstring). '''
+	with open(filename) as f:
+		spec = json.load(f)
+	return parse(spec, directory=os.path.dirname(os.path.abspath(filename)))
+
+def test_bins_match_lon_lat_splitter():
+	import parser
+	for grid_shape in ((73, 144), (94, 192), (9, 16)):
+		labels, keys = parser.LonLatSplitter(*grid_shape).label_grid()
+		regions = bins(4, 2)
+		assert regions.keys() == keys
+		assert numpy.array_equal(regions.labels(grid_shape), labels)
+
+def test_regions_from_file():
+	import shutil, tempfile
+	lats = numpy.linspace(90.0, -90.0, 7) # every 30 degrees
+	lons = numpy.arange(12) * 30.0
+	land = numpy.zeros((7, 12), dtype=bool)
+	land[2:5, 3:6] = True
+	tmpdir = tempfile.mkdtemp()
+	try:
+		numpy.save(os.path.join(tmpdir, 'land.npy'), land)
+		filename = os.path.join(tmpdir, 'regions.json')
+		with open(filename, 'w') as f:
+			json.dump({'regions': [{'key': 'arctic', 'lat': [60, 90]},
+								   {'key': 'land', 'mask': 'land.npy'},
+								   {'key': [1, 2], 'polygon': [[-40, 330], [-40, 400], [10, 400], [10, 330]]},
+								   {'key': 'south pacific', 'lat': [-90, -45], 'lon': [150, 270]}]}, f)
+		regions = load(filename)
+		labels = regions.labels((7, 12), lats, lons)
+	finally:
+		shutil.rmtree(tmpdir)
+	assert regions.keys() == ['arctic', 'land', (1, 2), 'south pacific']
+	assert (labels[:2] == 0).all() and (labels[2:5, 3:6] == 1).all()
+	# The polygon crosses 0E: lats -30..0, lons 330, 0 and 30.
+	assert sorted(zip(*numpy.nonzero(labels == 2))) == [(3, 0), (3, 1), (3, 11), (4, 0), (4, 1), (4, 11)]
+	assert sorted(zip(*numpy.nonzero(labels == 3))) == [(r, c) for r in (5, 6) for c in (5, 6, 7, 8)]
+	assert (labels >= -1).all() and (labels == -1).sum() == 84 - 24 - 9 - 6 - 8
+
+	# Cells in no region are left out of the reduction.
+	block = numpy.arange(84, dtype=float).reshape(1, 7, 12)
+	sums, counts = regions.reducer((7, 12), lats, lons).reduce_block(block)
+	assert counts.tolist() == [[24, 9, 6, 8]] and sums[0, 1] == block[0, 2:5, 3:6].sum()
+
+	# Validation against the grid.
+	def fails(regions, grid_shape, lats=None, lons=None):
+		try:
+			regions.labels(grid_shape, lats, lons)
+		except AssertionError:
+			return True
+		return False
+	assert fails(Regions([('a', {'mask': land})]), (7, 13)), 'Mask and grid shapes differ'
+	assert fails(Regions([('a', {'lat': [0, 90]}), ('b', {'lat': [-10, 10]})]), (7, 12), lats, lons), 'Regions overlap'
+	assert fails(Regions([('a', {'lat': [10, 20]})]), (7, 12), lats, lons), 'Region is empty'
+	assert fails(edges((90, 0, -90), (0, 180, 360)), (7, 12)), 'No coordinates'
+	assert not fails(edges((90, 0, -90), (0, 180, 360)), (7, 12), lats, lons)
+
+def test_area_weighted_regions():
+	lats = regrid.regular_lats(73)
+	lons = regrid.regular_lons(144)
+	block = numpy.sin(numpy.radians(numpy.meshgrid(lats, lons, indexing='ij')[0]))[numpy.newaxis]
+	octants = regrid.octant_reducer(lats, lons, weighting='area')
+	expected = octants.means(*octants.reduce_block(block))[0, 0]
+	regions = Regions([('north', {'lat': [45, 90], 'lon': [0, 180]})])
+	weighted = regions.reducer((73, 144), lats, lons, weighting='area')
+	plain = regions.reducer((73, 144), lats, lons)
+	# The 45N cells count wholly here, but only half towards the octant.
+	assert abs(weighted.means(*weighted.reduce_block(block))[0, 0] - expected) < 0.01
+	assert plain.means(*plain.reduce_block(block))[0, 0] - expected > 0.04
@@ -0,0 +1,187 @@
+'''
+Mapping grid cells onto regions by their actual coordinates.
+
+LonLatSplitter splits by index, so the octant boundaries land in different
+places on prate's 94x192 Gaussian grid than on the 73x144 grid the other
+variables use. Here the regions are defined in degrees instead, and each cell
+is weighted by how many square degrees of it fall in each region (cells
+straddling a boundary count partly towards both sides). A region's value is
+then its mean over latitude/longitude, which doesn't depend on how finely or
+evenly the grid samples it.
+
+With weighting='area', cells are weighted by their actual area on the sphere
+instead (cos(latitude) integrated over the cell: the difference of the sines of
+its edges), so the many small cells near the poles don't dominate a band. As
+with any weighting, cells that are missing at a given time drop out and the
+rest of the region's weights renormalize around them. The weights for a grid are worked
+out once, as a sparse (cell, region) matrix, and cached; after that reducing a
+block of time steps is a sparse matrix product (see WeightedRegionReducer).
+
+Note on naming: parser.py's "lon" axis (the one split four ways) is really the
+files' latitude axis, and its "lat" axis their longitude. The octant keys here
+keep parser.py's (lon_key, lat_key) order, i.e. (latitude band, longitude
+half), so the results line up with the index-based ones.
+'''
+import hashlib
+import numpy
+from scipy import sparse
+from reducer import WeightedRegionReducer
+
+# The octants in degrees: four latitude bands, north to south, by two
+# longitude halves.
+octant_lat_edges = (90.0, 45.0, 0.0, -45.0, -90.0)
+octant_lon_edges = (0.0, 180.0, 360.0)
+
+weightings = ('degrees', 'area')
+
+_weights_cache = {}
+
+def lat_cell_edges(lats):
+	''' Edges of each latitude cell: midway between centres, with the outer
+	cells running all the way to the poles. '''
+	lats = numpy.asarray(lats, dtype=float)
+	middles = (lats[1:] + lats[:-1]) / 2.0
+	pole = 90.0 if lats[0] > lats[-1] else -90.0
+	edges = numpy.concatenate(([pole], middles, [-pole]))
+	return (edges[:-1], edges[1:])
+
+def lon_cell_edges(lons):
+	''' Edges of each longitude cell, wrapping around 360. '''
+	lons = numpy.asarray(lons, dtype=float)
+	previous = numpy.roll(lons, 1)
+	previous[0] -= 360.0
+	following = numpy.roll(lons, -1)
+	following[-1] += 360.0
+	return ((lons + previous) / 2.0, (lons + following) / 2.0)
+
+def _overlap(starts, ends, bin_edges, period=None):
+	''' (cell, bin) length of each cell [start, end] inside each bin. Works
+	whichever way the cells and bins run. With a period, bins repeat. '''
+	lo = numpy.minimum(starts, ends)[:, numpy.newaxis]
+	hi = numpy.maximum(starts, ends)[:, numpy.newaxis]
+	bin_edges = numpy.asarray(bin_edges, dtype=float)
+	bin_lo = numpy.minimum(bin_edges[:-1], bin_edges[1:])[numpy.newaxis, :]
+	bin_hi = numpy.maximum(bin_edges[:-1], bin_edges[1:])[numpy.newaxis, :]
+	shifts = (-period, 0.0, period) if period else (0.0,)
+	overlap = sum(numpy.clip(numpy.minimum(hi, bin_hi + shift) - numpy.maximum(lo, bin_lo + shift), 0, None)
+				  for shift in shifts)
+	return overlap
+
+def cell_areas(lats, lons):
+	''' (lat, lon) array of each cell's area on the sphere, in the units
+	region_weights uses with weighting='area'. '''
+	starts, ends = lat_cell_edges(lats)
+	lon_starts, lon_ends = lon_cell_edges(lons)
+	sines = numpy.sin(numpy.radians(starts)) - numpy.sin(numpy.radians(ends))
+	return numpy.outer(numpy.abs(sines), lon_ends - lon_starts)
+
+def region_weights(lats, lons, lat_edges=octant_lat_edges, lon_edges=octant_lon_edges, cell_weights=None,
+				   weighting='degrees'):
+	''' Sparse (cell, region) matrix of the square degrees of each cell in each
+	region, for a (lat, lon) grid with the given coordinates, or with
+	weighting='area', of the area of each cell in each region (in units of
+	degrees of longitude times sin(latitude)). Regions are numbered lat band
+	major, lon bin minor. cell_weights, if given, is a (lat, lon) array each
+	cell's weights are multiplied by. '''
+	assert weighting in weightings, 'Unknown weighting %r (expected one of %s)' % (weighting, weightings)
+	cell_starts, cell_ends = lat_cell_edges(lats)
+	if weighting == 'area':
+		# Area between two latitudes is proportional to the difference of
+		# their sines, so measure the latitude overlaps in sin(latitude).
+		to_area = lambda degrees: numpy.sin(numpy.radians(numpy.asarray(degrees, dtype=float)))
+		lat_overlap = _overlap(to_area(cell_starts), to_area(cell_ends), to_area(lat_edges))
+	else:
+		lat_overlap = _overlap(cell_starts, cell_ends, lat_edges)
+	lon_overlap = _overlap(*(lon_cell_edges(lons) + (lon_edges,)), period=360.0)
+	# weights[(i, j), (a, b)] = lat_overlap[i, a] * lon_overlap[j, b]
+	weights = sparse.kron(sparse.csr_matrix(lat_overlap), sparse.csr_matrix(lon_overlap)).tocsr()
+	if cell_weights is not None:
+		weights = sparse.diags(numpy.asarray(cell_weights, dtype=float).ravel()).dot(weights).tocsr()
+	weights.eliminate_zeros()
+	return weights
+
+def _grid_key(*arrays):
+	sha1 = hashlib.sha1()
+	for array in arrays:
+		array = numpy.ascontiguousarray(array, dtype=float)
+		sha1.update(str(array.shape).encode('utf-8'))
+		sha1.update(array.tobytes())
+	return sha1.hexdigest()
+
+def octant_keys(lat_edges=octant_lat_edges, lon_edges=octant_lon_edges):
+	return [(a, b) for a in range(len(lat_edges) - 1) for b in range(len(lon_edges) - 1)]
+
+def octant_reducer(lats, lons, lat_edges=octant_lat_edges, lon_edges=octant_lon_edges, weighting='degrees'):
+	''' A WeightedRegionReducer for the grid with these coordinates, with the
+	weights built on first use and cached after that. '''
+	key = (weighting, _grid_key(lats, lons, lat_edges, lon_edges))
+	if key not in _weights_cache:
+		_weights_cache[key] = region_weights(lats, lons, lat_edges, lon_edges, weighting=weighting)
+	return WeightedRegionReducer(_weights_cache[key], octant_keys(lat_edges, lon_edges))
+
+def gaussian_lats(num_lats):
+	''' Latitudes of a Gaussian grid (like prate's), north to south. '''
+	nodes = numpy.polynomial.legendre.leggauss(num_lats)[0]
+	return numpy.degrees(numpy.arcsin(nodes))[::-1]
+
+def regular_lats(num_lats):
+	''' Latitudes of a regular grid including the poles, north to south. '''
+	return numpy.linspace(90.0, -90.0, num_lats)
+
+def regular_lons(num_lons):
+	return numpy.arange(num_lons) * (360.0 / num_lons)
+
+def test_region_weights():
+	lats = regular_lats(73)
+	lons = regular_lons(144)
+	weights = region_weights(lats, lons).toarray()
+	assert numpy.allclose(weights.sum(), 180 * 360), 'The whole globe should be covered once'
+	# Row 0 is the pole, half a cell high.
+	assert numpy.allclose(weights[1], [1.25 * 2.5, 0, 0, 0, 0, 0, 0, 0])
+	# Row 18 is 45N, right on a band edge; column 0 is 0E, on a half edge.
+	cell = 18 * 144 + 1
+	assert numpy.allclose(weights[cell], [1.25 * 2.5, 0, 1.25 * 2.5, 0, 0, 0, 0, 0])
+	cell = 10 * 144
+	assert numpy.allclose(weights[cell], [2.5 * 1.25, 2.5 * 1.25, 0, 0, 0, 0, 0, 0])
+	assert octant_reducer(lats, lons).weights is octant_reducer(lats, lons).weights, 'Weights should be cached'
+
+def test_grids_agree():
+	''' A field that's a function of position should come out the same on
+	both grids, which index-based splitting doesn't manage. '''
+	means = []
+	for lats, lons in ((regular_lats(73), regular_lons(144)), (gaussian_lats(94), regular_lons(192))):
+		lat_grid, lon_grid = numpy.meshgrid(lats, lons, indexing='ij')
+		field = 10 + 2 * numpy.sin(numpy.radians(lat_grid)) + numpy.cos(numpy.radians(lon_grid))
+		block = numpy.array([field, field * 2])
+		reducer = octant_reducer(lats, lons)
+		means.append(reducer.means(*reducer.reduce_block(block)))
+	assert numpy.allclose(means[0], means[1], rtol=0.002), '%s\n%s' % tuple(means)
+
+def test_area_weighting():
+	lats = regular_lats(73)
+	lons = regular_lons(144)
+	lat_grid, lon_grid = numpy.meshgrid(lats, lons, indexing='ij')
+	block = numpy.sin(numpy.radians(lat_grid))[numpy.newaxis]
+	means = {}
+	for weighting in weightings:
+		reducer = octant_reducer(lats, lons, weighting=weighting)
+		means[weighting] = reducer.means(*reducer.reduce_block(block))[0]
+	# Means of sin(latitude) over 45N-90N: by area, (1/2 - 1/4) / (1 - sin 45);
+	# by degrees, cos 45 / (pi / 4).
+	assert abs(means['area'][0] - 0.25 / (1 - numpy.sqrt(0.5))) < 1e-3, means['area']
+	assert abs(means['degrees'][0] - numpy.sqrt(0.5) / (numpy.pi / 4)) < 1e-3, means['degrees']
+	weights = region_weights(lats, lons, weighting='area')
+	assert numpy.allclose(weights.data.sum(), 2 * 360), 'Should cover the sphere once'
+	assert numpy.allclose(cell_areas(lats, lons), numpy.asarray(weights.sum(axis=1)).reshape(73, 144))
+
+def test_missing_values_reweight():
+	lats = regular_lats(5)
+	lons = regular_lons(4)
+	reducer = octant_reducer(lats, lons)
+	block = numpy.ones((1, 5, 4))
+	block[0, 0] = -1 # missing
+	block[0, 1] = 3
+	sums, totals = reducer.reduce_block(block, missing_value=-1)
+	means = reducer.means(sums, totals)
+	# The northern band is row 0 (all missing) and half of row 1 (all 3s).
+	assert numpy.allclose(means[0, :2], 3.0)
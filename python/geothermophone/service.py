@@ -0,0 +1,337 @@
+'''
+A local HTTP service for trying out variables, windows and normalizations
+while tuning the installation, without rerunning parser.py for each.
+
+A Service loads a pipeline.py spec's region series once, reduced but neither
+smoothed nor normalized, and answers queries on them:
+	GET /series?var=air&region=0,1&start=1970-01-01&end=1990-01-01
+	           &smoothing=boxcar&window=12&normalization=relative
+	           &rate=100&seconds=60&interpolation=cubic&format=json
+	var            a channel (see parser.channel_name), required
+	region         a region key (0,1 or as the regions file has it); may be
+	               repeated; every region if left out
+	start, end     dates; the records with start <= time < end
+	smoothing      boxcar, exponential or none (the default), over window
+	               records, as pipeline.Smooth does: a record's value averages
+	               the window before it, so the first window records of what
+	               was loaded only feed the average
+	normalization  one of pipeline.normalizations, or none (the default);
+	               min and max (0 <= min <= max) give the range to scale onto
+	rate, seconds  render onto seconds at rate values a second (see
+	               controlrate.py), by interpolation
+	format         json (the default): {"var", "regions", "times", "values"},
+	               values a list per region (null where missing); or binary:
+	               little-endian float64 (region, time) values, with the
+	               regions and shape in X-Regions and X-Shape headers
+	GET /variables lists the channels, regions and each channel's time span,
+	GET /stats the cache's.
+
+Results are cached, by their query parameters, in an LRU of at most
+max_bytes; so are the smoothed series and the normalized time ranges they're
+made from, so a query that only changes the region or the rate reuses the
+work of the ones before it. serve() listens on localhost only.
+'''
+import BaseHTTPServer
+import collections
+import json
+import urlparse
+import numpy
+import controlrate
+import pipeline
+import smoothing
+import timeaxis
+
+default_port = 8642
+default_max_bytes = 64 * 1024 * 1024
+variable_overrides = ('smoothing', 'window', 'normalization', 'range')
+
+class QueryError(Exception):
+	''' A query the service can't answer, reported as a 400. '''
+	pass
+
+def raw_spec(spec):
+	''' A pipeline.py spec with its smoothing and normalization taken out. '''
+	spec = dict(spec, smoothing=None, normalization=None, outputs=[])
+	spec['variables'] = [dict((name, value) for name, value in variable.items() if name not in variable_overrides)
+						 if isinstance(variable, dict) else variable for variable in spec['variables']]
+	return spec
+
+class LRUCache(object):
+	''' Arrays (or tuples of arrays) by key, least recently used first out
+	once they add up to more than max_bytes. '''
+	def __init__(self, max_bytes=default_max_bytes):
+		self.max_bytes = max_bytes
+		self.entries = collections.OrderedDict()
+		self.bytes = 0
+		self.hits = 0
+		self.misses = 0
+
+	def _size(self, value):
+		values = value if isinstance(value, tuple) else (value,)
+		return sum(numpy.asarray(part).nbytes for part in values)
+
+	def get(self, key, compute):
+		''' The value for key, from compute() if it isn't here. '''
+		if key in self.entries:
+			self.hits += 1
+			value = self.entries.pop(key)
+			self.entries[key] = value
+			return value
+		self.misses += 1
+		value = compute()
+		size = self._size(value)
+		if size <= self.max_bytes:
+			self.entries[key] = value
+			self.bytes += size
+			while self.bytes > self.max_bytes:
+				unused, evicted = self.entries.popitem(last=False)
+				self.bytes -= self._size(evicted)
+		return value
+
+	def stats(self):
+		return {'entries': len(self.entries), 'bytes': self.bytes, 'max_bytes': self.max_bytes,
+				'hits': self.hits, 'misses': self.misses}
+
+class Service(object):
+	''' Answers queries (see the module docstring) on a Pipeline's series. '''
+	def __init__(self, service_pipeline, max_bytes=default_max_bytes, cache=None, workers=None):
+		''' cache and workers are for loading, as in Pipeline.series. '''
+		self.pipeline = pipeline.Pipeline(raw_spec(service_pipeline.spec), service_pipeline.directory)
+		self.keys = self.pipeline.keys()
+		self.series = {}
+		self.times = {}
+		for variable, chunks in self.pipeline.streams(cache, workers, normalized=False):
+			first, last = self.pipeline.output_window(variable)
+			times = self.pipeline.read(variable).dataset.hours[first:last]
+			for name, values in self.pipeline._collect(variable, chunks).items():
+				self.series[name] = numpy.array([values[key] for key in self.keys], dtype=float).T.reshape(-1, len(self.keys))
+				self.times[name] = times
+		self.lookup = {}
+		for i, key in enumerate(self.keys):
+			self.lookup[str(key)] = i
+			if isinstance(key, tuple):
+				self.lookup[','.join(str(part) for part in key)] = i
+		self.cache = LRUCache(max_bytes)
+
+	def variables(self):
+		return {'variables': sorted(self.series), 'regions': [str(key) for key in self.keys],
+				'times': dict((name, [float(times[0]), float(times[-1])] if len(times) else [])
+							  for name, times in self.times.items())}
+
+	def _smoothed(self, var, kernel, window):
+		''' (times, values) of a channel, smoothed. '''
+		values, times = self.series[var], self.times[var]
+		if kernel is None:
+			return (times, values)
+		if kernel == 'boxcar':
+			smoothed = smoothing.smooth(values, window)[:-1]
+		else:
+			smoothed = smoothing.smooth(values, window, 'exponential', 'trailing')[window - 1:-1]
+		return (times[window:], smoothed.reshape(-1, len(self.keys)))
+
+	def _normalized(self, var, kernel, window, start, end, kind, new_range):
+		''' (times, values) of a channel, smoothed, cut to start..end and
+		normalized over what's left. '''
+		times, values = self.cache.get(('smoothed', var, kernel, window), lambda: self._smoothed(var, kernel, window))
+		dates = timeaxis.decode(times)
+		first = 0 if start is None else int(numpy.searchsorted(dates, timeaxis.to_datetime64(start)))
+		last = len(dates) if end is None else int(numpy.searchsorted(dates, timeaxis.to_datetime64(end)))
+		times, values = times[first:max(first, last)], values[first:max(first, last)]
+		if kind is None or not len(values):
+			return (times, values)
+		normalization = pipeline.Normalize(kind, *new_range)
+		return (times, normalization.scale(values, normalization.summarize(values)).astype(float))
+
+	def _rendered(self, params):
+		''' (times, (region, time) values) for a query's parameters. '''
+		var, kernel, window, start, end, kind, new_range, columns, rate, seconds, interpolation = params
+		times, values = self.cache.get(('normalized',) + params[:7],
+									   lambda: self._normalized(var, kernel, window, start, end, kind, new_range))
+		values = values[:, list(columns)].T
+		if seconds is None or not values.shape[1]:
+			return (times, values)
+		ranges = None
+		if kind is not None:
+			normalization = pipeline.Normalize(kind, *new_range)
+			ranges = {var: (normalization.new_min, normalization.new_max)}
+		renderer = controlrate.Renderer([{var: region} for region in values], seconds, rate, interpolation,
+										ranges=ranges, times=times)
+		return (renderer.render_times(), renderer.render(quantize=kind is not None)[var].astype(float))
+
+	def _params(self, query):
+		''' The canonical parameters of a query (a dict from name to a list
+		of values, as urlparse.parse_qs gives). '''
+		def get(name, default=None):
+			return query.get(name, [default])[-1]
+		var = get('var')
+		if var not in self.series:
+			raise QueryError('Unknown var %r (expected one of %s)' % (var, sorted(self.series)))
+		regions = query.get('region', [])
+		unknown = [region for region in regions if region not in self.lookup]
+		if unknown:
+			raise QueryError('Unknown regions %s (expected some of %s)' % (unknown, [str(key) for key in self.keys]))
+		columns = tuple(self.lookup[region] for region in regions) or tuple(range(len(self.keys)))
+		kernel = get('smoothing', 'none')
+		kernel = None if kernel == 'none' else kernel
+		if kernel not in smoothing.kernels + (None,):
+			raise QueryError('Unknown smoothing %r (expected one of %s)' % (kernel, smoothing.kernels))
+		kind = get('normalization', 'none')
+		kind = None if kind == 'none' else kind
+		if kind not in pipeline.normalizations + (None,):
+			raise QueryError('Unknown normalization %r (expected one of %s)' % (kind, pipeline.normalizations))
+		try:
+			window = int(get('window', 12)) if kernel else None
+			new_range = tuple(float(get(name)) if get(name) is not None else None for name in ('min', 'max'))
+			rate = float(get('rate', controlrate.default_rate))
+			seconds = float(get('seconds')) if get('seconds') is not None else None
+			for date in (get('start'), get('end')):
+				if date is not None:
+					timeaxis.to_datetime64(date)
+		except ValueError as error:
+			raise QueryError(str(error))
+		if kernel and window < 1:
+			raise QueryError('window must be at least 1')
+		if kind is not None:
+			normalization = pipeline.Normalize(kind, *new_range)
+			if not (numpy.isfinite(normalization.new_max) and 0 <= normalization.new_min <= normalization.new_max):
+				raise QueryError('min..max must be a non-negative range, not %s..%s' %
+								 (normalization.new_min, normalization.new_max))
+		for name, value in (('rate', rate), ('seconds', seconds)):
+			if value is not None and not (numpy.isfinite(value) and value > 0):
+				raise QueryError('%s must be positive, not %s' % (name, value))
+		interpolation = get('interpolation', 'cubic')
+		if interpolation not in controlrate.kinds:
+			raise QueryError('Unknown interpolation %r (expected one of %s)' % (interpolation, controlrate.kinds))
+		return (var, kernel, window, get('start'), get('end'), kind, new_range, columns,
+				rate if seconds is not None else None, seconds, interpolation if seconds is not None else None)
+
+	def query(self, query):
+		''' (times, (region, time) values, region keys) for a query. '''
+		params = self._params(query)
+		times, values = self.cache.get(('rendered',) + params, lambda: self._rendered(params))
+		return (times, values, [self.keys[column] for column in params[7]])
+
+def _json_values(values):
+	return [[None if numpy.isnan(value) else value for value in row] for row in values.tolist()]
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+	''' Serves a Service, as server.service. '''
+	def _send(self, status, body, content_type='application/json', headers=()):
+		self.send_response(status)
+		self.send_header('Content-Type', content_type)
+		self.send_header('Content-Length', str(len(body)))
+		for name, value in headers:
+			self.send_header(name, value)
+		self.end_headers()
+		self.wfile.write(body)
+
+	def _send_json(self, result, status=200):
+		self._send(status, json.dumps(result))
+
+	def do_GET(self):
+		url = urlparse.urlparse(self.path)
+		query = urlparse.parse_qs(url.query)
+		service = self.server.service
+		if url.path == '/variables':
+			return self._send_json(service.variables())
+		if url.path == '/stats':
+			return self._send_json(service.cache.stats())
+		if url.path != '/series':
+			return self._send_json({'error': 'Not found: %s' % url.path}, 404)
+		try:
+			times, values, region_keys = service.query(query)
+		except QueryError as error:
+			return self._send_json({'error': str(error)}, 400)
+		var = query['var'][-1]
+		if query.get('format', ['json'])[-1] == 'binary':
+			return self._send(200, values.astype('<f8').tostring(), 'application/octet-stream',
+							  [('X-Regions', json.dumps([str(key) for key in region_keys])),
+							   ('X-Shape', '%d,%d' % values.shape)])
+		self._send_json({'var': var, 'regions': [str(key) for key in region_keys], 'times': times.tolist(),
+						 'values': _json_values(values)})
+
+	def log_message(self, format, *args):
+		pass
+
+def make_server(service, port=default_port):
+	''' An HTTPServer for service on localhost (port 0 picks a free one). '''
+	server = BaseHTTPServer.HTTPServer(('127.0.0.1', port), Handler)
+	server.service = service
+	return server
+
+def serve(service, port=default_port):
+	server = make_server(service, port)
+	print 'Serving on http://127.0.0.1:%d/' % server.server_address[1]
+	server.serve_forever()
+
+def test_service():
+	import os, shutil, tempfile, threading, urllib2
+	from datetime import datetime
+	import parser
+	values = parser._fixture_grid(40, num_lons=9, num_lats=16)
+	hours = parser._month_hours(datetime(1959, 1, 1), len(values))
+	tmpdir = tempfile.mkdtemp()
+	try:
+		filename = os.path.join(tmpdir, 'air.nc')
+		parser._write_test_file(filename, 'air', values, hours)
+		spec = {'variables': [{'name': 'air', 'path': filename, 'window': 6}], 'statistics': ['max'],
+				'start': '1959-01-01'}
+		service = Service(pipeline.Pipeline(spec), max_bytes=1024 * 1024)
+		expected = pipeline.Pipeline(spec).series()
+	finally:
+		shutil.rmtree(tmpdir)
+	assert sorted(service.series) == ['air', 'air_max'] and service.series['air'].shape == (40, 8)
+	# The same smoothing and normalization as the pipeline's.
+	times, result, region_keys = service.query({'var': ['air'], 'smoothing': ['boxcar'], 'window': ['6'],
+												'normalization': ['relative']})
+	assert result.tolist() == [expected['air'][key] for key in region_keys] and numpy.allclose(times, hours[6:])
+	cut = service.query({'var': ['air'], 'smoothing': ['boxcar'], 'window': ['6'], 'start': ['1960-01-01'],
+						 'end': ['1961-01-01'], 'region': ['0,1']})
+	assert cut[1].shape == (1, 12) and cut[2] == [(0, 1)] and numpy.allclose(cut[0], hours[12:24])
+	# Sharing the smoothed series with the first query.
+	assert service.cache.stats()['hits'] == 1
+	rendered = service.query({'var': ['air_max'], 'normalization': ['absolute'], 'max': ['1000'], 'rate': ['10'],
+							  'seconds': ['2']})
+	assert rendered[1].shape == (8, 20) and len(rendered[0]) == 20
+	assert 500 < rendered[1].max() <= 1000 and numpy.array_equal(rendered[1], numpy.round(rendered[1]))
+	# Fractional bounds are fine, and the same query as whole ones.
+	assert service.query({'var': ['air'], 'normalization': ['relative'], 'min': ['0.5'], 'max': ['10']})[1].max() == 10
+	hits = service.cache.stats()['hits']
+	service.query({'var': ['air'], 'normalization': ['relative'], 'min': ['0.50'], 'max': ['10.0']})
+	hits += 1
+	assert service.cache.stats()['hits'] == hits
+
+	server = make_server(service, 0)
+	thread = threading.Thread(target=server.serve_forever)
+	thread.start()
+	try:
+		url = 'http://127.0.0.1:%d' % server.server_address[1]
+		response = json.load(urllib2.urlopen(url + '/series?var=air&region=(0,%201)&region=1,1'))
+		assert response['regions'] == ['(0, 1)', '(1, 1)'] and len(response['values'][0]) == 40
+		binary = urllib2.urlopen(url + '/series?var=air&smoothing=boxcar&window=6&normalization=relative&format=binary')
+		assert binary.info()['X-Shape'] == '8,34'
+		assert numpy.frombuffer(binary.read(), '<f8').reshape(8, 34).tolist() == result.tolist()
+		try:
+			urllib2.urlopen(url + '/series?var=rhum')
+			assert False, 'Expected a 400'
+		except urllib2.HTTPError as error:
+			assert error.code == 400 and 'rhum' in json.load(error)['error']
+		for bad in ('normalization=relative&min=200&max=100', 'normalization=absolute&min=-1', 'seconds=0',
+					'seconds=2&rate=-10', 'seconds=nan'):
+			try:
+				urllib2.urlopen(url + '/series?var=air&' + bad)
+				assert False, 'Expected a 400 for %s' % bad
+			except urllib2.HTTPError as error:
+				assert error.code == 400, bad
+		# The unsmoothed series, and the first query's again.
+		assert json.load(urllib2.urlopen(url + '/stats'))['hits'] == hits + 2
+	finally:
+		server.shutdown()
+		server.server_close()
+		thread.join()
+
+if __name__ == '__main__':
+	# python service.py spec.json [port]: load a pipeline.py spec's series and
+	# answer queries on them at http://127.0.0.1:port/series?var=...
+	import sys
+	serve(Service(pipeline.load(sys.argv[1])), int(sys.argv[2]) if len(sys.argv) > 2 else default_port)
@@ -0,0 +1,182 @@
+'''
+Running-window smoothing of region series.
+
+Everything works on (time, region) arrays, so all regions are smoothed at once.
+The boxcar kernel uses cumulative sums, so the cost is O(n) whatever the window
+length -- which matters once we're on daily or 6-hourly data and the windows
+are hundreds of samples long. The exponential kernel is a one-pole filter run
+through scipy.signal.lfilter.
+
+Missing values (nan) are skipped: a window's mean is over its valid samples,
+and comes out nan only if it has none.
+
+align says where each output sample sits relative to its window:
+	'valid'    -- only complete windows; row i is the mean of rows i..i+window-1
+	'trailing' -- same length as the input; row t ends its window at t
+	'centered' -- same length as the input; row t is the middle of its window
+	              (for even windows, the extra sample comes from before t)
+'trailing' and 'centered' pad with nan wherever the window isn't full.
+
+For feeding one time step at a time (e.g. incremental updates or live input),
+use RunningSmoother, which gives the same values as align='trailing'.
+'''
+import numpy
+from scipy import signal
+
+kernels = ('boxcar', 'exponential')
+alignments = ('valid', 'trailing', 'centered')
+
+def _window_sums(values, window):
+	''' Sums and valid-sample counts over every complete window, via
+	cumulative sums. Each column is offset by its own mean first so the
+	running totals stay small and the differences stay accurate. '''
+	valid = ~numpy.isnan(values)
+	with numpy.errstate(invalid='ignore'):
+		offset = numpy.nanmean(values, axis=0) if len(values) else 0.0
+	offset = numpy.where(numpy.isnan(offset), 0.0, offset)
+	centered = numpy.where(valid, values - offset, 0.0)
+
+	zeros = numpy.zeros((1,) + values.shape[1:])
+	sums = numpy.concatenate((zeros, numpy.cumsum(centered, axis=0)))
+	counts = numpy.concatenate((zeros, numpy.cumsum(valid, axis=0)))
+	window_sums = sums[window:] - sums[:-window]
+	window_counts = counts[window:] - counts[:-window]
+	return (window_sums + offset * window_counts, window_counts)
+
+def running_mean(values, window, align='valid'):
+	''' Boxcar mean of each column of a (time, region) array. '''
+	values = numpy.asarray(values, dtype=float)
+	assert window >= 1, 'Window must be at least one sample, not %s' % window
+	assert align in alignments, 'Unknown alignment %r (expected one of %s)' % (align, alignments)
+	if len(values) < window:
+		means = numpy.empty((0,) + values.shape[1:])
+	else:
+		window_sums, window_counts = _window_sums(values, window)
+		with numpy.errstate(invalid='ignore', divide='ignore'):
+			means = window_sums / window_counts
+	if align == 'valid':
+		return means
+	# Pad back out to the input length.
+	padded = numpy.empty(values.shape)
+	padded.fill(numpy.nan)
+	if align == 'trailing':
+		start = window - 1
+	else:
+		start = window // 2
+	padded[start:start + len(means)] = means
+	return padded
+
+def exponential_mean(values, window, align='trailing'):
+	''' Exponentially weighted mean of each column, with the usual
+	alpha = 2 / (window + 1), so window is roughly the span of a boxcar with
+	the same centre of mass. Starts from each column's first valid value
+	(nan before it); a nan sample after that repeats the last valid one. Only
+	trailing alignment makes sense for a causal filter. '''
+	assert align == 'trailing', 'Exponential smoothing only supports trailing alignment'
+	values = numpy.asarray(values, dtype=float)
+	if not len(values):
+		return values.copy()
+	alpha = 2.0 / (window + 1)
+	# Carry the last good value over any gaps so the filter never sees nan,
+	# and the first one back over the leading ones: the filter holds steady
+	# on it until it's really seen, as if it had started there.
+	valid = ~numpy.isnan(values)
+	first = numpy.argmax(valid, axis=0)[numpy.newaxis]
+	rows = numpy.where(valid, numpy.arange(len(values)).reshape((-1,) + (1,) * (values.ndim - 1)), first)
+	rows = numpy.maximum.accumulate(rows, axis=0)
+	filled = numpy.take_along_axis(values, rows, axis=0)
+	initial = (1 - alpha) * filled[0][numpy.newaxis]
+	smoothed, _ = signal.lfilter([alpha], [1, alpha - 1], filled, axis=0, zi=initial)
+	smoothed[numpy.logical_not(numpy.logical_or.accumulate(valid, axis=0))] = numpy.nan
+	return smoothed
+
+def smooth(values, window=12, kernel='boxcar', align='valid'):
+	''' Smooth each column of a (time, region) array with the given kernel. '''
+	assert kernel in kernels, 'Unknown kernel %r (expected one of %s)' % (kernel, kernels)
+	if kernel == 'exponential':
+		return exponential_mean(values, window, align)
+	return running_mean(values, window, align)
+
+class RunningSmoother(object):
+	''' Incremental version of smooth(..., align='trailing'): push one time step
+	(a row of region values) at a time and get the smoothed row back. Keeps a
+	ring buffer of the last window rows plus running sums, so each step is
+	O(regions) however long the window is. '''
+	def __init__(self, num_regions, window=12, kernel='boxcar'):
+		assert kernel in kernels, 'Unknown kernel %r (expected one of %s)' % (kernel, kernels)
+		self.window = window
+		self.kernel = kernel
+		self.alpha = 2.0 / (window + 1)
+		self.buffer = numpy.zeros((window, num_regions))
+		self.valid = numpy.zeros((window, num_regions), dtype=bool)
+		self.sums = numpy.zeros(num_regions)
+		self.counts = numpy.zeros(num_regions, dtype=int)
+		# nan until each region's first valid value.
+		self.state = numpy.full(num_regions, numpy.nan)
+		self.last = numpy.full(num_regions, numpy.nan)
+		self.seen = 0
+
+	def push(self, row):
+		''' Add one time step; return the smoothed row, nan until the first
+		full window for the boxcar kernel. '''
+		row = numpy.asarray(row, dtype=float)
+		if self.kernel == 'exponential':
+			row = numpy.where(numpy.isnan(row), self.last, row)
+			self.last = row
+			self.state = numpy.where(numpy.isnan(self.state), row, self.state + self.alpha * (row - self.state))
+			self.seen += 1
+			return self.state.copy()
+
+		slot = self.seen % self.window
+		# Drop the sample falling out of the window...
+		self.sums -= numpy.where(self.valid[slot], self.buffer[slot], 0.0)
+		self.counts -= self.valid[slot]
+		# ...and add the new one in its place.
+		present = ~numpy.isnan(row)
+		self.buffer[slot] = numpy.where(present, row, 0.0)
+		self.valid[slot] = present
+		self.sums += self.buffer[slot]
+		self.counts += present
+		self.seen += 1
+
+		result = numpy.empty(len(row))
+		result.fill(numpy.nan)
+		if self.seen >= self.window:
+			with numpy.errstate(invalid='ignore', divide='ignore'):
+				result = self.sums / self.counts
+		return result
+
+def test_running_mean():
+	values = numpy.arange(20, dtype=float).reshape(10, 2) ** 2
+	expected = numpy.array([numpy.mean(values[t-3:t], axis=0) for t in range(3, 11)])
+	assert numpy.allclose(running_mean(values, 3), expected)
+	trailing = running_mean(values, 3, align='trailing')
+	assert numpy.isnan(trailing[:2]).all() and numpy.allclose(trailing[2:], expected)
+	centered = running_mean(values, 3, align='centered')
+	assert numpy.isnan(centered[[0, -1]]).all() and numpy.allclose(centered[1:-1], expected)
+
+	values[4, 0] = numpy.nan
+	assert numpy.allclose(running_mean(values, 3)[2:5, 0], [(16 + 36) / 2.0, (36 + 100) / 2.0, (100 + 144) / 2.0])
+
+def test_running_smoother_matches_batch():
+	values = numpy.random.RandomState(0).randn(50, 3)
+	values[7, 1] = numpy.nan
+	for kernel in kernels:
+		smoother = RunningSmoother(3, window=12, kernel=kernel)
+		streamed = numpy.array([smoother.push(row) for row in values])
+		batch = smooth(values, 12, kernel=kernel, align='trailing')
+		assert numpy.allclose(streamed, batch, equal_nan=True), 'Streamed %s smoothing differs from batch' % kernel
+
+def test_exponential_leading_missing():
+	values = numpy.random.RandomState(1).randn(30, 4)
+	values[:5, 0] = numpy.nan
+	values[[0, 3, 4], 1] = numpy.nan
+	values[:, 2] = numpy.nan
+	batch = smooth(values, 6, kernel='exponential', align='trailing')
+	smoother = RunningSmoother(4, window=6, kernel='exponential')
+	streamed = numpy.array([smoother.push(row) for row in values])
+	assert numpy.allclose(streamed, batch, equal_nan=True)
+	# Seeded from the first valid value, as if the series started there.
+	assert numpy.isnan(batch[:5, 0]).all() and numpy.allclose(batch[5:, 0], smooth(values[5:, :1], 6, 'exponential', 'trailing')[:, 0])
+	assert numpy.isnan(batch[0, 1]) and batch[1, 1] == values[1, 1]
+	assert numpy.isnan(batch[:, 2]).all() and numpy.allclose(batch[:, 3], smooth(values[:, 3:], 6, 'exponential', 'trailing')[:, 0])
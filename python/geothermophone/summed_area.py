@@ -0,0 +1,258 @@
+'''
+Summed-area-table index of a variable, for re-cutting the globe into
+different regions without going back to the NetCDF file.
+
+build_index reads the variable once and stores, for every time step, the 2-D
+prefix sums of its weighted values and of the weights of its non-missing
+cells:
+	sums[t, i, j]   = sum of weight * values[t, :i, :j] (missing cells as 0)
+	counts[t, i, j] = sum of the weights of the valid cells in values[t, :i, :j]
+Any rectangle's sum (or count) is then four lookups, so the mean of any
+lon/lat rectangle at any time is O(1), and a whole layout's worth of series
+is a handful of array operations however big the grid is.
+
+Cells are weighted by their area (regrid.cell_areas, from the file's lat/lon
+variables) when parser.region_weighting is 'area', as get_all_data's octants
+are; without coordinates, or with 'degrees', every cell weighs 1 and counts
+are plain counts.
+
+IndexedSplitter answers like LonLatSplitter, but for arbitrary bin edges, and
+computes region series straight from an index. Regions are index rectangles
+of whole cells, using parser.py's (lon, lat) naming of the two grid axes.
+
+An index is a directory holding sums.npy, counts.npy, hours.npy and
+index.json; the arrays are memory-mapped when opened. hours.npy is the time
+axis decoded from the file's units into parser.py's hours since 1-1-1 (see
+timeaxis.py), whatever units the file uses.
+'''
+import json
+import os
+import numpy
+from numpy.lib import format as npy_format
+from scipy.io import netcdf
+from packing import Packing
+import parser
+import regrid
+import timeaxis
+
+default_block_size = 120
+
+def build_index(var, filename, index_dir, first=0, last=None, block_size=default_block_size):
+	''' Build the index for records first..last-1 of var in filename,
+	weighting cells as parser.region_weighting says. '''
+	if not os.path.isdir(index_dir):
+		os.makedirs(index_dir)
+	f = netcdf.netcdf_file(filename, 'r', mmap=True)
+	try:
+		data = f.variables[var]
+		packing = Packing.of(data)
+		if last is None:
+			last = data.shape[0]
+		num_times = last - first
+		shape = (num_times, data.shape[1] + 1, data.shape[2] + 1)
+		lats, lons = parser._coordinates(f, data)
+		if parser.region_weighting == 'area' and lats is not None and lons is not None:
+			weighting, weights = 'area', regrid.cell_areas(lats, lons)
+		else:
+			weighting, weights = None, numpy.ones(data.shape[1:])
+		sums = npy_format.open_memmap(os.path.join(index_dir, 'sums.npy'), mode='w+', dtype=numpy.float64, shape=shape)
+		counts = npy_format.open_memmap(os.path.join(index_dir, 'counts.npy'), mode='w+', dtype=numpy.float64, shape=shape)
+		for start in range(first, last, block_size):
+			stop = min(start + block_size, last)
+			raw = data.data[start:stop]
+			valid = packing.valid(raw)
+			if valid is None:
+				valid = numpy.ones(raw.shape, dtype=bool)
+			block = packing.decode(raw)
+			rows = slice(start - first, stop - first)
+			valid_weights = numpy.where(valid, weights, 0.0)
+			sums[rows, 1:, 1:] = (numpy.where(valid, block, 0.0) * valid_weights).cumsum(axis=1).cumsum(axis=2)
+			counts[rows, 1:, 1:] = valid_weights.cumsum(axis=1).cumsum(axis=2)
+		sums.flush()
+		counts.flush()
+		hours = timeaxis.TimeAxis.from_variable(f.variables['time']).hours[first:last]
+		numpy.save(os.path.join(index_dir, 'hours.npy'), hours)
+	finally:
+		data = raw = sums = counts = None
+		f.close()
+	with open(os.path.join(index_dir, 'index.json'), 'w') as meta:
+		json.dump({'var': var, 'source': os.path.abspath(filename), 'first': first, 'last': last,
+				   'grid_shape': list(shape[1:]), 'weighting': weighting}, meta)
+	return SummedAreaIndex(index_dir)
+
+class SummedAreaIndex(object):
+	''' An index written by build_index, memory-mapped. '''
+	def __init__(self, index_dir):
+		with open(os.path.join(index_dir, 'index.json')) as meta:
+			self.meta = json.load(meta)
+		self.sums = numpy.load(os.path.join(index_dir, 'sums.npy'), mmap_mode='r')
+		self.counts = numpy.load(os.path.join(index_dir, 'counts.npy'), mmap_mode='r')
+		self.hours = numpy.load(os.path.join(index_dir, 'hours.npy'))
+		self.grid_shape = (self.sums.shape[1] - 1, self.sums.shape[2] - 1)
+
+	def __len__(self):
+		return self.sums.shape[0]
+
+	def _rectangle(self, table, lon_start, lon_stop, lat_start, lat_stop, times):
+		# One time step, or a slice or array of them.
+		return (table[times, lon_stop, lat_stop] - table[times, lon_start, lat_stop]
+				- table[times, lon_stop, lat_start] + table[times, lon_start, lat_start])
+
+	def rectangle_sum_count(self, lon_start, lon_stop, lat_start, lat_stop, times=slice(None)):
+		''' (weighted sum, total weight) of the valid cells in [lon_start,
+		lon_stop) x [lat_start, lat_stop), at the given time index or
+		indices. '''
+		return (self._rectangle(self.sums, lon_start, lon_stop, lat_start, lat_stop, times),
+				self._rectangle(self.counts, lon_start, lon_stop, lat_start, lat_stop, times))
+
+	def rectangle_mean(self, lon_start, lon_stop, lat_start, lat_stop, times=slice(None)):
+		''' Mean of the valid cells in a rectangle; nan where there are none. '''
+		sums, counts = self.rectangle_sum_count(lon_start, lon_stop, lat_start, lat_stop, times)
+		with numpy.errstate(invalid='ignore', divide='ignore'):
+			return sums / counts
+
+	def grid_means(self, lon_edges, lat_edges, times=slice(None)):
+		''' Means of every rectangle of a grid of bins, shaped
+		(time, lon bins, lat bins), or (lon bins, lat bins) for a single time
+		index. Edges are cell indices, starting at 0 and ending at the grid
+		size. '''
+		single = not isinstance(times, slice) and numpy.ndim(times) == 0
+		if single:
+			times = numpy.atleast_1d(times)
+		lon_edges = numpy.asarray(lon_edges)
+		lat_edges = numpy.asarray(lat_edges)
+		corners = numpy.ix_(lon_edges, lat_edges)
+		sums = self.sums[times][(slice(None),) + corners]
+		counts = self.counts[times][(slice(None),) + corners]
+		def differences(table):
+			return table[:, 1:, 1:] - table[:, :-1, 1:] - table[:, 1:, :-1] + table[:, :-1, :-1]
+		with numpy.errstate(invalid='ignore', divide='ignore'):
+			means = differences(sums) / differences(counts)
+		return means[0] if single else means
+
+def even_edges(size, num_bins):
+	''' Edges that put cell i in bin floor(i / (size / num_bins)), the same
+	split LonLatSplitter makes. '''
+	divisor = size / float(num_bins)
+	return [int(numpy.ceil(k * divisor)) for k in range(num_bins)] + [size]
+
+class IndexedSplitter(object):
+	''' LonLatSplitter's interface for arbitrary bin edges, answering region
+	series from a SummedAreaIndex. '''
+	def __init__(self, index, lon_edges, lat_edges):
+		self.index = index
+		self.lon_edges = list(lon_edges)
+		self.lat_edges = list(lat_edges)
+		self.lon_range, self.lat_range = index.grid_shape
+		assert self.lon_edges[0] == 0 and self.lon_edges[-1] == self.lon_range, \
+			'Lon edges must run from 0 to %d' % self.lon_range
+		assert self.lat_edges[0] == 0 and self.lat_edges[-1] == self.lat_range, \
+			'Lat edges must run from 0 to %d' % self.lat_range
+		assert numpy.all(numpy.diff(self.lon_edges) > 0) and numpy.all(numpy.diff(self.lat_edges) > 0), \
+			'Edges must increase'
+
+	@classmethod
+	def even(cls, index, num_lon_bins=4, num_lat_bins=2):
+		''' Evenly sized bins, e.g. (4, 2) for the octants, (4, 4) or (8, 4)
+		for 16 or 32 panels. '''
+		return cls(index, even_edges(index.grid_shape[0], num_lon_bins), even_edges(index.grid_shape[1], num_lat_bins))
+
+	def split_to_octs(self, lon, lat):
+		''' return the key (lon bin, lat bin) the cell is in. '''
+		assert lon < self.lon_range, 'Longitude %d is outside range (max should be %d)' % (lon, self.lon_range-1)
+		assert lat < self.lat_range, 'Latitude %d is outside range (max should be %d)' % (lat, self.lat_range-1)
+		return (int(numpy.searchsorted(self.lon_edges, lon, side='right')) - 1,
+				int(numpy.searchsorted(self.lat_edges, lat, side='right')) - 1)
+
+	def keys(self):
+		return [(lon_key, lat_key)
+				for lon_key in range(len(self.lon_edges) - 1)
+				for lat_key in range(len(self.lat_edges) - 1)]
+
+	def series(self, times=slice(None)):
+		''' {(lon_key, lat_key): list of means over time}, like
+		parser.get_region_series without smoothing. A single time index
+		gives lists of one. '''
+		if not isinstance(times, slice):
+			times = numpy.atleast_1d(times)
+		means = self.index.grid_means(self.lon_edges, self.lat_edges, times)
+		return dict(((lon_key, lat_key), means[:, lon_key, lat_key].tolist()) for (lon_key, lat_key) in self.keys())
+
+def test_indexed_splitter_matches_reducer():
+	import shutil, tempfile
+	import parser
+	from reducer import RegionReducer
+	missing_value = numpy.float32(-9.96921e+36)
+	values = parser._fixture_grid(10, num_lons=9, num_lats=16, missing_value=missing_value)
+	tmpdir = tempfile.mkdtemp()
+	try:
+		filename = os.path.join(tmpdir, 'air.nc')
+		parser._write_test_file(filename, 'air', values, parser._month_hours(parser.starttime, len(values)), missing_value)
+		index = build_index('air', filename, os.path.join(tmpdir, 'index'), block_size=3)
+		os.remove(filename) # the index shouldn't need it
+		splitter = IndexedSplitter.even(index, 4, 2)
+		series = splitter.series()
+
+		lls = parser.LonLatSplitter(9, 16)
+		reducer = RegionReducer(*lls.label_grid())
+		expected = reducer.to_series(reducer.means(*reducer.reduce_block(values, missing_value)))
+		assert sorted(series) == sorted(expected)
+		for key in expected:
+			assert numpy.allclose(series[key], expected[key], rtol=1e-12), key
+		for lon in range(9):
+			for lat in range(16):
+				assert splitter.split_to_octs(lon, lat) == lls.split_to_octs(lon, lat)
+
+		# One arbitrary rectangle, directly.
+		block = values[4, 2:7, 3:11].astype(float)
+		valid = block != missing_value
+		assert numpy.allclose(index.rectangle_mean(2, 7, 3, 11, 4), block[valid].mean())
+		assert index.rectangle_sum_count(2, 7, 3, 11, 4)[1] == valid.sum()
+		# A single time index, as an int.
+		assert numpy.allclose(index.grid_means(splitter.lon_edges, splitter.lat_edges, 4)[0, 1], expected[(0, 1)][4])
+		assert splitter.series(-1)[(3, 1)] == series[(3, 1)][-1:]
+	finally:
+		index = splitter = None
+		shutil.rmtree(tmpdir)
+
+def test_index_decodes_time_units():
+	import shutil, tempfile
+	from datetime import datetime
+	import parser
+	values = parser._fixture_grid(6, num_lons=9, num_lats=16)
+	hours = parser._month_hours(datetime(1960, 1, 1), len(values))
+	tmpdir = tempfile.mkdtemp()
+	try:
+		filename = os.path.join(tmpdir, 'air.nc')
+		# The same times, counted from 1800 as the yearly files do.
+		parser._write_test_file(filename, 'air', values, timeaxis.encode(timeaxis.decode(hours), 'hours since 1800-1-1'))
+		f = netcdf.netcdf_file(filename, 'a')
+		f.variables['time'].units = 'hours since 1800-1-1 00:00:0.0'
+		f.close()
+		index = build_index('air', filename, os.path.join(tmpdir, 'index'), first=1, last=5)
+		assert numpy.allclose(index.hours, hours[1:5])
+	finally:
+		index = None
+		shutil.rmtree(tmpdir)
+
+def test_index_weights_by_area():
+	import shutil, tempfile
+	import regions
+	lats = regrid.regular_lats(13)
+	lons = regrid.regular_lons(24)
+	values = parser._fixture_grid(4, num_lons=13, num_lats=24, missing_value=-9999.0)
+	tmpdir = tempfile.mkdtemp()
+	try:
+		filename = os.path.join(tmpdir, 'air.nc')
+		parser._write_test_file(filename, 'air', values, parser._month_hours(parser.starttime, len(values)), -9999.0,
+								lats=lats, lons=lons)
+		index = build_index('air', filename, os.path.join(tmpdir, 'index'))
+		series = IndexedSplitter.even(index, 4, 4).series()
+	finally:
+		index = None
+		shutil.rmtree(tmpdir)
+	# The same 16 panels as area-weighted regions.
+	reducer = regions.bins(4, 4).reducer((13, 24), lats, lons, weighting='area')
+	expected = reducer.to_series(reducer.means(*reducer.reduce_block(values, -9999.0)))
+	for key in expected:
+		assert numpy.allclose(series[key], expected[key], rtol=1e-12), key
@@ -0,0 +1,182 @@
+'''
+Time axes: a file's time variable decoded, all at once, into a numpy
+datetime64 array, with selection by date and resampling of region series to
+seasons, years or decades.
+
+Time variables count some unit "since" an epoch, given in their units
+attribute, e.g. the monthly files' "hours since 1-1-1 00:00:0.0" and the
+yearly files' "hours since 1800-1-1 00:00:0.0". The files (like udunits) use
+the standard calendar: Julian before 1582-10-15 and Gregorian after. numpy
+and datetime use the Gregorian calendar throughout, and Julian 1-1-1 is
+Gregorian 0000-12-30, two days earlier. Those two days are where parser.py's
+old "trial and error" timeoffset of 693962 days came from: 1-1-1 to 1901-1-1
+is 693960 days in the proleptic Gregorian calendar. Epochs before the cutover
+are converted here instead. (Times themselves are assumed to fall after the
+cutover, as all of NCEP's do.)
+'''
+from datetime import datetime
+import re
+import numpy
+
+# What parser.py has always called "hours" (and what export.py writes out).
+standard_units = 'hours since 1-1-1 00:00:0.0'
+
+unit_seconds = {'seconds': 1, 'minutes': 60, 'hours': 3600, 'days': 86400}
+for _unit in list(unit_seconds):
+	unit_seconds[_unit[:-1]] = unit_seconds[_unit]
+
+periods = ('season', 'year', 'decade')
+season_names = ('DJF', 'MAM', 'JJA', 'SON')
+
+_units_pattern = re.compile(r'\s*(\w+)\s+since\s+(-?\d+)-(\d+)-(\d+)(?:[ T](\d+):(\d+)(?::(\d+(?:\.\d*)?))?)?')
+
+def _julian_to_gregorian(year, month, day):
+	''' The proleptic Gregorian datetime64[D] of a Julian calendar date. '''
+	a = (14 - month) // 12
+	y = year + 4800 - a
+	m = month + 12 * a - 3
+	julian_day = day + (153 * m + 2) // 5 + 365 * y + y // 4 - 32083
+	return numpy.datetime64('1970-01-01', 'D') + numpy.timedelta64(julian_day - 2440588, 'D')
+
+def parse_units(units):
+	''' Return (seconds per unit, epoch as datetime64[s]) for units of the
+	form '<unit> since Y-M-D[ h:m[:s]]'. '''
+	match = _units_pattern.match(units or '')
+	assert match and match.group(1).lower() in unit_seconds, \
+		'Can only handle time units of the form "<hours|days|...> since Y-M-D", not %r' % units
+	unit, year, month, day, hour, minute, second = match.groups()
+	year, month, day = int(year), int(month), int(day)
+	if (year, month, day) < (1582, 10, 15):
+		epoch = _julian_to_gregorian(year, month, day)
+	else:
+		epoch = numpy.datetime64('%04d-%02d-%02d' % (year, month, day), 'D')
+	seconds = int(hour or 0) * 3600 + int(minute or 0) * 60 + float(second or 0)
+	epoch = epoch.astype('datetime64[s]') + numpy.timedelta64(int(round(seconds)), 's')
+	return (unit_seconds[unit.lower()], epoch)
+
+def decode(values, units=standard_units):
+	''' Times in the given units as a datetime64[s] array, to the second. '''
+	scale, epoch = parse_units(units)
+	seconds = numpy.round(numpy.asarray(values, dtype=numpy.float64) * scale).astype(numpy.int64)
+	return epoch + seconds.astype('timedelta64[s]')
+
+def encode(dates, units=standard_units):
+	''' Inverse of decode: datetime64s (or datetimes) as float times in units. '''
+	scale, epoch = parse_units(units)
+	seconds = (numpy.asarray(dates, dtype='datetime64[s]') - epoch).astype(numpy.int64)
+	return seconds / float(scale)
+
+def to_datetime64(date):
+	''' A datetime, date string or datetime64 as a datetime64[s]. '''
+	return numpy.datetime64(date, 's')
+
+class TimeAxis(object):
+	''' A decoded time variable. dates is sorted, as the files' time axes are. '''
+	def __init__(self, values, units=standard_units):
+		self.units = units
+		self.dates = decode(values, units)
+
+	@classmethod
+	def from_variable(cls, time_var):
+		''' The TimeAxis of a netcdf_variable (copied out of any mmap). '''
+		return cls(numpy.array(time_var[:], dtype=numpy.float64), getattr(time_var, 'units', standard_units))
+
+	def __len__(self):
+		return len(self.dates)
+
+	@property
+	def hours(self):
+		''' The times in standard_units, parser.py's "hours since 1-1-1". '''
+		return encode(self.dates)
+
+	def select(self, start, end):
+		''' Return (first, last) such that dates[first:last] are the records
+		with start <= date < end. start/end are datetimes, date strings or
+		datetime64s. A binary search, since the axis is sorted. '''
+		first = numpy.searchsorted(self.dates, to_datetime64(start), side='left')
+		last = numpy.searchsorted(self.dates, to_datetime64(end), side='left')
+		return (int(first), int(max(first, last)))
+
+def period_starts(dates, period):
+	''' The datetime64[M] start of the period each date falls in. Seasons are
+	meteorological (DJF, MAM, JJA, SON), so December starts the next year's
+	winter. '''
+	assert period in periods, 'Unknown period %r (expected one of %s)' % (period, periods)
+	months = numpy.asarray(dates, dtype='datetime64[M]').astype(numpy.int64) # since 1970-01
+	if period == 'season':
+		months = (months + 1) // 3 * 3 - 1
+	else:
+		years = months // 12
+		if period == 'decade':
+			# Decades start on years ending in 0 (1970 is one).
+			years = years // 10 * 10
+		months = years * 12
+	return months.astype('datetime64[M]')
+
+def resample(values, dates, period, how='mean', min_count=1):
+	''' Aggregate a (time, ...) array over the periods its (sorted) dates fall
+	in. Returns (period starts as datetime64[M], aggregated values), nan-aware:
+	missing (nan) values are skipped, and periods with fewer than min_count
+	values come out as nan (e.g. min_count=3 for whole seasons of monthly
+	data). how is 'mean', 'sum', 'min' or 'max'. '''
+	values = numpy.asarray(values, dtype=float)
+	starts = period_starts(dates, period)
+	if not len(starts):
+		return (starts, values[:0])
+	boundaries = numpy.concatenate(([0], numpy.nonzero(starts[1:] != starts[:-1])[0] + 1))
+	present = ~numpy.isnan(values)
+	counts = numpy.add.reduceat(present, boundaries, axis=0)
+	if how in ('mean', 'sum'):
+		result = numpy.add.reduceat(numpy.where(present, values, 0.0), boundaries, axis=0)
+		if how == 'mean':
+			with numpy.errstate(invalid='ignore', divide='ignore'):
+				result = result / counts
+	elif how == 'min':
+		result = numpy.minimum.reduceat(numpy.where(present, values, numpy.inf), boundaries, axis=0)
+	elif how == 'max':
+		result = numpy.maximum.reduceat(numpy.where(present, values, -numpy.inf), boundaries, axis=0)
+	else:
+		assert False, 'Unknown aggregate %r' % how
+	result[counts < max(min_count, 1)] = numpy.nan
+	return (starts[boundaries], result)
+
+def resample_series(series, dates, period, how='mean', min_count=1):
+	''' resample for the {region key: list of values} dicts get_region_series
+	returns. Returns (period starts, dict of aggregated lists). '''
+	keys = sorted(series.keys())
+	values = numpy.array([series[key] for key in keys], dtype=float).T
+	starts, result = resample(values, dates, period, how, min_count)
+	return (starts, dict((key, result[:, i].tolist()) for i, key in enumerate(keys)))
+
+def season_name(start):
+	''' 'DJF 1960' and so on, for a season start from period_starts. '''
+	month = int(numpy.datetime64(start, 'M').astype(numpy.int64)) % 12
+	year = int(numpy.datetime64(start, 'Y').astype(numpy.int64)) + 1970 + (month == 11)
+	return '%s %d' % (season_names[(month + 1) % 12 // 3], year)
+
+def test_decode_units():
+	# The monthly files' units, against the old timeoffset arithmetic.
+	from datetime import timedelta
+	old_hours = (datetime(1948, 1, 1) + timedelta(days=693962) - datetime(1901, 1, 1)).total_seconds() / 3600
+	assert decode([old_hours])[0] == numpy.datetime64('1948-01-01T00:00:00')
+	assert encode([numpy.datetime64('1948-01-01')])[0] == old_hours
+	# The yearly files' units, and days.
+	assert decode([6], 'hours since 1800-1-1 00:00:0.0')[0] == numpy.datetime64('1800-01-01T06:00:00')
+	assert decode([1.5], 'days since 1970-01-01 12:00')[0] == numpy.datetime64('1970-01-03T00:00:00')
+	axis = TimeAxis(encode(numpy.arange('1955-01', '1965-01', dtype='datetime64[M]')))
+	assert axis.select(datetime(1960, 1, 1), '1963-01-01') == (60, 96)
+	assert axis.select('1970-01-01', '1980-01-01') == (120, 120)
+
+def test_resample():
+	dates = numpy.arange('1959-12', '1961-03', dtype='datetime64[M]') # 15 months
+	values = numpy.arange(15, dtype=float)[:, numpy.newaxis] * [1, 10]
+	values[1, 0] = numpy.nan
+	starts, seasonal = resample(values, dates, 'season')
+	assert [season_name(start) for start in starts] == ['DJF 1960', 'MAM 1960', 'JJA 1960', 'SON 1960', 'DJF 1961']
+	assert seasonal[:, 0].tolist() == [1.0, 4.0, 7.0, 10.0, 13.0]
+	assert seasonal[:, 1].tolist() == [10.0, 40.0, 70.0, 100.0, 130.0]
+	starts, annual = resample(values, dates, 'year', min_count=12)
+	assert starts.astype(str).tolist() == ['1959-01', '1960-01', '1961-01']
+	assert numpy.isnan(annual[0, 1]) and annual[1, 1] == 65.0 and numpy.isnan(annual[2, 1])
+	starts, maxes = resample_series({'a': values[:, 1].tolist()}, dates, 'decade', how='max')
+	assert starts.astype(str).tolist() == ['1950-01', '1960-01'] and maxes == {'a': [0.0, 140.0]}